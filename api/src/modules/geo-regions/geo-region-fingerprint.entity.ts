@@ -0,0 +1,27 @@
+import {
+  BaseEntity,
+  Column,
+  Entity,
+  JoinColumn,
+  OneToOne,
+  PrimaryColumn,
+} from 'typeorm';
+import { GeoRegion } from 'modules/geo-regions/geo-region.entity';
+
+/**
+ * Hash of the geometry and H3 resolution a GADM geo region was polyfilled from.
+ * Written by the incremental refresh in data/preprocessing/gadm/update_geo_region.py
+ * to only polyfill again the regions that changed, not used by the API.
+ */
+@Entity('geo_region_fingerprint')
+export class GeoRegionFingerprint extends BaseEntity {
+  @PrimaryColumn({ type: 'uuid' })
+  geoRegionId!: string;
+
+  @OneToOne(() => GeoRegion, { onDelete: 'CASCADE' })
+  @JoinColumn({ name: 'geoRegionId' })
+  geoRegion: GeoRegion;
+
+  @Column({ type: 'text' })
+  fingerprint!: string;
+}
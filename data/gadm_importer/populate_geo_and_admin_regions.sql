@@ -4,7 +4,17 @@ CREATE EXTENSION IF NOT EXISTS ltree;
 -- 1. Upsert from gadm to geo_region converting geometry to H3
 TRUNCATE TABLE geo_region CASCADE;
 
+-- geo_region_copy is set by the Makefile: the binary COPY stream written by preprocessing/gadm/gadm_h3.py, with the
+-- cells and geometries loaded without parsing, or the CSV export
+\if :{?geo_region_copy}
+\else
+\set geo_region_copy false
+\endif
+\if :geo_region_copy
+\copy geo_region("id", "h3Compact", "h3Flat", "h3FlatLength", "name", "theGeom") FROM PROGRAM 'gzip -dc geo_region.copy.gz' WITH (FORMAT binary);
+\else
 \copy geo_region("id", "h3Compact", "h3Flat", "h3FlatLength", "name", "theGeom") FROM 'geo_region.csv' WITH (FORMAT csv, HEADER, FORCE_NULL ("h3Compact", "h3Flat"));
+\endif
 -- isCreatedByUser must be false from the start
 UPDATE geo_region SET "isCreatedByUser" = FALSE;
 
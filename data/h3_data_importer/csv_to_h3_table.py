@@ -1,7 +1,9 @@
 """
 The script converts the csv with country data to H3 grid cells using the already populated geo_region and admin_region
 tables to get the h3 hexes for each country. This way it only uses a sql join and avoid doing geo-spatial operations and
-querys.
+querys. The csv values are copied to a temporary table and expanded to H3 in a single statement.
+Regions below country level (admin levels 1 and 2) are matched by their GADM id (i.e. BRA.1_1), stored in
+admin_region.gadmId.
 
 Postgres connection params read from environment:
  - API_POSTGRES_HOST
@@ -10,26 +12,29 @@ Postgres connection params read from environment:
  - API_POSTGRES_DATABASE
 
 Usage:
-    csv_to_h3_table.py <table> <column> <year>
+    csv_to_h3_table.py <file> <table> <column> <year> <iso3_column> [--h3-res=6] [--admin-level=0]
 
 Arguments:
     <file>            Path to the csv file with the hdi data.
     <table>           Postgresql table to create or overwrite.
     <column>          Column to insert HDI data into.
     <year>            Year of the data used.
-    <iso3_column>     Column with the country iso3 code.
+    <iso3_column>     Column with the country iso3 code, or with the GADM id of the regions for admin levels 1 and 2.
+Options:
+    --h3-res=<res>    h3 resolution of the table, the one of the geo_region cells or finer [default: 6].
+    --admin-level=<level>   Admin level of the regions in the csv [0, 1, 2] [default: 0].
 """
 
 import argparse
 import logging
 import os
+from io import StringIO
 from pathlib import Path
 
 import pandas as pd
-from psycopg2 import extensions
+from psycopg2 import extensions, sql
 from psycopg2.pool import ThreadedConnectionPool
-from tqdm import tqdm
-from utils import insert_to_h3_data_and_contextual_layer_tables, slugify
+from utils import index_and_analyze_h3_grid_table, insert_to_h3_data_and_contextual_layer_tables, slugify, timed
 
 CSV_URL = "https://hdr.undp.org/sites/default/files/data/2020/IHDI_HDR2020_040722.csv"
 
@@ -46,17 +51,27 @@ postgres_thread_pool = ThreadedConnectionPool(
 )
 
 
-def insert_h3_grid_table_query(table_name: str, column: str, country_iso3_code: str, hdi_value: float) -> str:
-    query = f"""
-        insert into {table_name} (h3index, "{column}")
+# admin_region column with the code of the regions of each admin level
+ADMIN_LEVEL_CODE_COLUMNS = {0: "isoA3", 1: "gadmId", 2: "gadmId"}
+
+
+def insert_h3_grid_table_query(table_name: str, column: str, admin_level: int) -> sql.Composed:
+    """Expands every region of the csv_values temporary table to its h3 cells joining admin_region and geo_region"""
+    return sql.SQL(
+        """
+        insert into {table} (h3index, {column})
         select
-            h3_uncompact(gr."h3Compact"::h3index[], 6) as h3index,
-            {hdi_value} as "{column}"
-        from geo_region gr
-        join admin_region ar on gr.id = ar."geoRegionId"
-        where ar."isoA3"  = '{country_iso3_code}';
+            h3_uncompact(gr."h3Compact"::h3index[], %(h3_res)s) as h3index,
+            csv_values.value
+        from csv_values
+        join admin_region ar on ar.{code_column} = csv_values.code and ar.level = %(admin_level)s
+        join geo_region gr on gr.id = ar."geoRegionId";
         """
-    return query
+    ).format(
+        table=sql.Identifier(table_name),
+        column=sql.Identifier(column),
+        code_column=sql.Identifier(ADMIN_LEVEL_CODE_COLUMNS[admin_level]),
+    )
 
 
 def load_data(filename: Path) -> pd.DataFrame:
@@ -64,7 +79,13 @@ def load_data(filename: Path) -> pd.DataFrame:
 
 
 def insert_h3_grid_data(
-    df: pd.DataFrame, table: str, value_column: str, iso3_column: str, connection: extensions.connection
+    df: pd.DataFrame,
+    table: str,
+    value_column: str,
+    iso3_column: str,
+    connection: extensions.connection,
+    h3_res: int = 6,
+    admin_level: int = 0,
 ) -> None:
     """
     Parameters
@@ -75,8 +96,14 @@ def insert_h3_grid_data(
         name of the h3 grid table to populate
     value_column : str
         column of the dataset to insert into h3 grid table
+    iso3_column : str
+        column with the iso3 code of the countries, or the GADM id of the regions for admin levels 1 and 2
     connection : psycopg2.extensions.connection
         postgres connection
+    h3_res : int
+        h3 resolution of the table, the one of the geo_region cells or finer
+    admin_level : int
+        admin level of the regions of the dataset
     """
     df = df.loc[:, [iso3_column, value_column]]
     df[value_column] = pd.to_numeric(df[value_column])
@@ -93,18 +120,27 @@ def insert_h3_grid_data(
     with connection:
         with connection.cursor() as cursor:
             log.info(f"Dropping table {table}...")
-            cursor.execute(f"drop table if exists {table};")
+            cursor.execute(sql.SQL("drop table if exists {};").format(sql.Identifier(table)))
             log.info(f"Creating table {table}...")
-            cursor.execute(f'create table {table} (h3index h3index PRIMARY KEY, "{value_column}" real);')
-
-        pbar = tqdm(df.itertuples(), total=len(df))
-        for row in pbar:
-            country_code, value = getattr(row, iso3_column), getattr(row, value_column)
-            pbar.set_description(f"Inserting {country_code} into {table}")
-            query = insert_h3_grid_table_query(table, value_column, country_code, value)
-
-            with connection.cursor() as cursor:
-                cursor.execute(query)
+            # the primary key is built once all the countries are inserted
+            cursor.execute(
+                sql.SQL("create table {} (h3index h3index, {} real);").format(
+                    sql.Identifier(table), sql.Identifier(value_column)
+                )
+            )
+
+            with timed(f"Inserting data into {table}"):
+                cursor.execute("create temporary table csv_values (code text, value real) on commit drop;")
+                with StringIO() as buffer:
+                    df.to_csv(buffer, columns=[iso3_column, value_column], header=False, index=False)
+                    buffer.seek(0)
+                    cursor.copy_expert("copy csv_values (code, value) from stdin with (format csv)", buffer)
+                cursor.execute(
+                    insert_h3_grid_table_query(table, value_column, admin_level),
+                    {"h3_res": h3_res, "admin_level": admin_level},
+                )
+                log.info(f"Inserted {cursor.rowcount} cells of {len(df)} regions into {table}")
+        index_and_analyze_h3_grid_table(connection, table)
 
 
 if __name__ == "__main__":
@@ -113,7 +149,20 @@ if __name__ == "__main__":
     parser.add_argument("table", help="name of the table to be created")
     parser.add_argument("column", help="label of the column to use")
     parser.add_argument("year", help="label of the column to use")
-    parser.add_argument("iso3_column", help="label of the column that contains the country iso3 code")
+    parser.add_argument(
+        "iso3_column",
+        help="label of the column that contains the country iso3 code, or the GADM id for admin levels 1 and 2",
+    )
+    parser.add_argument(
+        "--h3-res", help="h3 resolution of the table, the one of the geo_region cells or finer", default=6, type=int
+    )
+    parser.add_argument(
+        "--admin-level",
+        help="admin level of the regions in the csv",
+        choices=list(ADMIN_LEVEL_CODE_COLUMNS),
+        default=0,
+        type=int,
+    )
     args = parser.parse_args()
 
     # data = download_data(CSV_URL)
@@ -123,7 +172,7 @@ if __name__ == "__main__":
 
     conn = postgres_thread_pool.getconn()
 
-    insert_h3_grid_data(data, args.table, column, args.iso3_column, conn)
-    insert_to_h3_data_and_contextual_layer_tables(args.table, column, 6, "HDI", "Social", args.year, conn)
+    insert_h3_grid_data(data, args.table, column, args.iso3_column, conn, args.h3_res, args.admin_level)
+    insert_to_h3_data_and_contextual_layer_tables(args.table, column, args.h3_res, "HDI", "Social", args.year, conn)
 
     postgres_thread_pool.putconn(conn, close=True)
@@ -0,0 +1,104 @@
+"""On disk cache of raster to H3 conversion results
+
+Entries are Arrow IPC files with the uint64 h3index and the raster values. They are keyed on the sha256 checksum of
+the raster file, the H3 resolution and the converter version, so any unchanged input can be loaded back instead of
+being converted again (i.e. the same folder ingested as production and harvest_area, or a re-run of the Makefile).
+The cache is bounded in size and evicts the least recently used entries first.
+"""
+
+import hashlib
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+import h3ronpy
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+log = logging.getLogger(__name__)  # here we can use __name__ because it is an imported module
+
+# bump the suffix whenever the conversion output changes so stale entries are not reused
+CONVERTER_VERSION = f"h3ronpy{h3ronpy.__version__}-1"
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "landgriffon" / "h3"
+
+
+@lru_cache()
+def file_checksum(filename: Path) -> str:
+    """sha256 of a file, the same that `sha256sum` writes to the data_checksums files"""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def cache_path(cache_dir: Path, raster_file: Path, h3_resolution: int) -> Path:
+    """Path of the cache entry for a raster file converted at the given resolution"""
+    return cache_dir / f"{file_checksum(raster_file)}_res{h3_resolution}_{CONVERTER_VERSION}.arrow"
+
+
+def write_h3_arrow(path: Path, h3: pd.DataFrame):
+    """Writes a single column h3index -> value dataframe to an Arrow IPC file
+
+    The file is written to a temporary name first so a concurrent or interrupted run never sees a half written file.
+    """
+    table = pa.table({"h3index": h3.index.to_numpy(), "value": h3.iloc[:, 0].to_numpy()})
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with pa.OSFile(tmp_path.as_posix(), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def _column_to_numpy(table: pa.Table, name: str) -> np.ndarray:
+    column = table.column(name)
+    return (column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()).to_numpy()
+
+
+def read_h3_arrow(path: Path) -> pd.DataFrame:
+    """Memory-maps an Arrow IPC file written by `write_h3_arrow()` back into a h3index -> value dataframe
+
+    The returned arrays are read-only views of the mapped file, nothing is copied until pages are touched.
+    They stay valid after the file is deleted.
+    """
+    with pa.memory_map(path.as_posix()) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return pd.DataFrame(
+        {"value": _column_to_numpy(table, "value")},
+        index=pd.Index(_column_to_numpy(table, "h3index"), name="h3index", copy=False),
+        copy=False,
+    )
+
+
+def read_from_cache(cache_dir: Path, raster_file: Path, h3_resolution: int) -> Optional[pd.DataFrame]:
+    """Returns the cached h3index -> value dataframe of the raster or None if it is not in the cache"""
+    path = cache_path(cache_dir, raster_file, h3_resolution)
+    if not path.exists():
+        return None
+    h3 = read_h3_arrow(path)
+    path.touch()  # mark entry as recently used
+    log.info(f"Loaded {raster_file.name} H3 conversion from cache")
+    return h3
+
+
+def write_to_cache(cache_dir: Path, raster_file: Path, h3_resolution: int, h3: pd.DataFrame, max_size: int):
+    """Stores the single column h3index -> value dataframe of the raster and evicts old entries if needed"""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    write_h3_arrow(cache_path(cache_dir, raster_file, h3_resolution), h3)
+    log.info(f"Stored {raster_file.name} H3 conversion in cache")
+    evict(cache_dir, max_size)
+
+
+def evict(cache_dir: Path, max_size: int):
+    """Deletes the least recently used entries until the cache is smaller than max_size bytes"""
+    entries = sorted(cache_dir.glob("*.arrow"), key=lambda p: p.stat().st_mtime)
+    total_size = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total_size <= max_size:
+            break
+        total_size -= entry.stat().st_size
+        entry.unlink(missing_ok=True)
+        log.info(f"Evicted {entry.name} from H3 cache")
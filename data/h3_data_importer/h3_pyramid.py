@@ -0,0 +1,126 @@
+"""Coarser resolution companion tables of the h3 grid tables
+
+The API serves the low zoom levels aggregating the full resolution table with `h3_to_parent()` on every request.
+Here the same aggregation is computed once at import time, in numpy on the uint64 indexes, so the importers can store
+a small table for each coarser resolution (`<table>_res<r>`) and register it in h3_data.
+"""
+
+import logging
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils import get_metadata
+
+log = logging.getLogger(__name__)  # here we can use __name__ because it is an imported module
+
+AGG_TYPES = ["sum", "mean", "median", "min", "max", "mode"]
+
+H3_RES_OFFSET = 52
+H3_RES_MASK = np.uint64(0xF << H3_RES_OFFSET)
+H3_MAX_RES = 15
+H3_PER_DIGIT_OFFSET = 3
+
+
+def h3_to_parent(h3index: np.ndarray, resolution: int) -> np.ndarray:
+    """Parent cells at the given (coarser) resolution of an array of uint64 h3 indexes
+
+    Sets the resolution bits and fills the digits of the finer resolutions with 7 (unused), like `h3_to_parent()`.
+    """
+    unused_digits = np.uint64((1 << (H3_PER_DIGIT_OFFSET * (H3_MAX_RES - resolution))) - 1)
+    return (h3index & ~H3_RES_MASK) | np.uint64(resolution << H3_RES_OFFSET) | unused_digits
+
+
+def pyramid_table_name(table: str, resolution: int) -> str:
+    return f"{table}_res{resolution}"
+
+
+def layer_agg_type(table: str) -> str:
+    """aggType of the layer metadata. Layers without metadata are summed, like the API does for them"""
+    metadata_path = Path(__file__).parent / "contextual_layers_metadata" / f"{table}_metadata.json"
+    if not metadata_path.exists():
+        return "sum"
+    return get_metadata(table)["aggType"]
+
+
+def _aggregate(groups: np.ndarray, values: np.ndarray, n_groups: int, agg_type: str) -> np.ndarray:
+    """Aggregate values by group id with the same semantics as the API SQL aggregates, ignoring nulls (NaN)
+
+    Groups without values are NaN.
+    """
+    out_dtype = values.dtype if values.dtype.kind == "f" else np.dtype("float64")
+    out = np.full(n_groups, np.nan, dtype=out_dtype)
+    valid = ~np.isnan(values) if values.dtype.kind == "f" else np.ones(len(values), dtype=bool)
+    groups, values = groups[valid], values[valid]
+    counts = np.bincount(groups, minlength=n_groups)
+    has_values = counts > 0
+    if agg_type in ("sum", "mean"):
+        sums = np.bincount(groups, weights=values, minlength=n_groups)
+        result = sums if agg_type == "sum" else sums / np.maximum(counts, 1)
+        out[has_values] = result[has_values]
+        return out
+    # the rest need the values sorted within each group
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    group_ids = groups[starts]
+    group_counts = counts[group_ids]
+    if agg_type == "min":
+        out[group_ids] = values[starts]
+    elif agg_type == "max":
+        out[group_ids] = values[starts + group_counts - 1]
+    elif agg_type == "median":
+        # percentile_disc(0.5): first value whose position in the group reaches half of it
+        out[group_ids] = values[starts + (group_counts + 1) // 2 - 1]
+    elif agg_type == "mode":
+        # runs of equal values within each group, the longest one wins and ties go to the smallest value
+        run_starts = np.flatnonzero(np.r_[True, (groups[1:] != groups[:-1]) | (values[1:] != values[:-1])])
+        run_lengths = np.diff(np.r_[run_starts, len(values)])
+        run_groups = groups[run_starts]
+        best = np.lexsort((run_starts, -run_lengths, run_groups))
+        first_of_group = np.r_[True, run_groups[best][1:] != run_groups[best][:-1]]
+        winners = run_starts[best[first_of_group]]
+        out[groups[winners]] = values[winners]
+    else:
+        raise ValueError(f"Unknown aggregation type {agg_type}")
+    return out
+
+
+def aggregate_to_resolution(df: pd.DataFrame, resolution: int, agg_type: str) -> pd.DataFrame:
+    """Aggregate every column of an h3 dataframe (uint64 h3index) to the parent cells of the given resolution"""
+    non_numeric = [col for col, dtype in df.dtypes.items() if dtype.kind not in "biuf"]
+    if non_numeric:
+        raise ValueError(f"Only numeric columns can be aggregated, got {', '.join(non_numeric)}")
+    parents, groups = np.unique(h3_to_parent(df.index.to_numpy(dtype="uint64"), resolution), return_inverse=True)
+    columns = {col: _aggregate(groups, df[col].to_numpy(), len(parents), agg_type) for col in df.columns}
+    return pd.DataFrame(columns, index=pd.Index(parents, name="h3index"), copy=False)
+
+
+def h3_pyramid(df: pd.DataFrame, resolutions: List[int], agg_type: str) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """Aggregated dataframes for each of the resolutions, always computed from the full resolution data
+
+    Starting from the original cells instead of the previous level keeps mean, median and mode exact.
+    """
+    for resolution in sorted(resolutions, reverse=True):
+        log.info(f"Aggregating to resolution {resolution} with {agg_type}")
+        yield resolution, aggregate_to_resolution(df, resolution, agg_type)
+
+
+def register_pyramid_tables(cursor, table: str, columns: List[str], resolutions: List[int], year: int):
+    """Replace the h3_data entries of the pyramid tables of table
+
+    They are not linked to indicators, materials or contextual layers, which keep pointing to the full resolution
+    table. Uses only plain parameters so it works with both psycopg2 and psycopg cursors.
+    """
+    tables = [pyramid_table_name(table, resolution) for resolution in resolutions]
+    cursor.execute('DELETE FROM "h3_data" WHERE "h3tableName" = ANY(%s)', (tables,))
+    cursor.executemany(
+        'INSERT INTO "h3_data" ("h3tableName", "h3columnName", "h3resolution", "year") VALUES (%s, %s, %s, %s)',
+        [
+            (pyramid_table_name(table, resolution), column, resolution, year)
+            for resolution in resolutions
+            for column in columns
+        ],
+    )
@@ -1,20 +1,36 @@
 """Raster to h3 table converter."""
 
 import logging
+import math
 import multiprocessing
+import tempfile
+import uuid
 from functools import partial
 from io import StringIO
 from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 import click
 import h3ronpy.raster
+import numpy as np
 import pandas as pd
 import psycopg
 import rasterio as rio
 from psycopg import sql
 from rasterio import DatasetReader
-
-from utils import DTYPES_TO_PG, get_connection_info, slugify, snakify
+from rasterio.windows import Window
+
+from h3_cache import DEFAULT_CACHE_DIR, read_from_cache, read_h3_arrow, write_h3_arrow, write_to_cache
+from h3_pyramid import AGG_TYPES, h3_pyramid, layer_agg_type, pyramid_table_name, register_pyramid_tables
+from utils import (
+    DTYPES_TO_PG,
+    get_connection_info,
+    h3_binary_copy_chunks,
+    index_and_analyze_h3_grid_table,
+    slugify,
+    snakify,
+    timed,
+)
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("raster_to_h3")
@@ -44,34 +60,177 @@ def check_transform(reference_raster: DatasetReader, raster: DatasetReader):
         raise ValueError(message)
 
 
-def raster_to_h3(reference_raster: Path, h3_resolution: int, raster_file: Path) -> pd.DataFrame:
+def raster_to_h3(
+    reference_raster: Path, h3_resolution: int, raster_file: Path, window: Optional[Window] = None
+) -> pd.DataFrame:
     """Convert a raser to a dataframe with h3index -> value
 
-    Uses `h3ronpy.raster.raster_to_dataframe()` which uses already multiprocessing under the hood
-    so there's no need to iterate over the raster windows anymore.
+    Uses `h3ronpy.raster.raster_to_dataframe()`, which already spreads the tiles of the array over its own threads.
+    If `window` is given only that part of the raster is read and converted (see `raster_windows()`), which is how
+    `rasters_to_h3_windowed()` bounds the memory of each worker.
     """
-    log.info(f"Converting {raster_file.name} to H3 dataframe")
+    if window is None:
+        log.info(f"Converting {raster_file.name} to H3 dataframe")
+    else:
+        log.debug(f"Converting {raster_file.name} rows {window.row_off}-{window.row_off + window.height} to H3")
     with rio.open(raster_file) as raster:
         with rio.open(reference_raster) as ref:
             check_srs(ref, raster)
             check_transform(ref, raster)
 
         h3 = h3ronpy.raster.raster_to_dataframe(
-            raster.read(1),
-            transform=raster.transform,
+            raster.read(1, window=window),
+            transform=raster.transform if window is None else raster.window_transform(window),
             nodata_value=raster.nodata,
             h3_resolution=h3_resolution,
             compacted=False,
             geo=False,
         ).set_index("h3index")
-        # we need the h3 index in the hexadecimal form for the DB
-        h3.index = pd.Series(h3.index).apply(lambda x: hex(x)[2:])
+        # the h3 index is kept as uint64 and only converted to the DB representation when writing it
         return h3.rename(columns={"value": slugify(Path(raster.name).stem)})
 
 
+def raster_windows(raster_file: Path, window_rows: Optional[int] = None) -> List[Window]:
+    """Split a raster into full width row bands that can be converted independently
+
+    h3ronpy cuts the array into square tiles of `max(width // 10, 10)` pixels before converting them to H3, so a cell
+    is always produced by the tile that owns it. The bands span the whole raster width and their height is a multiple
+    of that tile size, which means every band is converted with exactly the same tiles as the whole raster and the
+    concatenated bands give the same cells and values as a whole raster conversion.
+    By default the band height follows the raster's internal block grid (rounded up to the tile size).
+    Since a band is at least one tile high it holds at least width * max(width // 10, 10) pixels, e.g. about a fifth
+    of a 2:1 global raster: a `window_rows` below the tile size can't make the bands any smaller.
+    """
+    with rio.open(raster_file) as raster:
+        tile_size = max(raster.width // 10, 10)
+        requested_rows = window_rows
+        if window_rows is None:
+            window_rows = raster.block_shapes[0][0]
+        rows = tile_size * math.ceil(window_rows / tile_size)
+        if requested_rows is not None and rows != requested_rows:
+            log.warning(
+                f"{raster_file.name}: bands of {requested_rows} rows rounded up to {rows} rows, a multiple of the "
+                f"{tile_size} pixels conversion tile size. Each band holds {raster.width}x{rows} pixels"
+            )
+        return [
+            Window(0, row_off, raster.width, min(rows, raster.height - row_off))
+            for row_off in range(0, raster.height, rows)
+        ]
+
+
+def raster_to_h3_arrow(
+    out_dir: Path, reference_raster: Path, h3_resolution: int, raster_file: Path, window: Optional[Window] = None
+) -> Path:
+    """Convert a raster (or a window of it) to H3 and write the result to an Arrow IPC file in out_dir
+
+    Meant to run in the pool workers: only the file path goes back to the parent, which memory-maps the
+    index and value buffers instead of unpickling a whole dataframe.
+    """
+    h3 = raster_to_h3(reference_raster, h3_resolution, raster_file, window)
+    row_off = window.row_off if window is not None else 0
+    path = out_dir / f"{raster_file.stem}_{row_off}.arrow"
+    write_h3_arrow(path, h3)
+    return path
+
+
+def read_raster_h3(path: Path, raster_file: Path) -> pd.DataFrame:
+    """Map back a file written by `raster_to_h3_arrow()` naming the column after the raster"""
+    return read_h3_arrow(path).rename(columns={"value": slugify(raster_file.stem)}, copy=False)
+
+
+def rasters_to_h3(
+    reference_raster: Path, raster_files: List[Path], h3_resolution: int, thread_count: int
+) -> List[pd.DataFrame]:
+    """Convert rasters to H3 one file per worker"""
+    with tempfile.TemporaryDirectory() as out_dir, multiprocessing.Pool(thread_count) as pool:
+        paths = pool.map(partial(raster_to_h3_arrow, Path(out_dir), reference_raster, h3_resolution), raster_files)
+        # mapped buffers outlive the temporary files
+        return [read_raster_h3(path, raster_file) for path, raster_file in zip(paths, raster_files)]
+
+
+def rasters_to_h3_windowed(
+    reference_raster: Path,
+    raster_files: List[Path],
+    h3_resolution: int,
+    thread_count: int,
+    window_rows: Optional[int] = None,
+) -> List[pd.DataFrame]:
+    """Convert rasters to H3 band by band, spreading the bands of all the files across a worker pool
+
+    Each worker only reads one band at a time, so memory stays bounded by band size times worker count
+    instead of by raster size, and single file folders get converted in parallel too.
+    """
+    tasks = [(file, window) for file in raster_files for window in raster_windows(file, window_rows)]
+    log.info(f"Converting {len(raster_files)} rasters to H3 in {len(tasks)} windows")
+    with tempfile.TemporaryDirectory() as out_dir, multiprocessing.Pool(thread_count) as pool:
+        paths = pool.starmap(partial(raster_to_h3_arrow, Path(out_dir), reference_raster, h3_resolution), tasks)
+        windows_h3 = [read_raster_h3(path, file) for (file, _), path in zip(tasks, paths)]
+    h3s = []
+    for raster_file in raster_files:
+        h3s.append(pd.concat([h3 for (file, _), h3 in zip(tasks, windows_h3) if file == raster_file]))
+    return h3s
+
+
+def load_cached_h3(
+    cache_dir: Path, reference_raster: Path, h3_resolution: int, raster_file: Path
+) -> Optional[pd.DataFrame]:
+    """Load the H3 conversion of a raster from the cache (see `h3_cache`) or return None if it is not cached
+
+    The raster is checked against the reference raster exactly like `raster_to_h3()` does.
+    """
+    with rio.open(raster_file) as raster:
+        with rio.open(reference_raster) as ref:
+            check_srs(ref, raster)
+            check_transform(ref, raster)
+    h3 = read_from_cache(cache_dir, raster_file, h3_resolution)
+    if h3 is not None:
+        return h3.rename(columns={"value": slugify(raster_file.stem)})
+
+
+def assemble_h3_dataframes(h3s: List[pd.DataFrame], how: str = "left") -> pd.DataFrame:
+    """Assemble the per raster H3 dataframes into a single wide dataframe in one pass
+
+    Gives the same result as chaining `h3s[0].join(h3s[1]).join(h3s[2])...` with the given `how` ("left" keeps the
+    cells of the first dataframe, "outer" the sorted union of all cells), including column order and NaN filling.
+    Instead of realigning and reallocating the growing dataframe on every join, the uint64 indexes are matched once
+    with sorted numpy operations and every column is scattered into its own preallocated array.
+    The frames are popped from `h3s` while they are placed so each one can be freed as soon as it's no longer needed.
+    """
+    if how == "left":
+        index = h3s[0].index.to_numpy(dtype=np.uint64)
+    elif how == "outer":
+        index = np.unique(np.concatenate([h3.index.to_numpy(dtype=np.uint64) for h3 in h3s]))
+    else:
+        raise ValueError(f"Unsupported join type '{how}'")
+    order = np.argsort(index, kind="stable")
+    sorted_index = index[order]
+
+    columns = {}
+    while h3s:
+        h3 = h3s.pop(0)
+        h3index = h3.index.to_numpy(dtype=np.uint64)
+        positions = np.searchsorted(sorted_index, h3index)
+        found = positions < len(index)
+        found[found] = sorted_index[positions[found]] == h3index[found]
+        rows = order[positions[found]]
+        for column in h3.columns:
+            values = h3[column].to_numpy()
+            if len(rows) == len(index):
+                columns[column] = np.empty(len(index), dtype=values.dtype)
+            else:
+                # same upcasting as pandas when reindexing with missing values
+                columns[column] = np.full(len(index), np.nan, values.dtype if values.dtype.kind == "f" else np.float64)
+            columns[column][rows] = values[found]
+        del h3
+    return pd.DataFrame(columns, index=pd.Index(index, name="h3index"), copy=False)
+
+
 def create_h3_grid_table(connection: psycopg.Connection, table: str, df: pd.DataFrame):
-    """Create H3 table with schema from df"""
-    index = [sql.SQL("h3index h3index PRIMARY KEY")]
+    """Create H3 table with schema from df
+
+    The table has no primary key yet, it is built after the COPY by `index_and_analyze_h3_grid_table()`.
+    """
+    index = [sql.SQL("h3index h3index")]
     extra = [
         sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL(DTYPES_TO_PG[str(dtype)]))
         for col, dtype in zip(df.columns, df.dtypes)
@@ -84,16 +243,48 @@ def create_h3_grid_table(connection: psycopg.Connection, table: str, df: pd.Data
         cur.execute(query)
 
 
-def write_data_to_h3_grid_table(connection: psycopg.Connection, table: str, data: pd.DataFrame):
-    """Copy data to table"""
+def write_data_to_h3_grid_table(connection: psycopg.Connection, table: str, data: pd.DataFrame, copy_format: str):
+    """Copy data to table
+
+    The binary format streams the uint64 h3index and the typed value columns straight from the numpy buffers.
+    The csv format renders the data as text with the h3index in hexadecimal form and is kept as a fallback.
+    """
     with connection.cursor() as cur:
         log.info(f"Writing H3 data to {table}")
-        with StringIO() as buffer:
-            data.to_csv(buffer, na_rep="NULL", header=False)
-            buffer.seek(0)
-            copy_query = sql.SQL("COPY {} FROM STDIN DELIMITER ',' CSV NULL 'NULL';").format(sql.Identifier(table))
+        if copy_format == "binary":
+            columns = sql.SQL(", ").join(sql.Identifier(col) for col in ["h3index", *data.columns])
+            copy_query = sql.SQL("COPY {} ({}) FROM STDIN (FORMAT BINARY)").format(sql.Identifier(table), columns)
             with cur.copy(copy_query) as copy:
-                copy.write(buffer.read())
+                for chunk in h3_binary_copy_chunks(data):
+                    copy.write(chunk)
+        else:
+            with StringIO() as buffer:
+                data.set_axis(data.index.map(lambda x: hex(x)[2:])).to_csv(buffer, na_rep="NULL", header=False)
+                buffer.seek(0)
+                copy_query = sql.SQL("COPY {} FROM STDIN DELIMITER ',' CSV NULL 'NULL';").format(sql.Identifier(table))
+                with cur.copy(copy_query) as copy:
+                    copy.write(buffer.read())
+
+
+def staging_table_name(table: str) -> str:
+    """Unique name for the table a new version of `table` gets loaded into
+
+    Short enough for its primary key name to stay within the 63 chars limit of PG identifiers.
+    """
+    return f"{table[:40]}_stg{uuid.uuid4().hex[:8]}"
+
+
+def swap_h3_grid_table(connection: psycopg.Connection, staging_table: str, table: str):
+    """Replace table with the staging table, renaming its primary key to the name it would have had in `table`"""
+    with connection.cursor() as cur:
+        log.info(f"Swapping {staging_table} in as {table}")
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+        cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(staging_table), sql.Identifier(table)))
+        cur.execute(
+            sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+                sql.Identifier(table), sql.Identifier(f"{staging_table}_pkey"), sql.Identifier(f"{table}_pkey")
+            )
+        )
 
 
 def clean_before_insert(connection: psycopg.Connection, table: str):
@@ -109,119 +300,196 @@ def clean_before_insert(connection: psycopg.Connection, table: str):
 def insert_to_h3_master_table(
     connection: psycopg.Connection, table: str, df: pd.DataFrame, h3_res: int, year: int, data_type: str, dataset: str
 ):
-    """Create entry to h3_data that points to the newly created h3 table"""
-    with connection.cursor() as cur:
+    """Create entries to h3_data that point to the newly created h3 table and link them to indicators or materials
+
+    Each step is a single statement for all the columns and they run in pipeline mode, so the number of round trips
+    doesn't grow with the number of columns.
+    """
+    columns = df.columns.tolist()
+    with connection.pipeline(), connection.cursor() as cur:
         log.info(f"Inserting data for {table} into h3_data master table.")
-        for column_name in df.columns:
-            cur.execute(
-                'INSERT INTO "h3_data" ("h3tableName", "h3columnName", "h3resolution", "year")'
-                "VALUES (%s, %s, %s, %s)",
-                (table, column_name, h3_res, year),
-            )
-            if data_type == "indicator":
-                update_for_indicator(cur, dataset, column_name)
-            elif data_type == "material_indicator":
-                update_for_indicator(cur, dataset, column_name)
-                try:
-                    update_for_material_indicator(cur, dataset, column_name)
-                except ValueError:
-                    log.warning(f"Failed to update material_indicator for {column_name}")
-                    continue
-            elif data_type in ["production", "harvest_area"]:
-                update_for_material(cur, dataset, column_name, data_type)
-
-
-def update_for_material_indicator(cursor: psycopg.Cursor, dataset: str, column_name: str):
-    """Updates entry in material_indicator_to_h3"""
-    cursor.execute('select id from "indicator" where "nameCode" = %s', (dataset,))
-    indicator_id = cursor.fetchone()
-    if not indicator_id:
-        log.warning(f"Indicator with 'nameCode' {dataset} does not exists")
-        raise ValueError(f"Indicator with 'nameCode' {dataset} does not exists")
-    # todo: convert to script parameter or something that is not hardcoded for a specific case.
-    spam_id = f"spam_{column_name.split('PerTProduction')[0].lower()}"  # something like 'spam_ocerwhea'
-    cursor.execute('select id from material where "datasetId" = %s', (spam_id,))
-    material_ids = cursor.fetchall()
-    if not material_ids:
-        log.warning(f"Material with 'datasetId' {spam_id} does not exists")
-        raise ValueError(f"Material with 'datasetId' {spam_id} does not exists")
-
-    cursor.execute('select id from h3_data where "h3columnName" = %s', (column_name,))
-    h3_data_id = cursor.fetchone()
-    if not h3_data_id:
-        log.warning(f"h3_data with 'h3columnName' {column_name} does not exists")
-        raise ValueError(f"h3_data with 'h3columnName' {column_name} does not exists")
-
-    # one spam dataset can have multiple materials, so we need to update all of them
-    for material_id in material_ids:
-        cursor.execute('delete from material_indicator_to_h3 where "materialId" = %s', (material_id[0],))
-        cursor.execute(
-            """
-            insert into material_indicator_to_h3 ("materialId", "indicatorId", "h3DataId")
-            values (%s, %s, %s);
-            """,
-            (material_id[0], indicator_id[0], h3_data_id[0]),
+        cur.execute(
+            'INSERT INTO "h3_data" ("h3tableName", "h3columnName", "h3resolution", "year")'
+            'SELECT %s, unnest(%s::text[]), %s, %s RETURNING id, "h3columnName"',
+            (table, columns, h3_res, year),
         )
-        log.info(f"Added material_indicator_to_h3 record for {column_name} of {dataset}")
+        inserted = {column_name: h3_data_id for h3_data_id, column_name in cur.fetchall()}
+        h3_data_ids = {column_name: inserted[column_name] for column_name in columns}
+        if data_type == "indicator":
+            update_for_indicator(cur, dataset, columns)
+        elif data_type == "material_indicator":
+            indicator_id = update_for_indicator(cur, dataset, columns)
+            update_for_material_indicator(cur, dataset, indicator_id, h3_data_ids)
+        elif data_type in ["production", "harvest_area"]:
+            update_for_material(cur, dataset, h3_data_ids, data_type)
+
+
+def select_materials(cursor: psycopg.Cursor, dataset_ids: List[str]) -> Dict[str, list]:
+    """Ids of the materials of each datasetId, one dataset can have multiple materials"""
+    # own cursor so the results of statements still pending in the pipeline don't get in the way
+    query = 'select id, "datasetId" from material where "datasetId" = ANY(%s)'
+    materials = {}
+    for material_id, dataset_id in cursor.connection.execute(query, (dataset_ids,)).fetchall():
+        materials.setdefault(dataset_id, []).append(material_id)
+    return materials
+
+
+def update_for_material_indicator(cursor: psycopg.Cursor, dataset: str, indicator_id, h3_data_ids: Dict[str, Any]):
+    """Replaces the material_indicator_to_h3 entries of the materials of every column"""
+    # todo: convert to script parameter or something that is not hardcoded for a specific case.
+    # something like 'spam_ocerwhea'
+    spam_ids = {column_name: f"spam_{column_name.split('PerTProduction')[0].lower()}" for column_name in h3_data_ids}
+    materials = select_materials(cursor, list(set(spam_ids.values())))
+    # a material linked from several columns keeps the link of the last one
+    links = {}
+    for column_name, spam_id in spam_ids.items():
+        if spam_id not in materials:
+            log.warning(f"Material with 'datasetId' {spam_id} does not exists")
+            log.warning(f"Failed to update material_indicator for {column_name}")
+            continue
+        for material_id in materials[spam_id]:
+            links[material_id] = h3_data_ids[column_name]
+    if not links:
+        return
+    cursor.execute('delete from material_indicator_to_h3 where "materialId" = ANY(%s)', (list(links),))
+    values = sql.SQL(", ").join([sql.SQL("(%s, %s, %s)")] * len(links))
+    cursor.execute(
+        sql.SQL('insert into material_indicator_to_h3 ("materialId", "indicatorId", "h3DataId") values {}').format(
+            values
+        ),
+        [param for material_id, h3_data_id in links.items() for param in (material_id, indicator_id, h3_data_id)],
+    )
+    log.info(f"Added {len(links)} material_indicator_to_h3 records for {dataset}")
 
 
-def update_for_indicator(cursor: psycopg.Cursor, dataset: str, column_name: str):
-    """Updates h3_data with indicatorId"""
-    cursor.execute('select id from "indicator" where "nameCode" = %s', (dataset,))
-    indicator_id = cursor.fetchone()
+def update_for_indicator(cursor: psycopg.Cursor, dataset: str, column_names: List[str]):
+    """Updates h3_data with indicatorId and returns it"""
+    indicator_id = cursor.connection.execute('select id from "indicator" where "nameCode" = %s', (dataset,)).fetchone()
     if not indicator_id:
         log.error(f"Indicator with 'nameCode' {dataset} does not exists")
         raise ValueError(f"Indicator with 'nameCode' {dataset} does not exists")
 
-    cursor.execute('update h3_data  set "indicatorId" = %s where  "h3columnName" = %s', (indicator_id[0], column_name))
-    log.info(f"Updated indicatorId '{indicator_id[0]}' in h3_data for {column_name}")
+    cursor.execute(
+        'update h3_data set "indicatorId" = %s where "h3columnName" = ANY(%s)', (indicator_id[0], column_names)
+    )
+    log.info(f"Updated indicatorId '{indicator_id[0]}' in h3_data for {', '.join(column_names)}")
+    return indicator_id[0]
 
 
-def update_for_material(cursor: psycopg.Cursor, dataset: str, column_name: str, data_type: str):
-    """Delete and insert for material_to_h3"""
-    select_query = sql.SQL('SELECT id FROM "h3_data" WHERE "h3columnName" = {}').format(sql.Literal(column_name))
-    cursor.execute(select_query)
-    h3_data_id = cursor.fetchone()
-    if not h3_data_id:
-        log.error(f"Query result of {select_query.as_string(cursor)} returned nothing.")
-        raise ValueError(f"h3_data with 'h3columnName' {column_name} does not exists")
+def update_for_material(cursor: psycopg.Cursor, dataset: str, h3_data_ids: Dict[str, Any], data_type: str):
+    """Replaces the material_to_h3 entries of the materials of every column"""
     # FIXME: the current solution for naming a material datasets is hard to follow and easy to mess up.
-    dataset_id = dataset + "_" + snakify(column_name).split("_")[-2]
-    log.info(f"Updating material_to_h3 for {column_name} of {dataset_id}")
+    dataset_ids = {column_name: dataset + "_" + snakify(column_name).split("_")[-2] for column_name in h3_data_ids}
     type_map = {"harvest_area": "harvest", "production": "producer"}
-    delete_query = sql.SQL(
-        'DELETE FROM "material_to_h3" WHERE "materialId" = {material_id} AND "type" = {data_type}'
-    ).format(
-        material_id=sql.Placeholder(),
-        data_type=sql.Literal(type_map[data_type]),
+    materials = select_materials(cursor, list(set(dataset_ids.values())))
+    # a material linked from several columns keeps the link of the last one
+    links = {}
+    for column_name, dataset_id in dataset_ids.items():
+        for material_id in materials.get(dataset_id, []):
+            links[material_id] = h3_data_ids[column_name]
+    if not links:
+        return
+    log.info(f"Updating material_to_h3 for {len(links)} materials of {dataset}")
+    cursor.execute(
+        sql.SQL('DELETE FROM "material_to_h3" WHERE "materialId" = ANY(%s) AND "type" = {data_type}').format(
+            data_type=sql.Literal(type_map[data_type])
+        ),
+        (list(links),),
     )
-    insert_query = sql.SQL(
-        'INSERT INTO "material_to_h3" ("materialId", "h3DataId", "type") '
-        "VALUES ({materialid}, {h3dataid}, {datatype})"
-    ).format(
-        materialid=sql.Placeholder(),
-        h3dataid=sql.Literal(h3_data_id[0]),
-        datatype=sql.Literal(type_map[data_type]),
+    values = sql.SQL(", ").join([sql.SQL("(%s, %s, {})").format(sql.Literal(type_map[data_type]))] * len(links))
+    cursor.execute(
+        sql.SQL('INSERT INTO "material_to_h3" ("materialId", "h3DataId", "type") VALUES {}').format(values),
+        [param for material_id, h3_data_id in links.items() for param in (material_id, h3_data_id)],
     )
-    cursor.execute('SELECT id FROM "material" WHERE "datasetId" = %s', (dataset_id,))
-    # cursor is going to be reused in the loop, so we need to fetch all the results before the loop
-    material_ids = cursor.fetchall()
-    for material_id in material_ids:
-        cursor.execute(delete_query, (material_id[0],))
-        cursor.execute(insert_query, (material_id[0],))
-        log.info(f"Updated materialId '{material_id[0]}' in material_to_h3 for {column_name}")
 
 
-def to_the_db(df: pd.DataFrame, table: str, data_type: str, dataset: str, year: int, h3_res: int):
+def load_with_swap(
+    connection: psycopg.Connection,
+    df: pd.DataFrame,
+    table: str,
+    data_type: str,
+    dataset: str,
+    year: int,
+    h3_res: int,
+    copy_format: str,
+):
+    """Load and index the data in a staging table that is committed on its own. Then replace the old table with it
+    and update the metadata in one short transaction, so readers only ever see the complete old or new table and
+    are blocked for the swap only instead of for the whole load.
+    """
+    staging_table = staging_table_name(table)
+    create_h3_grid_table(connection, staging_table, df)
+    connection.commit()
+    try:
+        with timed(f"Copying data to {staging_table}"):
+            write_data_to_h3_grid_table(connection, staging_table, df, copy_format)
+        index_and_analyze_h3_grid_table(connection, staging_table, commit=False)
+        connection.commit()
+        with timed(f"Swapping {staging_table} in and updating metadata of {table}"):
+            swap_h3_grid_table(connection, staging_table, table)
+            clean_before_insert(connection, table)
+            insert_to_h3_master_table(connection, table, df, h3_res, year, data_type, dataset)
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        with connection.cursor() as cur:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging_table)))
+        connection.commit()
+        raise
+
+
+def write_h3_pyramid(
+    connection: psycopg.Connection,
+    table: str,
+    df: pd.DataFrame,
+    h3_res: int,
+    year: int,
+    agg_type: str,
+    copy_format: str,
+):
+    """Store the aggregated tables of all the coarser resolutions (see `h3_pyramid`) and register them in h3_data"""
+    resolutions = list(range(1, h3_res))
+    for resolution, pyramid_df in h3_pyramid(df, resolutions, agg_type):
+        pyramid_table = pyramid_table_name(table, resolution)
+        create_h3_grid_table(connection, pyramid_table, pyramid_df)
+        write_data_to_h3_grid_table(connection, pyramid_table, pyramid_df, copy_format)
+        index_and_analyze_h3_grid_table(connection, pyramid_table, commit=False)
+    with connection.cursor() as cur:
+        register_pyramid_tables(cur, table, df.columns.tolist(), resolutions, year)
+
+
+def to_the_db(
+    df: pd.DataFrame,
+    table: str,
+    data_type: str,
+    dataset: str,
+    year: int,
+    h3_res: int,
+    copy_format: str = "binary",
+    swap: bool = False,
+    pyramid_agg_type: Optional[str] = None,
+):
     """all the database insertion and manipulation happens here
 
-    This way if we need to separate db stuff from actual data processing it can be done easily
+    This way if we need to separate db stuff from actual data processing it can be done easily.
+    With swap the table is replaced atomically, see `load_with_swap()`. With a pyramid_agg_type the coarser
+    resolution tables are built too, see `write_h3_pyramid()`.
     """
     with psycopg.connect(get_connection_info()) as conn:
-        create_h3_grid_table(conn, table, df)
-        write_data_to_h3_grid_table(conn, table, df)
-        clean_before_insert(conn, table)
-        insert_to_h3_master_table(conn, table, df, h3_res, year, data_type, dataset)
+        if swap:
+            load_with_swap(conn, df, table, data_type, dataset, year, h3_res, copy_format)
+        else:
+            with timed(f"Creating table {table}"):
+                create_h3_grid_table(conn, table, df)
+            with timed(f"Copying data to {table}"):
+                write_data_to_h3_grid_table(conn, table, df, copy_format)
+            index_and_analyze_h3_grid_table(conn, table, commit=False)
+            with timed(f"Updating metadata of {table}"):
+                clean_before_insert(conn, table)
+                insert_to_h3_master_table(conn, table, df, h3_res, year, data_type, dataset)
+        if pyramid_agg_type:
+            with timed(f"Building resolution pyramid of {table}"):
+                write_h3_pyramid(conn, table, df, h3_res, year, pyramid_agg_type, copy_format)
 
 
 @click.command()
@@ -235,7 +503,68 @@ def to_the_db(df: pd.DataFrame, table: str, data_type: str, dataset: str, year:
 @click.argument("year", type=int)
 @click.option("--h3-res", "h3_res", type=int, default=6, help="h3 resolution to use [default=6]")
 @click.option("--thread-count", "thread_count", type=int, default=4, help="Number of threads to use [default=4]")
-def main(folder: Path, table: str, data_type: str, dataset: str, year: int, h3_res: int, thread_count: int):
+@click.option(
+    "--windowed", is_flag=True, help="Convert rasters in row bands across the worker pool to bound memory usage"
+)
+@click.option(
+    "--window-rows",
+    "window_rows",
+    type=int,
+    default=None,
+    help=(
+        "Height of the bands used by --windowed, rounded up to a multiple of the conversion tile size "
+        "max(width // 10, 10), so each worker holds at least width * max(width // 10, 10) pixels "
+        "[default=raster block height]"
+    ),
+)
+@click.option(
+    "--copy-format",
+    "copy_format",
+    type=click.Choice(["binary", "csv"]),
+    default="binary",
+    help="Format used to COPY the data into the DB [default=binary]",
+)
+@click.option(
+    "--cache-dir",
+    "cache_dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=DEFAULT_CACHE_DIR,
+    envvar="H3_CACHE_DIR",
+    help=f"Folder of the raster to H3 conversion cache [default={DEFAULT_CACHE_DIR}]",
+)
+@click.option(
+    "--cache-size", "cache_size", type=float, default=20, help="Max size of the conversion cache in GB [default=20]"
+)
+@click.option("--no-cache", "no_cache", is_flag=True, help="Don't read nor write the conversion cache")
+@click.option("--refresh", is_flag=True, help="Convert every raster again and overwrite its cache entry")
+@click.option("--swap", is_flag=True, help="Load into a staging table and swap it in atomically once it is complete")
+@click.option("--pyramid", is_flag=True, help="Also store the data aggregated to every coarser resolution")
+@click.option(
+    "--agg-type",
+    "agg_type",
+    type=click.Choice(AGG_TYPES),
+    default=None,
+    help="Aggregation used by --pyramid [default=aggType of the layer metadata or sum]",
+)
+def main(
+    folder: Path,
+    table: str,
+    data_type: str,
+    dataset: str,
+    year: int,
+    h3_res: int,
+    thread_count: int,
+    windowed: bool,
+    window_rows: Optional[int],
+    copy_format: str,
+    cache_dir: Path,
+    cache_size: float,
+    no_cache: bool,
+    refresh: bool,
+    swap: bool,
+    pyramid: bool,
+    agg_type: Optional[str],
+):
     """Reads a folder of .tif, converts to h3 and loads into a PG table
 
     \b
@@ -248,18 +577,31 @@ def main(folder: Path, table: str, data_type: str, dataset: str, year: int, h3_r
     """
     # Part 1: Convert Raster to h3 index -> value map (or dataframe in this case)
     raster_files = list(folder.glob("*.tif"))
-    partial_raster_to_h3 = partial(raster_to_h3, raster_files[0], h3_res)
-    with multiprocessing.Pool(thread_count) as pool:
-        h3s = pool.map(partial_raster_to_h3, raster_files)
+    reference_raster = raster_files[0]
+    converted = {}
+    if not (no_cache or refresh):
+        for raster_file in raster_files:
+            h3 = load_cached_h3(cache_dir, reference_raster, h3_res, raster_file)
+            if h3 is not None:
+                converted[raster_file] = h3
+    to_convert = [raster_file for raster_file in raster_files if raster_file not in converted]
+    if to_convert:
+        if windowed:
+            h3s = rasters_to_h3_windowed(reference_raster, to_convert, h3_res, thread_count, window_rows)
+        else:
+            h3s = rasters_to_h3(reference_raster, to_convert, h3_res, thread_count)
+        for raster_file, h3 in zip(to_convert, h3s):
+            converted[raster_file] = h3
+            if not no_cache:
+                write_to_cache(cache_dir, raster_file, h3_res, h3, int(cache_size * 1e9))
+    h3s = [converted.pop(raster_file) for raster_file in raster_files]
     log.info(f"Joining H3 data of each raster into single dataframe for table {table}")
-    df = h3s[0]
-    with click.progressbar(h3s[1:], label="Joining H3 dataframes") as pbar:
-        for h3df in pbar:
-            df = df.join(h3df)
-            del h3df
+    df = assemble_h3_dataframes(h3s)
 
     # Part 2: Ingest h3 index into the database
-    to_the_db(df, table, data_type, dataset, year, h3_res)
+    if pyramid and agg_type is None:
+        agg_type = layer_agg_type(table)
+    to_the_db(df, table, data_type, dataset, year, h3_res, copy_format, swap, agg_type if pyramid else None)
 
 
 if __name__ == "__main__":
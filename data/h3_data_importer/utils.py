@@ -1,10 +1,14 @@
 import json
 import logging
 import os
+import time
+from contextlib import contextmanager
 from pathlib import Path
 from re import sub
+from typing import Iterator, Union
 
 import jsonschema
+import numpy as np
 import pandas as pd
 import psycopg
 from jsonschema import ValidationError
@@ -27,6 +31,24 @@ DTYPES_TO_PG = {
     "float64": "double precision",
 }
 
+# numpy representation of the postgres types above in the binary COPY format (network byte order)
+PG_BINARY_DTYPES = {
+    "bool": np.dtype("?"),
+    "smallint": np.dtype(">i2"),
+    "int": np.dtype(">i4"),
+    "bigint": np.dtype(">i8"),
+    "real": np.dtype(">f4"),
+    "double precision": np.dtype(">f8"),
+}
+
+# binary COPY signature followed by the flags field and the header extension length
+PG_COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+PG_COPY_BINARY_TRAILER = b"\xff\xff"
+
+# resources for building the h3index primary key after a bulk load, can be tuned to the DB host with env variables
+MAINTENANCE_WORK_MEM = os.getenv("H3_MAINTENANCE_WORK_MEM", "1GB")
+MAX_PARALLEL_MAINTENANCE_WORKERS = os.getenv("H3_MAX_PARALLEL_MAINTENANCE_WORKERS", "4")
+
 
 def slugify(s):
     # TODO: IS THIS NECESSARY? FIND A PACKAGE THAT DOES IT
@@ -38,6 +60,46 @@ def snakify(s):
     return sub(r"(?<!^)(?=[A-Z])", "_", s).lower()
 
 
+@contextmanager
+def timed(stage: str):
+    """Logs the time spent in the wrapped stage"""
+    start = time.perf_counter()
+    yield
+    log.info(f"{stage} took {time.perf_counter() - start:.2f}s")
+
+
+def set_index_build_settings(cursor):
+    """Sets maintenance_work_mem and the parallel index build workers for the current transaction
+
+    Only uses plain parameters so it works with both psycopg2 and psycopg cursors.
+    """
+    cursor.execute(
+        "SELECT set_config('maintenance_work_mem', %s, true), set_config('max_parallel_maintenance_workers', %s, true)",
+        (MAINTENANCE_WORK_MEM, MAX_PARALLEL_MAINTENANCE_WORKERS),
+    )
+
+
+def quote_identifier(name: str) -> str:
+    """Double quoted SQL identifier, as a plain string so it works with both psycopg2 and psycopg cursors"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def index_and_analyze_h3_grid_table(conn, table: str, commit: bool = True):
+    """Builds the h3index primary key of a table bulk-loaded without it and refreshes its statistics
+
+    Building the index once after the COPY is much cheaper than maintaining it row by row during the load.
+    Takes a psycopg2 or a psycopg connection. With commit=False the work is left in the current transaction.
+    """
+    with conn.cursor() as cursor:
+        set_index_build_settings(cursor)
+        with timed(f"Building primary key of {table}"):
+            cursor.execute(f"ALTER TABLE {quote_identifier(table)} ADD PRIMARY KEY (h3index)")
+        with timed(f"Analyzing {table}"):
+            cursor.execute(f"ANALYZE {quote_identifier(table)}")
+    if commit:
+        conn.commit()
+
+
 def get_contextual_layer_category_enum(conn: connection) -> set:
     """Get the enum of contextual layer categories"""
 
@@ -153,17 +215,65 @@ def get_connection_info() -> str:
     )
 
 
-def h3_table_schema(df: pd.DataFrame) -> sql.Composable:
+def h3_table_schema(df: pd.DataFrame, primary_key: bool = True) -> sql.Composable:
     """Construct an SQL schema for an H3 table from a pandas DataFrame
     TODO: make this func used everywhere and carefull with psycpg version in the future.
     Examples:
         >>> schema = h3_table_schema(df)
         >>> sql.SQL("CREATE TABLE {} ({})").format(sql.Identifier(table), schema)
+
+    For bulk loads use primary_key=False and build it after the COPY with `index_and_analyze_h3_grid_table()`.
     """
-    index = [sql.SQL("h3index h3index PRIMARY KEY")]
+    index = [sql.SQL("h3index h3index PRIMARY KEY" if primary_key else "h3index h3index")]
     extra = [
         sql.SQL("{} {}").format(sql.Identifier(col), sql.SQL(DTYPES_TO_PG[str(dtype)]))
         for col, dtype in zip(df.columns, df.dtypes)
     ]
     schema = sql.SQL(", ").join(index + extra)
     return schema
+
+
+def _scatter(buffer: np.ndarray, positions: np.ndarray, data: np.ndarray):
+    """Write each row of the (n, width) uint8 `data` array into `buffer` starting at the matching position"""
+    buffer[positions[:, np.newaxis] + np.arange(data.shape[1])] = data
+
+
+def h3_binary_copy_chunks(df: pd.DataFrame, chunk_size: int = 500_000) -> Iterator[Union[bytes, memoryview]]:
+    """Encode a dataframe indexed by uint64 h3index as a postgres `COPY ... (FORMAT BINARY)` stream
+
+    The h3index and the value columns are encoded in chunks of `chunk_size` rows straight from the numpy buffers,
+    without going through hex strings or CSV text. NaN values are written as NULL.
+    Examples:
+        >>> with cursor.copy("COPY h3_grid_table (h3index, value) FROM STDIN (FORMAT BINARY)") as copy:
+        ...     for chunk in h3_binary_copy_chunks(df):
+        ...         copy.write(chunk)
+    """
+    dtypes = [PG_BINARY_DTYPES[DTYPES_TO_PG[str(dtype)]] for dtype in df.dtypes]
+    field_count = np.array([len(df.columns) + 1], dtype=">i2").view(np.uint8)
+    h3index_length = np.array([8], dtype=">i4").view(np.uint8)
+    h3index = df.index.to_numpy(dtype=np.uint64)
+    yield PG_COPY_BINARY_HEADER
+    for start in range(0, len(df), chunk_size):
+        index = h3index[start : start + chunk_size]
+        values = [df.iloc[start : start + chunk_size, i].to_numpy() for i in range(len(df.columns))]
+        valids = [~np.isnan(v) if v.dtype.kind == "f" else np.ones(len(v), dtype=bool) for v in values]
+
+        # every row is: field count, h3index length and value, and then length and value (if not null) of each column
+        row_sizes = np.full(len(index), 2 + 4 + 8, dtype=np.int64)
+        for dtype, valid in zip(dtypes, valids):
+            row_sizes += 4 + dtype.itemsize * valid
+        offsets = np.cumsum(row_sizes) - row_sizes
+        buffer = np.empty(row_sizes.sum(), dtype=np.uint8)
+
+        _scatter(buffer, offsets, np.broadcast_to(field_count, (len(index), 2)))
+        _scatter(buffer, offsets + 2, np.broadcast_to(h3index_length, (len(index), 4)))
+        _scatter(buffer, offsets + 6, index.astype(">u8").view(np.uint8).reshape(-1, 8))
+        positions = offsets + 14
+        for value, valid, dtype in zip(values, valids, dtypes):
+            lengths = np.where(valid, dtype.itemsize, -1).astype(">i4")
+            _scatter(buffer, positions, lengths.view(np.uint8).reshape(-1, 4))
+            positions += 4
+            _scatter(buffer, positions[valid], value[valid].astype(dtype).view(np.uint8).reshape(-1, dtype.itemsize))
+            positions += dtype.itemsize * valid
+        yield buffer.data
+    yield PG_COPY_BINARY_TRAILER
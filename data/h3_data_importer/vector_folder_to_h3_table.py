@@ -1,6 +1,7 @@
 """Reads a folder of vector files, converts to h3 and loads into a PG table
 
 All vector files in the folder must have identical projection, transform, etc.
+GeoParquet files (.parquet) are read with pyarrow and the rest (.gdb, .gpkg, .shp, .fgb, .json, .geojson) with GDAL.
 Postgres connection params read from environment:
  - API_POSTGRES_HOST
  - API_POSTGRES_USER
@@ -9,8 +10,12 @@ Postgres connection params read from environment:
 
 Usage:
     vector_folder_to_h3_table.py <folder> <table> <column> <dataset> <category> <year> [--indicator] [--h3-res=6]
+                                 [--pyramid] [--batch-size=10000] [--duplicates=error]
+                                 [--thread-count=1] [--tile-size=10] [--layer=<name>]... [--coverage]
+                                 [--bbox <xmin> <ymin> <xmax> <ymax>]
+                                 [--output <table> <column> <dataset> [<indicator>]]...
 Arguments:
-    <folder>          Folder containing vector file.
+    <folder>          Folder containing the vector files, all of them are merged into the table.
     <table>           Postgresql table to overwrite.
     <column>          Column name of the feature to keep.
     <dataset>         Dataset name
@@ -20,27 +25,59 @@ Options:
     -h                Show help
     --indicator=<indicator_code>    Indicator nameCode
     --h3-res=<res>    h3 resolution to use [default: 6].
+    --layer=<name>    Layer of the vector files to convert, can be repeated [default: first layer].
+                      GeoParquet files have a single layer.
+    --bbox <xmin> <ymin> <xmax> <ymax>
+                      Only convert the features intersecting the bounding box. Uses the spatial index of the
+                      FlatGeobuf and GeoPackage files and skips the GeoParquet row groups outside of it.
+    --pyramid         Also store the data aggregated to every coarser resolution with the metadata aggType.
+    --batch-size=<n>  Number of features read and converted at a time [default: 10000].
+    --duplicates=<policy>   How to resolve h3 indexes found in more than one feature
+                            [error, first, max, mean, area-weighted] [default: error].
+    --coverage        Use every cell touched by the features instead of the cells with their center inside them,
+                      with the values weighted by the fraction of the cell covered by each feature. Gives the
+                      values of converting at a finer resolution and aggregating with the mean, without the extra
+                      cells. Replaces the --duplicates policy.
+    --thread-count=<n>      Number of processes converting the vector files, or tiles of the features of a
+                            single file, in parallel [default: 1].
+    --tile-size=<degrees>   Size of the tiles the features are split in with --thread-count [default: 10].
+    --output <table> <column> <dataset> [<indicator>]
+                      Also load another column of the same file to its own table, converting the geometries
+                      only once. Can be repeated.
 """
 import argparse
+import json
 import logging
+import math
+import multiprocessing
+import multiprocessing.pool
 import os
+from functools import partial
 from io import StringIO
+from itertools import chain
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-import fiona
-import geopandas as gpd
+import h3
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+from h3.api import numpy_int as h3_int
 from h3ronpy import vector
 from psycopg2 import sql
 from psycopg2.extensions import connection
 from psycopg2.pool import ThreadedConnectionPool
+from pyogrio.raw import open_arrow, read
 
+from h3_pyramid import h3_pyramid, layer_agg_type, pyramid_table_name, register_pyramid_tables
 from utils import (
     h3_table_schema,
+    index_and_analyze_h3_grid_table,
     insert_to_h3_data_and_contextual_layer_tables,
     link_to_indicator_table,
     slugify,
+    timed,
 )
 
 DTYPES_TO_PG = {
@@ -58,26 +95,519 @@ DTYPES_TO_PG = {
     "float64": "double precision",
 }
 
+DUPLICATE_POLICIES = ["error", "first", "max", "mean", "area-weighted"]
+
+VECTOR_EXTENSIONS = "gdb gpkg shp fgb json geojson parquet".split()
+# read with pyarrow, the GDAL build of pyogrio has no (Geo)Parquet driver
+PARQUET_SUFFIXES = (".parquet",)
+
+# a vector file and the layer to read from it, None for the default one
+VectorSource = Tuple[Path, Optional[str]]
+# xmin, ymin, xmax, ymax in the CRS of the vector files
+BBox = Tuple[float, float, float, float]
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("vector_folder_to_h3_table")
 
-postgres_thread_pool = ThreadedConnectionPool(
-    1,
-    50,
-    host=os.getenv("API_POSTGRES_HOST"),
-    port=os.getenv("API_POSTGRES_PORT"),
-    user=os.getenv("API_POSTGRES_USERNAME"),
-    password=os.getenv("API_POSTGRES_PASSWORD"),
-)
+# h3ronpy runs rayon threads, and a process forked after they started can deadlock in the child. The worker
+# processes are spawned instead: they only import this module, so nothing here must connect or convert at import time.
+POLYFILL_POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def sources_name(sources: List[VectorSource]) -> str:
+    """Short description of the vector sources for the logs"""
+    if len(sources) == 1:
+        filename, layer = sources[0]
+        return f"{filename}" if layer is None else f"{filename} ({layer})"
+    return f"{len(sources)} vector sources in {sources[0][0].parent}"
+
+
+def is_geoparquet(filename: Path) -> bool:
+    """Whether the file is read as GeoParquet, from its extension"""
+    return filename.suffix.lower() in PARQUET_SUFFIXES
+
+
+def geoparquet_geometry_column(parquet_file: pq.ParquetFile) -> Tuple[str, dict]:
+    """Name and GeoParquet metadata of the primary geometry column, which must be WKB encoded"""
+    geo_metadata = (parquet_file.schema_arrow.metadata or {}).get(b"geo")
+    if geo_metadata is None:
+        raise ValueError("Parquet file without GeoParquet metadata")
+    geo = json.loads(geo_metadata)
+    column = geo["primary_column"]
+    column_metadata = geo["columns"][column]
+    if column_metadata.get("encoding", "WKB").upper() != "WKB":
+        raise ValueError(f"Only WKB encoded GeoParquet geometries are supported, got {column_metadata['encoding']}")
+    return column, column_metadata
+
+
+def geoparquet_row_groups(parquet_file: pq.ParquetFile, column_metadata: dict, bbox: Optional[BBox]) -> List[int]:
+    """Row groups that can have features intersecting bbox
+
+    Uses the statistics of the bbox covering column of GeoParquet 1.1 files. Without it every row group is read and
+    the features are only filtered by their geometry.
+    """
+    row_groups = list(range(parquet_file.num_row_groups))
+    covering = column_metadata.get("covering", {}).get("bbox")
+    if bbox is None or covering is None:
+        return row_groups
+    metadata = parquet_file.metadata
+    paths = {metadata.schema.column(i).path: i for i in range(metadata.num_columns)}
+    bounds = {key: paths.get(".".join(path)) for key, path in covering.items()}
+
+    def statistics(row_group: int, key: str):
+        column = bounds[key]
+        stats = metadata.row_group(row_group).column(column).statistics if column is not None else None
+        return stats if stats is not None and stats.has_min_max else None
+
+    xmin, ymin, xmax, ymax = bbox
+    kept = []
+    for row_group in row_groups:
+        stats = {key: statistics(row_group, key) for key in ("xmin", "ymin", "xmax", "ymax")}
+        if any(stat is None for stat in stats.values()):
+            kept.append(row_group)
+        elif (
+            stats["xmin"].min <= xmax
+            and stats["xmax"].max >= xmin
+            and stats["ymin"].min <= ymax
+            and stats["ymax"].max >= ymin
+        ):
+            kept.append(row_group)
+    log.info(f"Reading {len(kept)} of {len(row_groups)} row groups intersecting {bbox}")
+    return kept
+
+
+def geoparquet_batches(
+    filename: Path, columns: List[str], batch_size: int, bbox: Optional[BBox] = None
+) -> Iterator[Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]]:
+    """Streams the features of a GeoParquet file like `vector_batches`, the fids are the row numbers
+
+    Only the geometry and the requested columns are read.
+    """
+    parquet_file = pq.ParquetFile(filename)
+    geometry_column, column_metadata = geoparquet_geometry_column(parquet_file)
+    row_group_sizes = [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]
+    row_offsets = np.r_[0, np.cumsum(row_group_sizes)]
+    area = shapely.box(*bbox) if bbox is not None else None
+    for row_group in geoparquet_row_groups(parquet_file, column_metadata, bbox):
+        start = row_offsets[row_group]
+        for batch in parquet_file.iter_batches(batch_size, row_groups=[row_group], columns=[geometry_column, *columns]):
+            fids = np.arange(start, start + batch.num_rows, dtype=np.int64)
+            start += batch.num_rows
+            geometries = batch.column(geometry_column).to_numpy(zero_copy_only=False)
+            if area is not None:
+                keep = shapely.intersects(shapely.from_wkb(geometries), area)
+            else:
+                keep = batch.column(geometry_column).is_valid().to_numpy(zero_copy_only=False)
+            values = {column: batch.column(column).to_numpy(zero_copy_only=False)[keep] for column in columns}
+            yield fids[keep], geometries[keep], values
+
+
+def vector_batches(
+    source: VectorSource, columns: List[str], batch_size: int, bbox: Optional[BBox] = None
+) -> Iterator[Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]]:
+    """Streams the features with a geometry of a vector source as batches of fids, WKB geometries and column values
+
+    GDAL sources are read through its Arrow interface and GeoParquet files with pyarrow, both only read the requested
+    columns. With a bbox only the features intersecting it are returned, GDAL uses the spatial index of the file
+    when it has one.
+    """
+    filename, layer = source
+    if is_geoparquet(filename):
+        yield from geoparquet_batches(filename, columns, batch_size, bbox)
+        return
+    stream = open_arrow(
+        filename.as_posix(), layer=layer, columns=columns, bbox=bbox, batch_size=batch_size, return_fids=True
+    )
+    with stream as (meta, reader):
+        geometry_column = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            batch = batch.filter(batch.column(geometry_column).is_valid())
+            fids = batch.column(meta["fid_column"]).to_numpy()
+            geometries = batch.column(geometry_column).to_numpy(zero_copy_only=False)
+            yield fids, geometries, {column: batch.column(column).to_numpy(zero_copy_only=False) for column in columns}
+
+
+def read_features_wkb(filename: Path, layer: Union[str, None], fids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Reads the WKB geometry of the features with the given fids, returns the fids read and their geometries"""
+    fids = np.unique(fids)
+    if is_geoparquet(filename):
+        geometry_column, _ = geoparquet_geometry_column(pq.ParquetFile(filename))
+        table = pq.read_table(filename, columns=[geometry_column])
+        return fids, table.column(geometry_column).take(fids).to_numpy(zero_copy_only=False)
+    _, read_fids, geometries, _ = read(filename.as_posix(), layer=layer, columns=[], fids=fids, return_fids=True)
+    return read_fids, geometries
+
+
+def feature_cell_overlap(filename: Path, layer: Union[str, None], fids: np.ndarray, h3index: np.ndarray) -> np.ndarray:
+    """Area (in square degrees) of the intersection between each feature, given by its fid, and each h3 cell
+
+    Only needed for the duplicated cells, so their features are read again by fid instead of keeping every geometry.
+    """
+    read_fids, geometries = read_features_wkb(filename, layer, fids)
+    sorter = np.argsort(read_fids)
+    features = shapely.from_wkb(geometries)[sorter[np.searchsorted(read_fids, fids, sorter=sorter)]]
+    return shapely.area(shapely.intersection(h3_cell_polygons(h3index), features))
+
+
+def antimeridian_cell_polygon(boundary: np.ndarray) -> shapely.Geometry:
+    """Polygon of a cell outline crossing the antimeridian, split in the parts at each side of it
+
+    The longitudes are unwrapped so the outline is continuous, past ±180 where it crosses it, and the parts beyond
+    ±180 are cut off and moved back 360 degrees. An outline around a pole ends 360 degrees away from where it started
+    and is closed along the latitude of the pole.
+    """
+    lon = np.degrees(np.unwrap(np.radians(boundary[:, 0])))
+    coords = np.column_stack([lon, boundary[:, 1]])
+    if abs(lon[-1] - lon[0]) > 180:
+        pole = 90.0 if boundary[:, 1].mean() > 0 else -90.0
+        coords = np.vstack([coords, [[lon[-1], pole], [lon[0], pole]]])
+    polygon = shapely.make_valid(shapely.Polygon(coords))
+    parts = [
+        shapely.transform(
+            shapely.intersection(polygon, shapely.box(west, -90, west + 360, 90)),
+            lambda c, west=west: c - [west + 180, 0],
+        )
+        for west in (-540, -180, 180)
+    ]
+    return shapely.union_all(parts)
+
+
+def h3_cell_polygons(h3index: np.ndarray) -> np.ndarray:
+    """Shapely polygons of the outline of the uint64 h3 cells, each distinct cell is built once
+
+    Pentagons and cells crossing an icosahedron edge have a different number of vertices, so the rings are built
+    from the flat list of coordinates. The outlines spanning more than 180 degrees of longitude cross the antimeridian
+    and are split at it instead, see `antimeridian_cell_polygon`.
+    h3 3.x has no vectorized cell boundary, so only the boundary call runs per cell: it takes the integer cells
+    as they are and all the coordinates are gathered into a single array in one pass.
+    """
+    cells, inverse = np.unique(h3index, return_inverse=True)
+    boundaries = [h3_int.h3_to_geo_boundary(cell, geo_json=True) for cell in cells.tolist()]
+    lengths = np.fromiter(map(len, boundaries), dtype=np.int64, count=len(boundaries))
+    coords = np.fromiter(
+        chain.from_iterable(chain.from_iterable(boundaries)), dtype=np.float64, count=2 * lengths.sum()
+    ).reshape(-1, 2)
+    rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(cells)), lengths))
+    polygons = shapely.polygons(rings)
+    bounds = shapely.bounds(polygons)
+    starts = np.r_[0, np.cumsum(lengths)]
+    for i in np.flatnonzero(bounds[:, 2] - bounds[:, 0] > 180):
+        polygons[i] = antimeridian_cell_polygon(coords[starts[i] : starts[i + 1]])
+    return polygons[inverse]
+
+
+def coverage_candidates(features: np.ndarray, h3_res: int) -> np.ndarray:
+    """WKB of the shapely features grown by the size of a cell, so the centroid of every cell they touch is inside
+
+    Polyfilling them gives all the cells touched by the features plus some around them that `cell_coverage()` finds
+    not covered. The distance in degrees grows with the latitude of the feature like the degrees of longitude of a
+    cell do.
+    """
+    cell_size = 1.5 * h3.edge_length(h3_res, unit="km") / 111.32
+    max_lat = np.abs(shapely.bounds(features)[:, [1, 3]]).max(axis=1)
+    return shapely.to_wkb(shapely.buffer(features, cell_size / np.cos(np.radians(np.minimum(max_lat, 85)))))
+
+
+def cell_coverage(features: np.ndarray, h3index: np.ndarray) -> np.ndarray:
+    """Fraction of the area of each h3 cell covered by each shapely feature, computed for all pairs at once"""
+    cells = h3_cell_polygons(h3index)
+    return shapely.area(shapely.intersection(cells, features)) / shapely.area(cells)
+
+
+def coverage_weighted_h3(h3df: pd.DataFrame, coverage: np.ndarray) -> pd.DataFrame:
+    """Values of the cells as the mean of the values of the features that cover them weighted by their coverage
+
+    Cells only touched by the features (no covered area) are dropped. A cell half covered by one feature gets the
+    value of the feature, the same the mean of its finer resolution children inside the feature would get.
+    """
+    column = h3df.columns[0]
+    values = h3df[column].to_numpy()
+    if values.dtype.kind not in "biuf":
+        raise ValueError(f"Coverage weighted values need a numeric column but {column} is {values.dtype}")
+    order = np.argsort(h3df.index.to_numpy(), kind="stable")
+    h3index, values, coverage = h3df.index.to_numpy()[order], values[order].astype("float64"), coverage[order]
+    starts = np.flatnonzero(np.r_[True, h3index[1:] != h3index[:-1]])
+    covered = np.add.reduceat(coverage, starts) > 0
+    coverage[np.isnan(values)] = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        resolved = np.add.reduceat(np.nan_to_num(values) * coverage, starts) / np.add.reduceat(coverage, starts)
+    log.info(f"Weighted {len(h3index)} feature cells by coverage into {covered.sum()} cells")
+    return pd.DataFrame(
+        {column: resolved[covered]}, index=pd.Index(h3index[starts][covered], name="h3index"), copy=False
+    )
+
+
+def resolve_duplicated_h3(
+    h3df: pd.DataFrame,
+    fids: np.ndarray,
+    policy: str,
+    sources: List[VectorSource],
+    source_ids: Optional[np.ndarray] = None,
+) -> pd.DataFrame:
+    """Resolves the h3 indexes produced by more than one feature (i.e. overlapping polygons) with a policy
+
+    - error: duplicates with the same value are dropped, different values stop the ingestion to encourage a manual
+      check of the data. The aqueduct data set generates duplicated h3 indexes and we currently don't know why.
+    - first: value of the first feature, in the order of the sources and then of the file
+    - max, mean: max or mean of the values
+    - area-weighted: mean of the values weighted by the area of each feature inside the cell
+
+    Features are identified by their fid and, when converting more than one source (file and layer), by the
+    position of their source in sources given in source_ids.
+    Everything is computed in one pass over the index sorted by h3index, source and fid, where the rows of each cell
+    are contiguous.
+    """
+    if source_ids is None:
+        source_ids = np.zeros(len(fids), dtype=np.int64)
+    name = sources_name(sources)
+    order = np.lexsort((fids, source_ids, h3df.index.to_numpy()))
+    h3index = h3df.index.to_numpy()[order]
+    starts = np.flatnonzero(np.r_[True, h3index[1:] != h3index[:-1]])
+    if len(starts) == len(h3index):
+        return h3df
+    column = h3df.columns[0]
+    values = h3df[column].to_numpy()[order]
+    counts = np.diff(np.r_[starts, len(h3index)])
+    missing = pd.isna(values)
+    same_as_first = (values == np.repeat(values[starts], counts)) | (missing & np.repeat(missing[starts], counts))
+    different = ~np.logical_and.reduceat(same_as_first, starts)
+    n_duplicated, n_different = int((counts > 1).sum()), int(different.sum())
+    log.warning(
+        f"{n_duplicated} H3 indexes found more than once in {name}, {n_different} of them with different values"
+    )
+    if policy == "error" and n_different:
+        idx = h3index[starts[different][0]]
+        log.error(
+            f"Duplicated H3 index {idx} found in {name} with different values."
+            " Data ingestion will stop. Please check the data or use another duplicates policy."
+        )
+        raise ValueError(f"Duplicated H3 index {idx} found in {name} with different values.")
+
+    if policy in ("error", "first"):
+        resolved = values[starts]
+    elif values.dtype.kind not in "biuf":
+        raise ValueError(f"Duplicates policy {policy} needs a numeric column but {column} is {values.dtype}")
+    elif policy == "max":
+        resolved = (np.fmax if values.dtype.kind == "f" else np.maximum).reduceat(values, starts)
+    else:
+        weights = np.ones(len(values))
+        if policy == "area-weighted":
+            duplicated = np.repeat(counts > 1, counts)
+            for source_id in np.unique(source_ids[order][duplicated]):
+                rows = duplicated & (source_ids[order] == source_id)
+                filename, layer = sources[source_id]
+                weights[rows] = feature_cell_overlap(filename, layer, fids[order][rows], h3index[rows])
+        values = values.astype("float64")
+        weights[np.isnan(values)] = 0
+        total_weights = np.add.reduceat(weights, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            resolved = np.add.reduceat(np.nan_to_num(values) * weights, starts) / total_weights
+    log.info(
+        f"Resolved {n_duplicated} duplicated H3 indexes with policy '{policy}',"
+        f" dropped {len(h3index) - len(starts)} rows"
+    )
+    return pd.DataFrame({column: resolved}, index=pd.Index(h3index[starts], name="h3index"), copy=False)
+
+
+def polyfill(h3_res: int, geometries: np.ndarray, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Converts WKB geometries to h3, returns the id of the geometry and the h3index of every cell"""
+    ids_chunks, h3index_chunks = [np.empty(0, dtype=np.uint64)], [np.empty(0, dtype=np.uint64)]
+    for chunk_ids, chunk_h3indexes in vector.geometries_to_h3_generator(
+        geometries, ids, h3_res, chunk_size=max(len(geometries), 1)
+    ):
+        ids_chunks.append(chunk_ids)
+        h3index_chunks.append(chunk_h3indexes)
+    return np.concatenate(ids_chunks), np.concatenate(h3index_chunks)
+
+
+def _polygonal_parts(geometry: shapely.Geometry) -> Union[shapely.Geometry, None]:
+    """Polygons of the result of a clip, dropping the lines and points left where the geometry touches the tile"""
+    polygons = [part for part in shapely.get_parts(geometry) if isinstance(part, shapely.Polygon)]
+    return shapely.MultiPolygon(polygons) if polygons else None
+
+
+def tile_partitions(geometries: np.ndarray, tile_size: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Groups WKB geometries in tasks by the tile of a grid of tile_size degrees they fall in
+
+    Polygons spanning several tiles are clipped to each of them. Cells belong to a polygon when their centroid is
+    inside it, so every cell ends up in exactly one piece and the cells of the pieces are the cells of the polygon.
+    Returns the ids (position in geometries) and WKB of the pieces of each tile, largest tiles first.
+    """
+    shapes = shapely.from_wkb(geometries)
+    n_cols, n_rows = math.ceil(360 / tile_size), math.ceil(180 / tile_size)
+    xmin, ymin, xmax, ymax = shapely.bounds(shapes).T
+    col_min, col_max = (np.clip((x + 180) // tile_size, 0, n_cols - 1).astype(int) for x in (xmin, xmax))
+    row_min, row_max = (np.clip((y + 90) // tile_size, 0, n_rows - 1).astype(int) for y in (ymin, ymax))
+    tiles = {}
+    for i, shape in enumerate(shapes):
+        polygonal = isinstance(shape, (shapely.Polygon, shapely.MultiPolygon))
+        if (col_min[i] == col_max[i] and row_min[i] == row_max[i]) or not polygonal:
+            tiles.setdefault((col_min[i], row_min[i]), []).append((i, geometries[i]))
+            continue
+        for col in range(col_min[i], col_max[i] + 1):
+            for row in range(row_min[i], row_max[i] + 1):
+                x, y = col * tile_size - 180, row * tile_size - 90
+                piece = _polygonal_parts(shapely.intersection(shape, shapely.box(x, y, x + tile_size, y + tile_size)))
+                if piece is not None:
+                    tiles.setdefault((col, row), []).append((i, shapely.to_wkb(piece)))
+    tasks = sorted(tiles.values(), key=len, reverse=True)
+    return [
+        (np.array([i for i, _ in pieces], dtype=np.uint64), np.array([wkb for _, wkb in pieces], dtype=object))
+        for pieces in tasks
+    ]
+
+
+def polyfill_partitioned(
+    pool: multiprocessing.pool.Pool, h3_res: int, geometries: np.ndarray, tile_size: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Converts WKB geometries to h3 partitioned in tiles across the worker pool, see `tile_partitions`
+
+    The result is the same set of (id, h3index) pairs as `polyfill()` of the whole geometries.
+    """
+    results = pool.starmap(
+        partial(polyfill, h3_res), [(wkb, ids) for ids, wkb in tile_partitions(geometries, tile_size)]
+    )
+    ids = np.concatenate([np.empty(0, dtype=np.uint64)] + [ids for ids, _ in results])
+    h3indexes = np.concatenate([np.empty(0, dtype=np.uint64)] + [h3indexes for _, h3indexes in results])
+    # a centroid right on a tile edge could be claimed by the pieces at both sides
+    order = np.lexsort((h3indexes, ids))
+    ids, h3indexes = ids[order], h3indexes[order]
+    unique = np.r_[True, (ids[1:] != ids[:-1]) | (h3indexes[1:] != h3indexes[:-1])]
+    return ids[unique], h3indexes[unique]
+
+
+def _init_polyfill_worker():
+    # one h3ronpy thread per worker process, the pool already uses the cores
+    os.environ["RAYON_NUM_THREADS"] = "1"
+
 
+def vector_source_to_h3(
+    source: VectorSource,
+    columns: List[str],
+    h3_res: int = 6,
+    batch_size: int = 10_000,
+    pool: Optional[multiprocessing.pool.Pool] = None,
+    tile_size: float = 10,
+    coverage: bool = False,
+    bbox: Optional[BBox] = None,
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray], Optional[np.ndarray]]:
+    """Converts the features of a vector file layer to H3 and returns the h3index, fid and column values of each cell
+
+    With coverage the cells touching each feature are returned together with the fraction of them covered by the
+    feature, computed while the geometries of the batch are at hand, see `coverage_candidates` and `cell_coverage`.
 
-def records(filename: str, usecols: List[str], **kwargs):
-    """Generator to yield subset of columns from vector file"""
-    with fiona.open(filename, **kwargs) as source:
-        for feature in source:
-            f = {k: feature[k] for k in ["id", "geometry"]}
-            f["properties"] = {k: feature["properties"][k] for k in usecols}
-            yield f
+    The file is streamed in batches of features, see `vector_batches`, and the WKB geometries of each batch are
+    converted to H3 straight away, so only one batch of geometries is held in memory and no per-feature python
+    objects are built. Only the h3index, fid and value arrays of each batch are kept.
+    The geometries are converted once and the resulting cells are shared by all the columns.
+    With a pool the geometries are split in tiles converted in parallel, see `polyfill_partitioned`.
+    """
+    filename, layer = source
+    log.info(f"Reading {sources_name([source])} and converting geometry to H3...")
+    h3index_chunks, fid_chunks = [np.empty(0, dtype=np.uint64)], [np.empty(0, dtype=np.int64)]
+    coverage_chunks = [np.empty(0, dtype=np.float64)]
+    value_chunks = {column: [] for column in columns}
+    for batch_fids, geometries, batch_values in vector_batches(source, columns, batch_size, bbox):
+        features = shapely.from_wkb(geometries) if coverage else None
+        if coverage:
+            geometries = coverage_candidates(features, h3_res)
+        if pool is None:
+            ids, h3indexes = polyfill(h3_res, geometries, np.arange(len(geometries), dtype=np.uint64))
+        else:
+            ids, h3indexes = polyfill_partitioned(pool, h3_res, geometries, tile_size)
+        h3index_chunks.append(h3indexes)
+        fid_chunks.append(batch_fids[ids])
+        if coverage:
+            coverage_chunks.append(cell_coverage(features[ids], h3indexes))
+        for column in columns:
+            value_chunks[column].append(batch_values[column][ids])
+    values = {
+        column: np.concatenate(chunks) if chunks else np.empty(0, dtype=np.float64)
+        for column, chunks in value_chunks.items()
+    }
+    coverages = np.concatenate(coverage_chunks) if coverage else None
+    return np.concatenate(h3index_chunks), np.concatenate(fid_chunks), values, coverages
+
+
+def vector_sources_to_h3dataframes(
+    sources: List[VectorSource],
+    columns: List[str],
+    h3_res: int = 6,
+    batch_size: int = 10_000,
+    duplicates: str = "error",
+    thread_count: int = 1,
+    tile_size: float = 10,
+    coverage: bool = False,
+    bbox: Optional[BBox] = None,
+) -> Dict[str, Union[pd.DataFrame, None]]:
+    """Converts columns of one or more vector files or layers to h3 dataframes with uint64 h3index, one for each column
+
+    With more than one thread a single source is split in tiles converted in parallel, and several sources are
+    converted concurrently, one per worker, see `vector_source_to_h3`.
+    The cells of all the sources are merged and the h3 indexes produced by more than one feature, from the same or
+    from different sources, are resolved with the duplicates policy for each column, see `resolve_duplicated_h3`.
+    With coverage every cell touched by the features gets their values weighted by the fraction of the cell they
+    cover instead, see `coverage_weighted_h3`, and the duplicates policy is not used.
+    With a bbox only the features intersecting it are converted.
+    """
+    pool = POLYFILL_POOL_CONTEXT.Pool(thread_count, initializer=_init_polyfill_worker) if thread_count > 1 else None
+    try:
+        if len(sources) == 1:
+            results = [vector_source_to_h3(sources[0], columns, h3_res, batch_size, pool, tile_size, coverage, bbox)]
+        elif pool is not None:
+            convert = partial(
+                vector_source_to_h3,
+                columns=columns,
+                h3_res=h3_res,
+                batch_size=batch_size,
+                coverage=coverage,
+                bbox=bbox,
+            )
+            results = pool.map(convert, sources, chunksize=1)
+        else:
+            results = [
+                vector_source_to_h3(source, columns, h3_res, batch_size, coverage=coverage, bbox=bbox)
+                for source in sources
+            ]
+    finally:
+        if pool is not None:
+            pool.terminate()
+    h3index = pd.Index(np.concatenate([h3indexes for h3indexes, _, _, _ in results]), name="h3index")
+    if h3index.empty:
+        return dict.fromkeys(columns)
+    fids = np.concatenate([source_fids for _, source_fids, _, _ in results])
+    source_ids = np.repeat(np.arange(len(sources)), [len(h3indexes) for h3indexes, _, _, _ in results])
+    coverages = np.concatenate([source_coverages for _, _, _, source_coverages in results]) if coverage else None
+    h3dfs = {}
+    for column in columns:
+        # sources without features don't have the dtype of the column
+        values = [source_values[column] for _, _, source_values, _ in results if len(source_values[column])]
+        h3df = pd.DataFrame({column: np.concatenate(values)}, index=h3index, copy=False)
+        if coverage:
+            h3df = coverage_weighted_h3(h3df, coverages)
+        else:
+            h3df = resolve_duplicated_h3(h3df, fids, duplicates, sources, source_ids)
+        # slugify column name to be ColumnName as everywhere else
+        h3dfs[column] = h3df.rename(columns={column: slugify(column)}) if not h3df.empty else None
+    return h3dfs
+
+
+def vector_file_to_h3dataframes(
+    filename: Path,
+    columns: List[str],
+    h3_res: int = 6,
+    layer: Union[str, None] = None,
+    batch_size: int = 10_000,
+    duplicates: str = "error",
+    thread_count: int = 1,
+    tile_size: float = 10,
+    coverage: bool = False,
+    bbox: Optional[BBox] = None,
+) -> Dict[str, Union[pd.DataFrame, None]]:
+    """Converts columns of a vector file to h3 dataframes, see `vector_sources_to_h3dataframes`"""
+    return vector_sources_to_h3dataframes(
+        [(filename, layer)], columns, h3_res, batch_size, duplicates, thread_count, tile_size, coverage, bbox
+    )
 
 
 def vector_file_to_h3dataframe(
@@ -85,37 +615,17 @@ def vector_file_to_h3dataframe(
     column: str,
     h3_res: int = 6,
     layer: Union[str, None] = None,
+    batch_size: int = 10_000,
+    duplicates: str = "error",
+    thread_count: int = 1,
+    tile_size: float = 10,
+    coverage: bool = False,
+    bbox: Optional[BBox] = None,
 ) -> Union[pd.DataFrame, None]:
-    """Converts a vector file to a GeoDataFrame"""
-    log.info(f"Reading {str(filename)} and converting geometry to H3...")
-    gdf = gpd.GeoDataFrame.from_features(records(filename.as_posix(), [column], layer=layer)).set_crs("EPSG:4326")
-    h3df = vector.geodataframe_to_h3(gdf, h3_res).set_index("h3index")  # type: ignore
-    # check for duplicated h3 indices since the aqueduct data set generates duplicated h3 indices
-    # we currently don't know why this happens and further investigation is needed
-    # but for now we just drop the duplicates if it is safe to do so (i.e. the dupes have the same value)
-    if h3df.index.duplicated().any():
-        log.warning(f"Duplicated H3 indexes found in {filename}. Checking if it safe to drop...")
-        dupes_mask = h3df.index.duplicated(keep="first")
-        dupe_idx = h3df.index[dupes_mask]
-        # check that the duplicated values are the same and drop them if they are
-        # if not, raise an error and stop ingestion to encourage manual data validation check
-        for idx in dupe_idx:
-            values = h3df.loc[idx]
-            if any(values[col].is_unique for col in values.columns):
-                log.error(
-                    f"Duplicated H3 index {idx} found in {filename} with different values."
-                    " Data ingestion will stop. Please check the data."
-                )
-                raise ValueError(f"Duplicated H3 index {idx} found in {filename} with different values.")
-        h3df = h3df[~dupes_mask]  # drop the duplicates
-        log.info(f"Dropped {len(dupe_idx)} duplicated H3 indexes")
-
-    if not h3df.empty:
-        # we want h3index as hex, do we?
-        h3df.index = pd.Series(h3df.index).apply(lambda x: hex(x))
-        # slugify column name to be ColumnName as everywhere else
-        h3df = h3df.rename(columns={column: slugify(column)})
-        return h3df
+    """Converts a column of a vector file to a h3 dataframe with uint64 h3index, see `vector_file_to_h3dataframes`"""
+    return vector_file_to_h3dataframes(
+        filename, [column], h3_res, layer, batch_size, duplicates, thread_count, tile_size, coverage, bbox
+    )[column]
 
 
 def create_h3_grid_table(
@@ -130,7 +640,10 @@ def create_h3_grid_table(
     if drop_if_exists:
         cursor.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(sql.Identifier(table_name)))
         log.info(f"Dropped table {table_name}")
-    cursor.execute(sql.SQL("CREATE TABLE {} ({})").format(sql.Identifier(table_name), h3_table_schema(df)))
+    # the primary key is built after the data is copied with index_and_analyze_h3_grid_table
+    cursor.execute(
+        sql.SQL("CREATE TABLE {} ({})").format(sql.Identifier(table_name), h3_table_schema(df, primary_key=False))
+    )
     log.info(f"Created table {table_name} with columns {', '.join(dtypes.keys())}")
     conn.commit()
     cursor.close()
@@ -146,6 +659,8 @@ def insert_to_h3_grid_table(
     log.info(f"Preparing {len(df)} rows buffer...")
 
     with StringIO() as buffer:  # why are we using this?
+        # we want h3index as hex, do we?
+        df = df.set_axis(df.index.map(hex))
         df.to_csv(buffer, na_rep="NULL", header=False, sep="\t")  # use tabs because fields with commas
         buffer.seek(0)
         cursor.copy_from(buffer, table_name, sep="\t", null="NULL")
@@ -155,6 +670,49 @@ def insert_to_h3_grid_table(
     log.info(f"{len(df)} values written to database.")
 
 
+def write_h3_pyramid(table: str, df: pd.DataFrame, h3_res: int, year: int, conn: connection):
+    """Store the data aggregated to every coarser resolution (see `h3_pyramid`) and register the tables in h3_data"""
+    agg_type = layer_agg_type(table)
+    resolutions = list(range(1, h3_res))
+    for resolution, pyramid_df in h3_pyramid(df, resolutions, agg_type):
+        pyramid_table = pyramid_table_name(table, resolution)
+        create_h3_grid_table(pyramid_table, pyramid_df, conn)
+        insert_to_h3_grid_table(pyramid_table, pyramid_df, conn)
+        index_and_analyze_h3_grid_table(conn, pyramid_table)
+    with conn.cursor() as cursor:
+        register_pyramid_tables(cursor, table, df.columns.tolist(), resolutions, year)
+    conn.commit()
+
+
+def write_h3_output(
+    conn: connection,
+    df: pd.DataFrame,
+    table: str,
+    column: str,
+    dataset: str,
+    category: str,
+    year: int,
+    h3_res: int,
+    indicator_code: Optional[str],
+    pyramid: bool = False,
+):
+    """Loads the h3 dataframe of a column to its table and registers it as contextual layer and/or indicator"""
+    with timed(f"Creating table {table}"):
+        create_h3_grid_table(table, df, conn)
+    with timed(f"Copying data to {table}"):
+        insert_to_h3_grid_table(table, df, conn)
+    index_and_analyze_h3_grid_table(conn, table)
+    # slugify the column name to follow the convention of db column naming
+    column = slugify(column)
+    with timed(f"Updating metadata of {table}"):
+        insert_to_h3_data_and_contextual_layer_tables(table, column, h3_res, dataset, category, year, conn)
+    if pyramid:
+        with timed(f"Building resolution pyramid of {table}"):
+            write_h3_pyramid(table, df, h3_res, year, conn)
+    if indicator_code:  # if given, consider layer as indicator update h3_table
+        link_to_indicator_table(conn, indicator_code, table, column)
+
+
 def main(
     folder: str,
     table: str,
@@ -164,40 +722,67 @@ def main(
     year: int,
     h3_res: int,
     indicator_code: str,
-    layer: str,
+    layers: Union[List[str], str, None],
+    pyramid: bool = False,
+    batch_size: int = 10_000,
+    duplicates: str = "error",
+    thread_count: int = 1,
+    tile_size: float = 10,
+    extra_outputs: Optional[List[Tuple[str, str, str, Optional[str]]]] = None,
+    coverage: bool = False,
+    bbox: Optional[BBox] = None,
 ):
-    """Vector file to h3 table utility"""
-    vec_extensions = "gdb gpkg shp json geojson".split()
+    """Vector file to h3 table utility
+
+    Every vector file of the folder, or the given layers of each of them, is converted and merged into the same
+    tables. extra_outputs are (table, column, dataset, indicator_code) of other columns of the same files, all of them
+    are converted in a single pass over the geometries.
+    """
     path = Path(folder)
     vectors = []
-    for ext in vec_extensions:
+    for ext in VECTOR_EXTENSIONS:
         vectors.extend(path.glob(f"*.{ext}"))
     if not vectors:
-        log.error(f"No vectors with extension {vec_extensions} found in {folder}")
+        log.error(f"No vectors with extension {VECTOR_EXTENSIONS} found in {folder}")
         return
+    if isinstance(layers, str):
+        layers = [layers]
+    # sorted so the sources, and the features kept by the "first" duplicates policy, don't depend on the file system
+    sources = [
+        (vector, layer)
+        for vector in sorted(vectors)
+        for layer in ([None] if is_geoparquet(vector) else layers or [None])
+    ]
+    log.info(f"Found {len(sources)} vector sources in {folder}")
 
+    outputs = [(table, column, dataset, indicator_code)] + (extra_outputs or [])
+    columns = list(dict.fromkeys(out_column for _, out_column, _, _ in outputs))
+    dfs = vector_sources_to_h3dataframes(
+        sources, columns, h3_res, batch_size, duplicates, thread_count, tile_size, coverage, bbox
+    )
+    postgres_thread_pool = ThreadedConnectionPool(
+        1,
+        50,
+        host=os.getenv("API_POSTGRES_HOST"),
+        port=os.getenv("API_POSTGRES_PORT"),
+        user=os.getenv("API_POSTGRES_USERNAME"),
+        password=os.getenv("API_POSTGRES_PASSWORD"),
+    )
     conn = postgres_thread_pool.getconn()
-    if len(vectors) == 1:  # folder just contains one vector file
-        df = vector_file_to_h3dataframe(vectors[0], column, h3_res, layer)
-        create_h3_grid_table(table, df, conn)
-        insert_to_h3_grid_table(table, df, conn)
-        # slugify the column name to follow the convention of db column naming
-        column = slugify(column)
-        insert_to_h3_data_and_contextual_layer_tables(table, column, h3_res, dataset, category, year, conn)
-    else:
-        mssg = (
-            f"Found more than one vector file in {folder}."
-            f" For now we only support folders with just one vector file."
-        )
-        logging.error(mssg)
-        return  # gracefully exit without exception
-
-    if indicator_code:  # if given, consider layer as indicator update h3_table
-        link_to_indicator_table(conn, indicator_code, table, column)
+    for out_table, out_column, out_dataset, out_indicator in outputs:
+        df = dfs[out_column]
+        write_h3_output(conn, df, out_table, out_column, out_dataset, category, year, h3_res, out_indicator, pyramid)
 
     postgres_thread_pool.putconn(conn, close=True)
 
 
+def output_spec(values: List[str]) -> Tuple[str, str, str, Optional[str]]:
+    """Parses the TABLE COLUMN DATASET [INDICATOR] values of an --output option"""
+    if len(values) not in (3, 4):
+        raise argparse.ArgumentTypeError(f"--output takes TABLE COLUMN DATASET [INDICATOR], got {' '.join(values)}")
+    return tuple(values) if len(values) == 4 else (*values, None)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("folder", help="Folder containing vector file.")
@@ -212,8 +797,70 @@ if __name__ == "__main__":
     parser.add_argument("year", type=int, help="Year of the imported dataset")
     parser.add_argument("--indicator", help="Indicator nameCode", default=None)
     parser.add_argument("--h3-res", help="h3 resolution to use", dest="h3res", default=6, type=int)
-    parser.add_argument("--layer", help="Layer name. Only if file has multiple layers (ie, a GDB)", default=None)
+    parser.add_argument(
+        "--layer",
+        help="Layer name. Only if files have multiple layers (ie, a GDB). Can be repeated",
+        dest="layers",
+        action="append",
+        default=None,
+    )
+    parser.add_argument(
+        "--pyramid", action="store_true", help="Also store the data aggregated to every coarser resolution"
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Number of features read and converted at a time",
+        dest="batch_size",
+        default=10_000,
+        type=int,
+    )
+    parser.add_argument(
+        "--duplicates",
+        help="How to resolve h3 indexes found in more than one feature",
+        choices=DUPLICATE_POLICIES,
+        default="error",
+    )
+    parser.add_argument(
+        "--thread-count",
+        help="Number of processes converting the vector files, or tiles of the features of a single file, in parallel",
+        dest="thread_count",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--tile-size",
+        help="Size in degrees of the tiles the features are split in with --thread-count",
+        dest="tile_size",
+        default=10,
+        type=float,
+    )
+    parser.add_argument(
+        "--output",
+        help="Also convert another column of the same file in the same pass. Can be repeated",
+        dest="outputs",
+        nargs="+",
+        action="append",
+        metavar="TABLE COLUMN DATASET [INDICATOR]",
+        default=[],
+    )
+    parser.add_argument(
+        "--coverage",
+        action="store_true",
+        help="Use every cell touched by the features with their values weighted by the fraction of the cell they cover",
+    )
+    parser.add_argument(
+        "--bbox",
+        help="Only convert the features intersecting the bounding box",
+        nargs=4,
+        type=float,
+        metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+        default=None,
+    )
     args = parser.parse_args()
+    try:
+        extra_outputs = [output_spec(values) for values in args.outputs]
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
 
     raise SystemExit(
         main(
@@ -225,6 +872,14 @@ if __name__ == "__main__":
             args.year,
             args.h3res,
             args.indicator,
-            args.layer,
+            args.layers,
+            args.pyramid,
+            args.batch_size,
+            args.duplicates,
+            args.thread_count,
+            args.tile_size,
+            extra_outputs,
+            args.coverage,
+            tuple(args.bbox) if args.bbox else None,
         )
     )
@@ -0,0 +1,321 @@
+"""Batch geocoding with Nominatim, cached on disk and within its rate limit
+
+A batch of queries is normalized and de-duplicated, the queries already answered are read from a SQLite cache and only
+the others are sent to Nominatim, concurrently through an asyncio client that keeps to the request rate of the usage
+policy with a token bucket. Every answer is stored in the cache as soon as it arrives, so an interrupted batch is
+resumed where it stopped. A single search request returns both the point and the boundary polygon of a place.
+
+Geocoding a whole sourcing file first warms the cache for the row by row lookups:
+
+    results = geocode_batch(input_data['Address'] + ', ' + input_data['Country'])
+    point, features = results[0].point, results[0].features
+"""
+
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+NOMINATIM_ENDPOINT = "https://nominatim.openstreetmap.org/"
+# per the nominatim usage policy: "an absolute maximum of 1 request per second"
+NOMINATIM_RATE = 1.0
+USER_AGENT = "landgriffon-lab-geocoder"
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "landgriffon" / "geocoding.sqlite"
+# responses worth trying again after a pause: rate limited, overloaded or timed out
+RETRY_STATUSES = {429, 502, 503, 504}
+# SQLite builds before 3.32 allow at most 999 parameters per statement
+SQLITE_MAX_PARAMETERS = 999
+
+
+class GeocodeResult(NamedTuple):
+    """
+    Geocoding of a query string
+    Parameters
+    ----------
+    query : string
+        the query string as given
+    point : tuple or None
+        the (lng, lat) coordinates of the place, None if it was not found or the request failed
+    features : list
+        the place as a list with a GeoJSON feature with its boundary geometry and bbox, empty if not found
+    """
+
+    query: str
+    point: Optional[Tuple[float, float]]
+    features: List[dict]
+
+
+def normalize_query(query: str) -> str:
+    """
+    Cache key of a query string: unicode normalized, case folded and with runs of whitespace collapsed, so
+    "Spain", " spain" and "SPAIN " are the same query
+    """
+    query = unicodedata.normalize("NFKC", str(query)).casefold()
+    return re.sub(r"\s+", " ", query).strip(" ,")
+
+
+def parse_response(query: str, response_json: Optional[list]) -> GeocodeResult:
+    """
+    Extracts the point and the boundary feature of the first result of a Nominatim search response
+    """
+    if not response_json:
+        return GeocodeResult(query, None, [])
+    result = response_json[0]
+    point = (float(result["lon"]), float(result["lat"]))
+    features = []
+    if "geojson" in result:
+        bbox_south, bbox_north, bbox_west, bbox_east = [float(x) for x in result["boundingbox"]]
+        features = [
+            {
+                "type": "Feature",
+                "geometry": result["geojson"],
+                "properties": {
+                    "place_name": result.get("display_name"),
+                    "bbox_north": bbox_north,
+                    "bbox_south": bbox_south,
+                    "bbox_east": bbox_east,
+                    "bbox_west": bbox_west,
+                },
+            }
+        ]
+    return GeocodeResult(query, point, features)
+
+
+class GeocodeCache:
+    """
+    Persistent cache of Nominatim search responses keyed on the normalized query, in a SQLite file.
+    Queries without results are cached as well, failed requests are not.
+    Parameters
+    ----------
+    path : Path
+        SQLite file of the cache, created if it doesn't exist
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # used from the thread running the event loop, one thread at a time
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS geocode (query TEXT PRIMARY KEY, response TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get_many(self, queries: List[str]) -> Dict[str, list]:
+        """
+        Cached responses of the normalized queries, the queries not in the cache are left out
+        """
+        responses = {}
+        for start in range(0, len(queries), SQLITE_MAX_PARAMETERS):
+            chunk = queries[start : start + SQLITE_MAX_PARAMETERS]
+            rows = self.connection.execute(
+                f"SELECT query, response FROM geocode WHERE query IN ({','.join('?' * len(chunk))})", chunk
+            )
+            responses.update((query, json.loads(response)) for query, response in rows)
+        return responses
+
+    def put(self, query: str, response: list):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO geocode (query, response, updated) VALUES (?, ?, ?)",
+            (query, json.dumps(response), time.time()),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TokenBucket:
+    """
+    Rate limiter letting through `rate` requests per second on average and bursts of up to `capacity` requests.
+    Waiters are served in order.
+    """
+
+    def __init__(self, rate: float = NOMINATIM_RATE, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = None
+        self._lock = None
+
+    async def acquire(self):
+        # created on first use, bound to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NominatimClient:
+    """
+    Asyncio Nominatim search client with pooled keep-alive connections and a token bucket rate limit.
+    Used as an async context manager, the connections are closed on exit.
+    Parameters
+    ----------
+    endpoint : string
+        Nominatim API endpoint
+    rate : float
+        maximum average number of requests per second
+    burst : int
+        maximum number of requests sent at once after an idle period
+    max_connections : int
+        maximum number of concurrent connections
+    retries : int
+        number of times a rate limited or failed request is tried again
+    error_pause : float
+        how long to pause in seconds before re-trying a request if the response has no Retry-After
+    timeout : float
+        timeout of each request in seconds
+    key : string
+        API key, if you are using a commercial endpoint that requires it
+    """
+
+    def __init__(
+        self,
+        endpoint=NOMINATIM_ENDPOINT,
+        rate=NOMINATIM_RATE,
+        burst=1,
+        max_connections=2,
+        retries=3,
+        error_pause=60,
+        timeout=180,
+        key=None,
+        user_agent=USER_AGENT,
+    ):
+        self.url = endpoint.rstrip("/") + "/search"
+        self.bucket = TokenBucket(rate, burst)
+        self.max_connections = max_connections
+        self.retries = retries
+        self.error_pause = error_pause
+        self.timeout = timeout
+        self.key = key
+        self.user_agent = user_agent
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"User-Agent": self.user_agent},
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def search(self, query: str) -> list:
+        """
+        Nominatim search response of the first result of the query, with its boundary geometry
+        """
+        params = {"format": "json", "limit": 1, "dedupe": 0, "polygon_geojson": 1, "q": query}
+        if self.key:
+            params["key"] = self.key
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            async with self.session.get(self.url, params=params) as response:
+                if response.status in RETRY_STATUSES and attempt < self.retries:
+                    retry_after = response.headers.get("Retry-After", "")
+                    pause = float(retry_after) if retry_after.isdigit() else self.error_pause
+                    log.warning(f'Response returned {response.status} for "{query}", retrying in {pause} seconds')
+                    await asyncio.sleep(pause)
+                    continue
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+
+async def geocode_batch_async(
+    queries: Iterable[str], cache: GeocodeCache, client: Optional[NominatimClient] = None
+) -> List[GeocodeResult]:
+    """
+    Geocodes a batch of query strings, each distinct query is looked up in the cache or requested only once
+    Parameters
+    ----------
+    queries : iterable of strings
+        the query strings to geocode
+    cache : GeocodeCache
+        cache of the responses, updated with every new one
+    client : NominatimClient
+        client of the requests, not entered yet. A client with the default options if not given
+    Returns
+    -------
+    results : list of GeocodeResult
+        the result of each query, in the same order
+    """
+    queries = list(queries)
+    keys = [normalize_query(query) for query in queries]
+    unique_keys = list(dict.fromkeys(key for key in keys if key))
+    responses = cache.get_many(unique_keys)
+    missing = [key for key in unique_keys if key not in responses]
+    log.info(f"{len(queries)} queries, {len(unique_keys)} distinct, {len(missing)} not cached")
+
+    if missing:
+
+        async def fetch(session, key):
+            try:
+                responses[key] = await session.search(key)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                log.error(f'Geocoding "{key}" failed: {error!r}')
+                return
+            cache.put(key, responses[key])
+
+        async with client or NominatimClient() as session:
+            await asyncio.gather(*(fetch(session, key) for key in missing))
+    return [parse_response(query, responses.get(key)) for query, key in zip(queries, keys)]
+
+
+def run(coroutine):
+    """
+    asyncio.run, also from a notebook where an event loop is already running: then in a thread of its own
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def geocode_batch(queries: Iterable[str], cache_path=DEFAULT_CACHE_PATH, **client_options) -> List[GeocodeResult]:
+    """
+    Geocodes a batch of query strings with the cache in cache_path, see `geocode_batch_async`
+    Parameters
+    ----------
+    queries : iterable of strings
+        the query strings to geocode
+    cache_path : Path
+        SQLite file of the cache
+    client_options :
+        options of the NominatimClient, i.e. endpoint or rate
+    Returns
+    -------
+    results : list of GeocodeResult
+        the result of each query, in the same order
+    """
+    with GeocodeCache(cache_path) as cache:
+        return run(geocode_batch_async(queries, cache, NominatimClient(**client_options)))
@@ -1,47 +1,66 @@
-
-from .utils import geocode, _osm_polygon_request
+from .geocoding import geocode_batch
 
 
 class GeolocateAddress:
     """
     Geocode a query string to (lat, lng) with the Nominatim geocoder
+    The point and the boundary polygon come from a single cached request, see `geocoding.geocode_batch`.
     Parameters
     -----------
     query: string
-        the query string to geocode    
+        the query string to geocode
+    result: GeocodeResult
+        the result of the query if it was already geocoded, see `GeolocateAddress.batch`
     Return
     -----------
     point: tuple
         the (lat, lng) coordinates returned by the geocoder
     """
 
-    def __init__(self, query=''):
+    def __init__(self, query="", result=None):
         self.geojson = None
         self.query = query
+        self.result = result if result is not None else geocode_batch([query])[0]
         self.point = self.get_point()
         self.polygon_json = self.get_feature_json()
 
+    @classmethod
+    def batch(cls, queries, **options):
+        """
+        Geolocates many query strings at once, each distinct query is requested only once
+        Parameters
+        -----------
+        queries: iterable of strings
+            the query strings to geocode
+        options:
+            options of `geocoding.geocode_batch`, i.e. cache_path or endpoint
+        Returns
+        -----------
+        geolocations: list
+            a GeolocateAddress for each query, None for the queries that could not be geocoded
+        """
+        return [
+            cls(query=result.query, result=result) if result.point is not None else None
+            for result in geocode_batch(queries, **options)
+        ]
+
     def get_point(self):
         """
         Geocode a query string to (lat, lng) with the Nominatim geocoder
         Parameters
         -----------
         query: string
-            the query string to geocode    
+            the query string to geocode
         Return
         -----------
         point: tuple
             the (lat, lng) coordinates returned by the geocoder
         """
-        point = geocode(query=self.query)
-        self.geojson = {
-            "type": "Feature",
-            "properties": {},
-            "geometry": {
-                    "type": "Point",
-                    "coordinates": list(point)
-            }
-        }
+        point = self.result.point
+        if point is None:
+            raise ValueError(f'Nominatim could not geocode query "{self.query}"')
+        print(f'Geocoded "{self.query}" to {point}')
+        self.geojson = {"type": "Feature", "properties": {}, "geometry": {"type": "Point", "coordinates": list(point)}}
         return point
 
     def get_feature_json(self):
@@ -53,6 +72,4 @@ class GeolocateAddress:
         -----------
 
         """
-        feature = _osm_polygon_request(
-            query=self.query, limit=1, polygon_geojson=1)
-        return feature
+        return self.result.features
@@ -0,0 +1,251 @@
+"""Offline lookup of the H3 cell and the admin regions of points, from a snapshot of the geo_region table
+
+The index is built from the h3Flat cells of the GADM level 0, 1 and 2 regions, as written by
+`preprocessing/gadm/gadm_h3.py` to a .parquet file or exported from a database with `export_snapshot`. For each level
+it keeps a sorted uint64 cell array and the position of the region of each cell, so the regions of a batch of points
+are found by converting the points to cells and a binary search per level, without any network call.
+The index is stored as an Arrow IPC file and memory-mapped back, see `write_index` and `read_index`.
+
+    index = load_index('geo_region.parquet', 'geo_region_index.arrow')
+    regions = lookup_points(index, df['lat'], df['lng'])
+"""
+
+import json
+import logging
+import os
+import warnings
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+with warnings.catch_warnings():
+    # the vectorized functions live in the unstable module of h3 3.x
+    warnings.simplefilter("ignore")
+    from h3.unstable import vect
+
+log = logging.getLogger(__name__)
+
+ADMIN_LEVELS = [0, 1, 2]
+
+# GADM level 0-2 regions and their cells, the level is taken from the admin_region of the region
+SNAPSHOT_QUERY = """
+    SELECT gr.id::text, gr.name, ar.level, gr."h3Flat"
+    FROM geo_region gr
+    INNER JOIN admin_region ar ON ar."geoRegionId" = gr.id
+    WHERE ar.level IN (0, 1, 2) AND gr."h3Flat" IS NOT NULL
+    ORDER BY ar.level, gr.name
+"""
+
+
+class RegionIndex(NamedTuple):
+    """
+    Cells of the regions of every admin level
+    Parameters
+    ----------
+    region_ids : list
+        geo_region id of each region
+    names : list
+        GADM id of each region (geo_region.name)
+    offsets : np.ndarray
+        cells[offsets[level]:offsets[level + 1]] are the sorted cells of the regions of the level
+    cells : np.ndarray
+        uint64 cells of every level
+    regions : np.ndarray
+        position in region_ids of the region of each cell
+    resolution : int
+        H3 resolution of the cells
+    """
+
+    region_ids: List[str]
+    names: List[str]
+    offsets: np.ndarray
+    cells: np.ndarray
+    regions: np.ndarray
+    resolution: int
+
+    def level(self, level: int):
+        start, end = self.offsets[level], self.offsets[level + 1]
+        return self.cells[start:end], self.regions[start:end]
+
+
+def gadm_level(name: str) -> int:
+    """
+    Admin level of a GADM id, the number of parts of the id after the country: "ESP", "ESP.1_1", "ESP.1.2_1"
+    """
+    return name.count(".")
+
+
+def export_snapshot(conn, path):
+    """
+    Writes the cells of the level 0-2 regions of geo_region to a parquet snapshot, with the same columns as the output
+    of `preprocessing/gadm/gadm_h3.py` and the level of each region
+    Parameters
+    ----------
+    conn : psycopg2 connection
+        connection to the database with the geo_region and admin_region tables
+    path : Path
+        the parquet file to write
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(SNAPSHOT_QUERY)
+        rows = cursor.fetchall()
+    lengths = np.array([len(flat) for *_, flat in rows], dtype=np.int64)
+    cells = np.fromiter((int(cell, 16) for *_, flat in rows for cell in flat), dtype=np.uint64, count=lengths.sum())
+    table = pa.table(
+        {
+            "id": [region_id for region_id, *_ in rows],
+            "name": [name for _, name, *_ in rows],
+            "level": pa.array([level for _, _, level, _ in rows], type=pa.int8()),
+            "h3Flat": pa.ListArray.from_arrays(
+                pa.array(np.r_[0, np.cumsum(lengths)].astype(np.int32)), pa.array(cells)
+            ),
+        }
+    )
+    pq.write_table(table, Path(path).as_posix(), compression="zstd")
+    log.info(f"Exported {len(rows)} regions with {len(cells)} cells to {path}")
+
+
+def build_index(snapshot) -> RegionIndex:
+    """
+    Builds the index from a geo_region parquet snapshot with id, name, h3Flat (list<uint64>) and optionally level
+    columns. A cell claimed by more than one region of the same level is kept for the first of them.
+    """
+    table = pq.read_table(Path(snapshot).as_posix())
+    region_ids = [str(region_id) for region_id in table.column("id").to_pylist()]
+    names = table.column("name").to_pylist()
+    if "level" in table.column_names:
+        levels = np.array(table.column("level").to_pylist(), dtype=np.int64)
+    else:
+        levels = np.array([gadm_level(name) for name in names], dtype=np.int64)
+    flat = table.column("h3Flat").combine_chunks()
+    lengths = flat.value_lengths().fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+    all_cells = flat.flatten().to_numpy(zero_copy_only=False).astype(np.uint64, copy=False)
+    all_regions = np.repeat(np.arange(len(names), dtype=np.int32), lengths)
+    cell_levels = np.repeat(levels, lengths)
+    resolution = int(vect.h3_get_resolution(all_cells[:1])[0]) if len(all_cells) else 6
+
+    cells, regions, offsets = [], [], [0]
+    for level in ADMIN_LEVELS:
+        level_rows = np.flatnonzero(cell_levels == level)
+        order = np.argsort(all_cells[level_rows], kind="stable")
+        level_cells, level_regions = all_cells[level_rows][order], all_regions[level_rows][order]
+        unique = np.ones(len(level_cells), dtype=bool)
+        unique[1:] = level_cells[1:] != level_cells[:-1]
+        if not unique.all():
+            log.warning(f"{(~unique).sum()} cells of level {level} are in more than one region")
+        cells.append(level_cells[unique])
+        regions.append(level_regions[unique])
+        offsets.append(offsets[-1] + unique.sum())
+    return RegionIndex(
+        region_ids, names, np.array(offsets, dtype=np.int64), np.concatenate(cells), np.concatenate(regions), resolution
+    )
+
+
+def write_index(index: RegionIndex, path):
+    """
+    Writes the index to an Arrow IPC file, through a temporary name so readers never see a half written file
+    """
+    path = Path(path)
+    metadata = {
+        "region_ids": json.dumps(index.region_ids),
+        "names": json.dumps(index.names),
+        "offsets": json.dumps(index.offsets.tolist()),
+        "resolution": str(index.resolution),
+    }
+    table = pa.table({"h3index": index.cells, "region": index.regions}).replace_schema_metadata(metadata)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with pa.OSFile(tmp_path.as_posix(), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def _column_to_numpy(table: pa.Table, name: str) -> np.ndarray:
+    column = table.column(name)
+    return (column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()).to_numpy()
+
+
+def read_index(path) -> RegionIndex:
+    """
+    Memory-maps an index written by `write_index`, the cell arrays are read-only views of the mapped file
+    """
+    with pa.memory_map(Path(path).as_posix()) as source:
+        table = pa.ipc.open_file(source).read_all()
+    metadata = table.schema.metadata
+    return RegionIndex(
+        json.loads(metadata[b"region_ids"]),
+        json.loads(metadata[b"names"]),
+        np.array(json.loads(metadata[b"offsets"]), dtype=np.int64),
+        _column_to_numpy(table, "h3index"),
+        _column_to_numpy(table, "region"),
+        int(metadata[b"resolution"]),
+    )
+
+
+def load_index(snapshot, path, refresh: bool = False) -> RegionIndex:
+    """
+    Index stored in path, built from the snapshot first if it doesn't exist, is older than the snapshot or refresh
+    """
+    path = Path(path)
+    if refresh or not path.exists() or path.stat().st_mtime < Path(snapshot).stat().st_mtime:
+        log.info(f"Building region index from {snapshot}...")
+        write_index(build_index(snapshot), path)
+    return read_index(path)
+
+
+def lookup_cells(index: RegionIndex, cells: np.ndarray, level: int, order: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Position in index.region_ids of the region of the level containing each cell, -1 for cells outside every region.
+    The cells are searched in sorted order, given by order (np.argsort(cells)) or sorted here: the binary searches of
+    consecutive sorted cells touch the same pages of the index, instead of a random page of it for every cell.
+    """
+    regions = np.full(len(cells), -1, dtype=np.int32)
+    level_cells, level_regions = index.level(level)
+    if not len(level_cells):
+        return regions
+    if order is None:
+        order = np.argsort(cells)
+    sorted_cells = cells[order]
+    positions = np.minimum(np.searchsorted(level_cells, sorted_cells), len(level_cells) - 1)
+    found = level_cells[positions] == sorted_cells
+    regions[order[found]] = level_regions[positions[found]]
+    return regions
+
+
+def lookup_points(index: RegionIndex, lat, lng, levels: Optional[List[int]] = None) -> pd.DataFrame:
+    """
+    H3 cell and admin regions of a batch of points
+    Parameters
+    ----------
+    index : RegionIndex
+        the region index, see `load_index`
+    lat, lng : array-like
+        coordinates of the points in degrees
+    levels : list
+        the admin levels to look up, all by default
+    Returns
+    -------
+    regions : pd.DataFrame
+        a row for each point with its uint64 h3index (0 for invalid coordinates) and, for each level, the GADM id
+        (gadm_id_<level>) and the geo_region id (geo_region_id_<level>) of its region as categoricals, missing for
+        points outside every region
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    valid = np.isfinite(lat) & np.isfinite(lng) & (np.abs(lat) <= 90)
+    cells = np.zeros(len(lat), dtype=np.uint64)
+    cells[valid] = vect.geo_to_h3(lat[valid], lng[valid], index.resolution)
+
+    names, region_ids = pd.CategoricalDtype(index.names), pd.CategoricalDtype(index.region_ids)
+    columns = {"h3index": cells}
+    order = np.argsort(cells)
+    for level in ADMIN_LEVELS if levels is None else levels:
+        regions = lookup_cells(index, cells, level, order)
+        columns[f"gadm_id_{level}"] = pd.Categorical.from_codes(regions, dtype=names)
+        columns[f"geo_region_id_{level}"] = pd.Categorical.from_codes(regions, dtype=region_ids)
+    return pd.DataFrame(columns)
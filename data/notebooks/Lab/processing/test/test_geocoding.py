@@ -0,0 +1,177 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from processing.geocoding import GeocodeCache, TokenBucket, geocode_batch, normalize_query  # noqa: E402
+from processing.geolocating_data import GeolocateAddress  # noqa: E402
+
+PLACES = {
+    "spain": {"lat": "40.0", "lon": "-4.0", "display_name": "España"},
+    "france": {"lat": "46.0", "lon": "2.0", "display_name": "France"},
+    "madrid, spain": {"lat": "40.4", "lon": "-3.7", "display_name": "Madrid, España"},
+    "lleida": {"lat": "41.6", "lon": "0.6", "display_name": "Lleida"},
+}
+
+
+def search_result(place):
+    lon, lat = float(place["lon"]), float(place["lat"])
+    return {
+        **place,
+        "boundingbox": [str(lat - 1), str(lat + 1), str(lon - 1), str(lon + 1)],
+        "geojson": {
+            "type": "Polygon",
+            "coordinates": [[[lon - 1, lat - 1], [lon + 1, lat - 1], [lon + 1, lat + 1], [lon - 1, lat - 1]]],
+        },
+    }
+
+
+class StubNominatim(BaseHTTPRequestHandler):
+    """Nominatim search stub, the responses to fail with are queued by query in the server"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests.append((time.monotonic(), params))
+        failures = self.server.failures.get(params.get("q"), [])
+        if url.path != "/search":
+            status, body = 404, []
+        elif failures:
+            status, body = failures.pop(0), {"error": "stub failure"}
+        else:
+            place = PLACES.get(params["q"])
+            status, body = 200, [search_result(place)] if place else []
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def nominatim():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubNominatim)
+    server.requests = []
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def options(nominatim, tmp_path):
+    return {
+        "endpoint": f"http://127.0.0.1:{nominatim.server_address[1]}/",
+        "cache_path": tmp_path / "geocoding.sqlite",
+        "rate": 1000,
+        "burst": 10,
+        "error_pause": 0,
+    }
+
+
+def requested_queries(server):
+    return [params["q"] for _, params in server.requests]
+
+
+def test_normalize_query():
+    assert normalize_query("  Madrid,\tSPAIN ") == "madrid, spain"
+    assert normalize_query("Ｓｐａｉｎ") == "spain"
+    assert normalize_query("Lleida, ") == "lleida"
+
+
+def test_batch_deduplicates_and_combines_point_and_polygon(nominatim, options):
+    results = geocode_batch(["Spain", " spain", "SPAIN ", "France", "Atlantis"], **options)
+
+    assert sorted(requested_queries(nominatim)) == ["atlantis", "france", "spain"]
+    assert all(params["polygon_geojson"] == "1" for _, params in nominatim.requests)
+    assert [result.query for result in results] == ["Spain", " spain", "SPAIN ", "France", "Atlantis"]
+    assert [result.point for result in results] == [(-4.0, 40.0)] * 3 + [(2.0, 46.0), None]
+    assert results[0].features[0]["geometry"]["type"] == "Polygon"
+    assert results[0].features[0]["properties"]["place_name"] == "España"
+    assert results[4].features == []
+
+
+def test_cache_persists_between_batches(nominatim, options):
+    geocode_batch(["Spain", "Atlantis"], **options)
+    results = geocode_batch(["spain", "ATLANTIS", "France"], **options)
+
+    # found and not found queries are both cached
+    assert requested_queries(nominatim) == ["spain", "atlantis", "france"]
+    assert [result.point for result in results] == [(-4.0, 40.0), None, (2.0, 46.0)]
+    with GeocodeCache(options["cache_path"]) as cache:
+        assert sorted(cache.get_many(["spain", "atlantis", "france", "lleida"])) == ["atlantis", "france", "spain"]
+
+
+def test_rate_limit(nominatim, options):
+    rate = 20
+    geocode_batch(PLACES, **{**options, "rate": rate, "burst": 1})
+
+    times = sorted(request_time for request_time, _ in nominatim.requests)
+    assert len(times) == len(PLACES)
+    # the first request goes straight away, every following one waits for a token
+    assert times[-1] - times[0] >= (len(PLACES) - 1) / rate * 0.9
+
+
+def test_token_bucket_burst():
+    async def acquire_all(bucket, count):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*(bucket.acquire() for _ in range(count)))
+        return loop.time() - start
+
+    assert asyncio.run(acquire_all(TokenBucket(rate=10, capacity=3), 3)) < 0.05
+    assert asyncio.run(acquire_all(TokenBucket(rate=10, capacity=3), 5)) >= 0.18
+
+
+def test_rate_limited_requests_are_retried(nominatim, options):
+    nominatim.failures["spain"] = [429, 503]
+    results = geocode_batch(["Spain"], **options)
+
+    assert requested_queries(nominatim) == ["spain"] * 3
+    assert results[0].point == (-4.0, 40.0)
+
+
+def test_failed_requests_are_not_cached(nominatim, options):
+    nominatim.failures["spain"] = [500]
+    results = geocode_batch(["Spain", "France"], **options)
+
+    assert [result.point for result in results] == [None, (2.0, 46.0)]
+    results = geocode_batch(["Spain", "France"], **options)
+    assert requested_queries(nominatim).count("spain") == 2
+    assert requested_queries(nominatim).count("france") == 1
+    assert results[0].point == (-4.0, 40.0)
+
+
+def test_batch_from_a_running_event_loop(nominatim, options):
+    """Notebooks run the cells within an event loop"""
+
+    async def cell():
+        return geocode_batch(["France"], **options)
+
+    assert asyncio.run(cell())[0].point == (2.0, 46.0)
+
+
+def test_geolocate_address_batch(nominatim, options):
+    geolocations = GeolocateAddress.batch(["Madrid, Spain", "madrid,  spain", "Atlantis"], **options)
+
+    assert sorted(requested_queries(nominatim)) == ["atlantis", "madrid, spain"]
+    assert geolocations[0].point == (-3.7, 40.4)
+    assert geolocations[0].geojson["geometry"] == {"type": "Point", "coordinates": [-3.7, 40.4]}
+    assert geolocations[1].polygon_json == geolocations[0].polygon_json
+    assert geolocations[0].polygon_json[0]["geometry"]["type"] == "Polygon"
+    assert geolocations[2] is None
@@ -0,0 +1,122 @@
+import sys
+from pathlib import Path
+
+import h3
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from processing.region_lookup import build_index, load_index, lookup_points, read_index, write_index  # noqa: E402
+
+RESOLUTION = 6
+
+
+def box_cells(west, south, east, north):
+    polygon = {"type": "Polygon", "coordinates": [[[west, south], [east, south], [east, north], [west, north]]]}
+    return sorted(int(cell, 16) for cell in h3.polyfill(polygon, RESOLUTION, geo_json_conformant=True))
+
+
+@pytest.fixture
+def regions():
+    """GADM like hierarchy of two countries split in states and districts, as in a geo_region snapshot"""
+    regions = {}
+    for country, west in (("AAA", 0.0), ("BBB", 4.0)):
+        regions[country] = box_cells(west, 40, west + 4, 42)
+        for state in (1, 2):
+            state_west = west + 2 * (state - 1)
+            regions[f"{country}.{state}_1"] = box_cells(state_west, 40, state_west + 2, 42)
+            for district in (1, 2):
+                south = 40 + (district - 1)
+                regions[f"{country}.{state}.{district}_1"] = box_cells(state_west, south, state_west + 2, south + 1)
+    return regions
+
+
+def write_snapshot(path, regions, with_level=False):
+    names = list(regions)
+    lengths = [len(cells) for cells in regions.values()]
+    columns = {
+        "id": [f"id-{name}" for name in names],
+        "name": names,
+        "h3Flat": pa.ListArray.from_arrays(
+            pa.array(np.r_[0, np.cumsum(lengths)].astype(np.int32)),
+            pa.array(np.concatenate([np.array(cells, dtype=np.uint64) for cells in regions.values()])),
+        ),
+    }
+    if with_level:
+        columns["level"] = pa.array([name.count(".") for name in names], type=pa.int8())
+    pq.write_table(pa.table(columns), path)
+    return path
+
+
+def expected_region(regions, cell, level):
+    matches = [name for name, cells in regions.items() if name.count(".") == level and cell in set(cells)]
+    return matches[0] if matches else None
+
+
+@pytest.mark.parametrize("with_level", [False, True])
+def test_lookup_points_matches_brute_force(tmp_path, regions, with_level):
+    index = build_index(write_snapshot(tmp_path / "geo_region.parquet", regions, with_level))
+    rng = np.random.default_rng(0)
+    lat, lng = rng.uniform(39.5, 42.5, 500), rng.uniform(-0.5, 8.5, 500)
+
+    result = lookup_points(index, lat, lng)
+
+    cells = [int(h3.geo_to_h3(y, x, RESOLUTION), 16) for y, x in zip(lat, lng)]
+    assert result["h3index"].tolist() == cells
+    for level in (0, 1, 2):
+        expected = [expected_region(regions, cell, level) for cell in cells]
+        found = result[f"gadm_id_{level}"].astype(object).where(result[f"gadm_id_{level}"].notna(), None)
+        assert found.tolist() == expected
+        assert result[f"geo_region_id_{level}"].astype(object).tolist() == [
+            f"id-{name}" if name else np.nan for name in expected
+        ]
+    assert result["gadm_id_0"].notna().any() and result["gadm_id_0"].isna().any()
+
+
+def test_invalid_coordinates(tmp_path, regions):
+    index = build_index(write_snapshot(tmp_path / "geo_region.parquet", regions))
+
+    result = lookup_points(index, [41.0, np.nan, 95.0, 41.0], [1.0, 1.0, 1.0, np.inf], levels=[2])
+
+    assert result["h3index"].tolist()[1:] == [0, 0, 0]
+    assert result["gadm_id_2"].astype(object).tolist()[0] == "AAA.1.2_1"
+    assert result["gadm_id_2"].isna().tolist() == [False, True, True, True]
+    assert list(result.columns) == ["h3index", "gadm_id_2", "geo_region_id_2"]
+
+
+def test_overlapping_cells_are_kept_for_the_first_region(tmp_path, regions):
+    overlapping = {**regions, "AAA.1.3_1": regions["AAA.1.1_1"][:10]}
+    index = build_index(write_snapshot(tmp_path / "geo_region.parquet", overlapping))
+
+    cells, _ = index.level(2)
+    assert len(cells) == len(np.unique(cells))
+    lat, lng = h3.h3_to_geo(hex(overlapping["AAA.1.3_1"][0])[2:])
+    assert lookup_points(index, [lat], [lng])["gadm_id_2"].tolist() == ["AAA.1.1_1"]
+
+
+def test_levels_without_regions(tmp_path, regions):
+    countries = {name: cells for name, cells in regions.items() if "." not in name}
+    index = build_index(write_snapshot(tmp_path / "geo_region.parquet", countries))
+
+    result = lookup_points(index, [41.0], [1.0])
+
+    assert result["gadm_id_0"].tolist() == ["AAA"]
+    assert result["gadm_id_1"].isna().all() and result["gadm_id_2"].isna().all()
+
+
+def test_index_is_memory_mapped_back(tmp_path, regions):
+    snapshot = write_snapshot(tmp_path / "geo_region.parquet", regions)
+    index = build_index(snapshot)
+    write_index(index, tmp_path / "index.arrow")
+
+    mapped = read_index(tmp_path / "index.arrow")
+
+    assert mapped.names == index.names and mapped.region_ids == index.region_ids
+    assert mapped.resolution == RESOLUTION
+    np.testing.assert_array_equal(mapped.offsets, index.offsets)
+    np.testing.assert_array_equal(mapped.cells, index.cells)
+    np.testing.assert_array_equal(mapped.regions, index.regions)
+    assert not mapped.cells.flags.writeable
+    assert load_index(snapshot, tmp_path / "index.arrow").names == index.names
@@ -4,62 +4,29 @@ import time
 # import geopandas as gpd
 from collections import OrderedDict
 
+from .geocoding import geocode_batch
+
 def _osm_polygon_request(query, limit=1, polygon_geojson=1):
     """
     Geocode a place and download its boundary geometry from OSM's Nominatim API.
+    The response is cached, see `geocoding.geocode_batch`.
     Parameters
     ----------
-    query : string or dict
-        query string or structured query dict to geocode/download
+    query : string
+        query string to geocode/download
     limit : int
-        max number of results to return
+        max number of results to return, only the first one is used
     polygon_geojson : int
-        request the boundary geometry polygon from the API, 0=no, 1=yes
+        request the boundary geometry polygon from the API, it is always requested
     Returns
     -------
-    response_json : dict
+    features : list
+        the place as a GeoJSON feature with its boundary geometry
     """
-    #define params
-    params = OrderedDict()
-    params['format'] = 'json'
-    params['limit'] = 1
-    params['dedupe'] = 0  # prevent OSM from deduping results so we get precisely 'limit' # of results
-    params['polygon_geojson'] = 1
-    params['q'] = query
-    print(f'Params:{params}')
-          
-    #prepare the nominatim request:
-    ## TODO: add default info as setting and import to utils.
-    request_type='search'
-    #pause_duration=1
-    #timeout=30
-    #error_pause_duration=180
-    nominatim_endpoint = 'https://nominatim.openstreetmap.org/'
-    url = nominatim_endpoint.rstrip('/') + '/' + request_type
-    prepared_url = requests.Request('GET', url, params=params).prepare().url
-    print(f'Preparing url: {prepared_url}')
-    
-    #make the request:
-    req = requests.get(prepared_url)
-    #print(reg.response)
-    data = req.json()
-          
-    which_result=1
-    if len(data) >= which_result:
-
-        # extract data elements from the JSON response
-        result = data[which_result - 1]
-        bbox_south, bbox_north, bbox_west, bbox_east = [float(x) for x in result['boundingbox']]
-        geometry = result['geojson']
-        place = result['display_name']
-        features = [{'type': 'Feature',
-                     'geometry': geometry,
-                     'properties': {'place_name': place,
-                                    'bbox_north': bbox_north,
-                                    'bbox_south': bbox_south,
-                                    'bbox_east': bbox_east,
-                                    'bbox_west': bbox_west}}]
-          
+    features = geocode_batch([query])[0].features
+    if not features:
+        raise ValueError(f'Nominatim could not geocode query "{query}"')
+    geometry = features[0]['geometry']
     if geometry['type'] not in ['Polygon', 'MultiPolygon']:
         print(f'OSM returned a {geometry["type"]} as the geometry')
 
@@ -147,30 +114,19 @@ def nominatim_request(params, request_type="search", pause=1, error_pause=60):
 
 def geocode(query):
     """
-    Geocode a query string to (lat, lng) with the Nominatim geocoder
+    Geocode a query string to (lng, lat) with the Nominatim geocoder.
+    The response is cached, see `geocoding.geocode_batch` to geocode many queries at once.
     Parameters
     -----------
     query: string
-        the query string to geocode    
+        the query string to geocode
     Return
     -----------
     point: tuple
-        the (lat, lng) coordinates returned by the geocoder
+        the (lng, lat) coordinates returned by the geocoder
     """
-    # define the parameters
-    params = OrderedDict()
-    params["format"] = "json"
-    params["limit"] = 1
-    params["dedupe"] = 0  # prevent deduping to get precise number of results
-    params["q"] = query
-    response_json = nominatim_request(params=params)
-    
-    # if results were returned, parse lat and lng out of the result
-    if response_json and "lat" in response_json[0] and "lon" in response_json[0]:
-        lat = float(response_json[0]["lat"])
-        lng = float(response_json[0]["lon"])
-        #point = (lat, lng)
-        point = (lng, lat)
+    point = geocode_batch([query])[0].point
+    if point is not None:
         print(f'Geocoded "{query}" to {point}')
         return point
     else:
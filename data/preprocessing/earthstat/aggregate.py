@@ -1,13 +1,14 @@
 import logging
+import sys
 from enum import Enum
 from pathlib import Path
-from time import sleep
 from typing import Annotated
 
-import numpy as np
-import rasterio as rio
 import typer
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # shared preprocessing modules
+from raster_algebra import WeightedSum, evaluate  # noqa: E402
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("aggregate")
 
@@ -48,44 +49,35 @@ def crop(filename: str) -> str:
     return filename.split("_")[3]
 
 
-def aggregate(data_dir: Path, proportions: dict[str, float], harvest_or_prod: HarvestOrProd) -> str:
-    """Aggregate rasters that in files that are present in proportions map with the corresponding proportion
+def aggregation(data_dir: Path, proportions: dict[str, float], harvest_or_prod: HarvestOrProd) -> WeightedSum:
+    """Aggregation of the rasters in files that are present in proportions map with the corresponding proportion
     into one raster.
     """
-    files = list(data_dir.glob("*.tif"))
-    components = [(f, proportions[crop(f.stem)]) for f in files if crop(f.stem) in proportions.keys()]
-    for i, (file, proportion) in enumerate(components):
-        if i == 0:
-            with rio.open(file) as ref:
-                ref_meta = ref.meta.copy()
-                data = ref.read(1, masked=True) * proportion
-        else:
-            with rio.open(file) as src:
-                data += src.read(1, masked=True) * proportion
+    files = sorted(data_dir.glob("*.tif"))
+    components = {f: proportions[crop(f.stem)] for f in files if crop(f.stem) in proportions.keys()}
 
     unit = "ha" if harvest_or_prod == "harvest" else "t"
     outfile = (
         data_dir
         / f"earthstat_global_{harvest_or_prod.name}_{''.join(f.title() for f in proportions.keys())}_{unit}.tif"
     )
-
-    with rio.open(outfile, "w", **ref_meta) as dest:
-        dest.write(np.round(data, 5), 1)
-
-    return outfile.as_posix()
+    return WeightedSum(outfile, components, nodata="mask", decimals=5)
 
 
 def main(
     data_dir: Annotated[Path, typer.Argument],
     harvest_or_prod: Annotated[HarvestOrProd, typer.Argument(case_sensitive=False)],
+    thread_count: Annotated[int, typer.Option(help="Number of processes computing bands of rows")] = 1,
 ) -> None:
     if len(list(data_dir.glob("*.tif"))) == 0:
         raise typer.BadParameter(f"Directory {data_dir} does not contain any tif files.")
-    sleep(10)
-    gras_silage_filename = aggregate(data_dir, GRAS_SILAGE_COMPONENTS, harvest_or_prod)
-    others_filename = aggregate(data_dir, OTHER_CONCENTRATES_COMPONENTS, harvest_or_prod)
-    log.info(f"Created {gras_silage_filename}")
-    log.info(f"Created {others_filename}")
+    # both aggregations in a single pass, the rasters they share (oilseedfor) are read once
+    aggregations = [
+        aggregation(data_dir, GRAS_SILAGE_COMPONENTS, harvest_or_prod),
+        aggregation(data_dir, OTHER_CONCENTRATES_COMPONENTS, harvest_or_prod),
+    ]
+    for filename in evaluate(aggregations, thread_count):
+        log.info(f"Created {filename.as_posix()}")
 
 
 if __name__ == "__main__":
@@ -1,10 +1,13 @@
 import os
+import sys
 from pathlib import Path
+from typing import Optional
 
 import click
-import numpy as np
 import psycopg
-import rasterio as rio
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # shared preprocessing modules
+from raster_algebra import WeightedSum, evaluate  # noqa: E402
 
 
 def get_spam_aggregations() -> list[list[str]]:
@@ -35,32 +38,29 @@ def make_ghg_filename(spam_id: str):
     return f"{spam_id.upper()}_per_t_production.tif"
 
 
-def aggregate_ghg_rasters(spam_aggregations: list[str], data_dir: Path):
+def ghg_aggregation(spam_aggregations: list[str], data_dir: Path) -> Optional[WeightedSum]:
+    """Sum (ignoring NaN) of the GHG rasters of the spam ids of an aggregation, None if any of them is missing"""
     fnames = [data_dir / make_ghg_filename(spam_id) for spam_id in spam_aggregations]
-    rasters = []
     for file in fnames:
         if not file.exists():
             click.echo(
                 f" ERROR: File {file} does not exist. Aggregation {spam_aggregations} will be incomplete.", nl=True
             )
-            return
-
-        with rio.open(file) as src:
-            rasters.append(src.read(1))
-            profile = src.profile  # should be the same for all rasters
+            return None
 
     outfile = make_ghg_filename("".join(spam_aggregations))
-    with rio.open(data_dir / outfile, "w", **profile) as dst:
-        dst.write(np.nansum(rasters, 0)[np.newaxis, :])
+    return WeightedSum(data_dir / outfile, dict.fromkeys(fnames, 1), nodata="nansum")
 
 
 @click.command()
 @click.argument("data-dir", type=click.Path(exists=True, path_type=Path))
-def main(data_dir: Path):
+@click.option("--thread-count", "thread_count", type=int, default=1, help="Number of processes computing bands of rows")
+def main(data_dir: Path, thread_count: int):
     spam_aggregations = get_spam_aggregations()
-    with click.progressbar(spam_aggregations, show_eta=False) as bar:
-        for aggregation in bar:
-            aggregate_ghg_rasters(aggregation, data_dir)
+    aggregations = [ghg_aggregation(aggregation, data_dir) for aggregation in spam_aggregations]
+    # all the aggregations in a single pass, the rasters used by several of them are read once
+    outputs = evaluate([aggregation for aggregation in aggregations if aggregation is not None], thread_count)
+    click.echo(f"Created {len(outputs)} aggregated GHG rasters")
 
 
 if __name__ == "__main__":
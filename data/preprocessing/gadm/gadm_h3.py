@@ -1,43 +1,185 @@
-"""Converts the GADM Shapefile to a csv with h3 cells for ingesting
-into geo_region table.
+"""Converts the GADM Shapefile to the rows of the geo_region table, with the h3 cells of every region
+
+The geometries are polyfilled and compacted across a pool of processes and the cells are kept as uint64 arrays.
+The output format is chosen by the extension of the output file:
+ - .parquet: Parquet with the h3Flat and h3Compact cells as list<uint64> columns and the geometries as WKB
+ - .copy: PostgreSQL binary COPY stream of geo_region("id", "h3Compact", "h3Flat", "h3FlatLength", "name", "theGeom"),
+   loaded as is with `\\copy geo_region(...) FROM 'geo_region.copy' WITH (FORMAT binary)`
 """
 
+import multiprocessing
+import os
+import struct
 import uuid
+from functools import partial
 from pathlib import Path
+from typing import BinaryIO, List, Tuple
 
 import click
 import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
 from h3ronpy.pandas import compact
 from h3ronpy.pandas.vector import geoseries_to_cells
 
 H3_RESOLUTION = 6
+SRID = 4326
+OUTPUT_FORMATS = [".parquet", ".copy"]
+
+# h3ronpy runs rayon threads, and a process forked after they started can deadlock in the child, so the workers are
+# spawned instead and polyfill_all can be called at any point, i.e. more than once in the same process
+POLYFILL_POOL_CONTEXT = multiprocessing.get_context("spawn")
+# chunks of geometries sent to each worker, several per worker so a slow chunk doesn't hold the others back
+CHUNKS_PER_THREAD = 8
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+TEXT_OID = 25
+HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+# h3 cell indexes (mode 1) are always 15 hex digits long, from 0x8000... to 0xfff...
+CELL_HEX_LENGTH = 15
+
+
+def polyfill(geometries: List[bytes], resolution: int = H3_RESOLUTION) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Flat and compacted uint64 cells of each WKB geometry, empty arrays for missing geometries"""
+    cells = geoseries_to_cells(gpd.GeoSeries.from_wkb(geometries), resolution=resolution, compact=False)
+    results = []
+    for flat in cells:
+        flat = np.empty(0, dtype=np.uint64) if flat is None else np.asarray(flat, dtype=np.uint64)
+        compacted = np.asarray(compact(flat), dtype=np.uint64) if len(flat) else flat
+        results.append((flat, compacted))
+    return results
+
+
+def balanced_chunks(costs: np.ndarray, chunk_count: int) -> List[np.ndarray]:
+    """Splits the positions of costs in chunks of about the same total cost, costliest first
+
+    The positions are taken by decreasing cost, so the costliest geometries get a chunk of their own and start first.
+    """
+    order = np.argsort(-costs, kind="stable")
+    total = costs.sum()
+    if total <= 0 or chunk_count <= 1:
+        return [order] if len(order) else []
+    chunk_ids = np.minimum(np.cumsum(costs[order]) // (total / chunk_count), chunk_count - 1)
+    return np.split(order, np.flatnonzero(np.diff(chunk_ids)) + 1)
+
+
+def _init_polyfill_worker():
+    # one h3ronpy thread per worker process, the pool already uses the cores
+    os.environ["RAYON_NUM_THREADS"] = "1"
+
+
+def polyfill_all(
+    geometries: gpd.GeoSeries, resolution: int = H3_RESOLUTION, thread_count: int = 1
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """Flat and compacted cells of every geometry, polyfilled in parallel in chunks of about the same area"""
+    wkb = shapely.to_wkb(geometries.to_numpy())
+    costs = np.nan_to_num(shapely.area(geometries.to_numpy()))
+    flat, compacted = [None] * len(wkb), [None] * len(wkb)
+    pool = POLYFILL_POOL_CONTEXT.Pool(thread_count, initializer=_init_polyfill_worker) if thread_count > 1 else None
+    try:
+        chunks = balanced_chunks(costs, thread_count * CHUNKS_PER_THREAD if pool is not None else 1)
+        tasks = [list(wkb[chunk]) for chunk in chunks]
+        if pool is not None:
+            results = pool.imap(partial(polyfill, resolution=resolution), tasks, chunksize=1)
+        else:
+            results = (polyfill(task, resolution) for task in tasks)
+        for chunk, chunk_results in zip(chunks, results):
+            for position, (flat_cells, compact_cells) in zip(chunk, chunk_results):
+                flat[position], compacted[position] = flat_cells, compact_cells
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return flat, compacted
+
+
+def list_array(arrays: List[np.ndarray]) -> pa.ListArray:
+    """list<uint64> arrow array from a list of uint64 arrays, without going through python lists"""
+    offsets = np.r_[0, np.cumsum([len(array) for array in arrays])].astype(np.int32)
+    values = np.concatenate([np.empty(0, dtype=np.uint64)] + arrays)
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(values, type=pa.uint64()))
+
+
+def write_parquet(gdf: gpd.GeoDataFrame, output: Path):
+    table = pa.table(
+        {
+            "id": gdf["id"],
+            "h3Compact": list_array(list(gdf["h3Compact"])),
+            "h3Flat": list_array(list(gdf["h3Flat"])),
+            "h3FlatLength": pa.array(gdf["h3FlatLength"], type=pa.int32()),
+            "name": gdf["name"],
+            "theGeom": pa.array(shapely.to_wkb(gdf.geometry.to_numpy()), type=pa.binary()),
+        }
+    )
+    pq.write_table(table, output.as_posix(), compression="zstd")
+
+
+def hex_cells(cells: np.ndarray) -> np.ndarray:
+    """Lowercase hex digits of the cells like hex(cell)[2:], as a (cells, 15) uint8 array"""
+    if len(cells) and (cells.min() < 16 ** (CELL_HEX_LENGTH - 1) or cells.max() >= 16**CELL_HEX_LENGTH):
+        raise ValueError("Not valid h3 cell indexes")
+    shifts = np.arange(4 * (CELL_HEX_LENGTH - 1), -1, -4, dtype=np.uint64)
+    return HEX_DIGITS[(cells[:, None] >> shifts) & np.uint64(0xF)]
+
+
+def copy_text_array(cells: np.ndarray) -> bytes:
+    """Binary COPY representation of the cells as a text[] of hex strings, the type of the h3 columns"""
+    if not len(cells):
+        return struct.pack(">iii", 0, 0, TEXT_OID)
+    # each element is its length followed by its bytes
+    elements = np.empty((len(cells), 4 + CELL_HEX_LENGTH), dtype=np.uint8)
+    elements[:, :4] = np.frombuffer(struct.pack(">i", CELL_HEX_LENGTH), dtype=np.uint8)
+    elements[:, 4:] = hex_cells(cells)
+    return struct.pack(">iiiii", 1, 0, TEXT_OID, len(cells), 1) + elements.tobytes()
+
+
+def copy_field(value) -> bytes:
+    """A field of a binary COPY row: its length and its bytes, or length -1 for null"""
+    if value is None:
+        return struct.pack(">i", -1)
+    return struct.pack(">i", len(value)) + value
+
+
+def write_copy(gdf: gpd.GeoDataFrame, sink: BinaryIO):
+    """Writes the rows as a PostgreSQL binary COPY stream of the geo_region columns listed in the module docstring"""
+    geometries = shapely.to_wkb(shapely.set_srid(gdf.geometry.to_numpy(), SRID), include_srid=True)
+    sink.write(COPY_SIGNATURE + struct.pack(">ii", 0, 0))
+    for row, geometry in zip(gdf[["id", "h3Compact", "h3Flat", "h3FlatLength", "name"]].itertuples(False), geometries):
+        fields = [
+            uuid.UUID(row.id).bytes,
+            copy_text_array(row.h3Compact),
+            copy_text_array(row.h3Flat),
+            struct.pack(">i", row.h3FlatLength),
+            row.name.encode() if isinstance(row.name, str) else None,
+            geometry,
+        ]
+        sink.write(struct.pack(">h", len(fields)) + b"".join(copy_field(field) for field in fields))
+    sink.write(struct.pack(">h", -1))
 
 
 @click.command()
 @click.argument("filename", type=click.Path(exists=True, path_type=Path))
 @click.argument("output", type=click.Path(path_type=Path))
-def main(filename: Path, output) -> None:
-    """Convert gadm shapefile to csv with h3 columns"""
-    gdf = gpd.read_file(filename)
-    print("Making h3 cells...")
-    gdf["h3Flat"] = geoseries_to_cells(gdf["geometry"], resolution=H3_RESOLUTION, compact=False)
-    gdf["h3Compact"] = [list(compact(x)) for x in gdf["h3Flat"]]
-    gdf["h3Compact"] = gdf["h3Compact"].apply(lambda arr: [hex(x)[2:] for x in arr])
-    gdf["h3Flat"] = gdf["h3Flat"].apply(lambda arr: [hex(x)[2:] for x in arr])
-
-    # convert h3 lists to sql literal arrays
-    gdf["h3Compact"] = gdf["h3Compact"].apply(lambda x: f"{{{','.join(e for e in x)}}}")
-    gdf["h3Flat"] = gdf["h3Flat"].apply(lambda x: f"{{{','.join(e for e in x)}}}")
-
-    gdf = gdf.to_wkb(hex=True)
-    gdf = gdf.drop(["name"], axis=1)
-    gdf = gdf.rename(columns={"geometry": "theGeom", "mpath": "name"})
-
-    gdf["h3FlatLength"] = gdf["h3Flat"].apply(lambda x: len(x))
+@click.option("--thread-count", type=int, default=1, help="Number of processes polyfilling the geometries")
+def main(filename: Path, output: Path, thread_count: int) -> None:
+    """Convert gadm shapefile to a parquet file or a binary COPY stream of geo_region rows"""
+    if output.suffix not in OUTPUT_FORMATS:
+        raise click.BadParameter(f"Output must be one of {', '.join(OUTPUT_FORMATS)}", param_hint="OUTPUT")
+    gdf = gpd.read_file(filename, engine="pyogrio")
+    print(f"Making h3 cells of {len(gdf)} regions...")
+    gdf["h3Flat"], gdf["h3Compact"] = polyfill_all(gdf.geometry, H3_RESOLUTION, thread_count)
+    gdf["h3FlatLength"] = [len(cells) for cells in gdf["h3Flat"]]
+    gdf = gdf.drop(["name"], axis=1).rename(columns={"mpath": "name"})
     gdf["id"] = [str(uuid.uuid4()) for _ in range(len(gdf))]
+
     print(f"Writing to {output}...")
-    gdf.to_csv(output, index=False, columns=["id", "h3Compact", "h3Flat", "h3FlatLength", "name", "theGeom"])
-    # gdf.to_parquet(output, index=False, columns=["id", "h3Compact", "h3Flat", "h3FlatLength", "name", "theGeom"])
+    if output.suffix == ".parquet":
+        write_parquet(gdf, output)
+    else:
+        with open(output, "wb") as sink:
+            write_copy(gdf, sink)
 
 
 if __name__ == "__main__":
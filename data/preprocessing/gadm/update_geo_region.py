@@ -0,0 +1,242 @@
+"""Incremental refresh of geo_region from the GADM Shapefile, only the added or changed regions are polyfilled
+
+Every region geometry is fingerprinted with a hash of its WKB and the H3 resolution, and compared with the fingerprint
+of the geo_region row of the same name, kept in the geo_region_fingerprint table of the API schema (entity
+GeoRegionFingerprint). The rows without a stored fingerprint (i.e. after a full import with
+populate_geo_and_admin_regions.sql) get it from their geometry and the resolution of their cells. Only the regions
+with a new or different fingerprint are polyfilled and upserted: the others keep their cells, and every existing row
+keeps its id so the tables referencing geo_region are untouched.
+The added regions get their admin_region, linked to their parent like in populate_geo_and_admin_regions.sql.
+The regions of geo_region missing from the file are reported but not deleted, they can still be referenced.
+"""
+
+import hashlib
+import os
+import tempfile
+import uuid
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import click
+import geopandas as gpd
+import numpy as np
+import psycopg2
+import shapely
+from gadm_h3 import H3_RESOLUTION, polyfill_all, write_copy
+
+GEO_REGION_COLUMNS = '"id", "h3Compact", "h3Flat", "h3FlatLength", "name", "theGeom"'
+
+STORED_FINGERPRINTS = """
+    SELECT gr.name, gr.id, f."fingerprint"
+    FROM geo_region gr
+    LEFT JOIN geo_region_fingerprint f ON f."geoRegionId" = gr.id
+    WHERE gr.name IS NOT NULL AND NOT gr."isCreatedByUser"
+"""
+
+# geometry as stored, in the same WKB flavor as `normalized_wkb()`, and a cell to know the resolution of the row
+STORED_GEOMETRIES = """
+    SELECT id, ST_AsBinary("theGeom", 'NDR'), "h3Flat"[1]
+    FROM geo_region
+    WHERE id = ANY(%s::uuid[])
+"""
+
+UPSERT_FINGERPRINTS = """
+    INSERT INTO geo_region_fingerprint ("geoRegionId", "fingerprint")
+    SELECT unnest(%s::uuid[]), unnest(%s::text[])
+    ON CONFLICT ("geoRegionId") DO UPDATE SET "fingerprint" = EXCLUDED."fingerprint"
+"""
+
+UPSERT_GEO_REGIONS = f"""
+    INSERT INTO geo_region ({GEO_REGION_COLUMNS}, "isCreatedByUser")
+    SELECT {GEO_REGION_COLUMNS}, FALSE FROM geo_region_update
+    ON CONFLICT (id) DO UPDATE SET
+        "h3Compact" = EXCLUDED."h3Compact",
+        "h3Flat" = EXCLUDED."h3Flat",
+        "h3FlatLength" = EXCLUDED."h3FlatLength",
+        "theGeom" = EXCLUDED."theGeom"
+"""
+
+INSERT_ADMIN_REGIONS = """
+    INSERT INTO admin_region ("name", "level", "gadmId", "geoRegionId", "isoA3")
+    SELECT
+        name,
+        level,
+        mpath,
+        "geoRegionId",
+        CASE WHEN gid_0 = mpath THEN gid_0 ELSE NULL END
+    FROM unnest(%s::text[], %s::int[], %s::text[], %s::uuid[], %s::text[])
+        AS added(name, level, mpath, "geoRegionId", gid_0)
+    ON CONFLICT ("gadmId") DO UPDATE SET
+        "geoRegionId" = EXCLUDED."geoRegionId"
+"""
+
+# same parent rule as populate_geo_and_admin_regions.sql, GADM appends "_1" to the end of some IDs
+LINK_ADMIN_REGION_PARENTS = """
+    UPDATE admin_region child
+    SET "parentId" = parent.id
+    FROM admin_region parent
+    WHERE child."gadmId" = ANY(%s::text[])
+        AND subpath(child."gadmId"::ltree, 0, -1)::text = replace(parent."gadmId", '_1', '')
+"""
+
+# id based materialized path `parent.mpath`.`child.id`, the level of the parents must be done before
+SET_ADMIN_REGION_MPATHS = """
+    UPDATE admin_region child
+    SET mpath = concat(
+        (SELECT parent.mpath || '.' FROM admin_region parent WHERE parent.id = child."parentId"), child.id
+    )
+    WHERE child."gadmId" = ANY(%s::text[]) AND child.level = %s
+"""
+
+
+class RegionChanges(NamedTuple):
+    """Positions in the file of the added and changed regions and names of the regions missing from the file"""
+
+    added: np.ndarray
+    changed: np.ndarray
+    removed: List[str]
+
+
+def get_connection():
+    """Connection to the API database from the API_POSTGRES_* environment variables"""
+    return psycopg2.connect(
+        host=os.getenv("API_POSTGRES_HOST"),
+        port=os.getenv("API_POSTGRES_PORT"),
+        database=os.getenv("API_POSTGRES_DATABASE"),
+        user=os.getenv("API_POSTGRES_USERNAME"),
+        password=os.getenv("API_POSTGRES_PASSWORD"),
+    )
+
+
+def normalized_wkb(geometries: np.ndarray) -> np.ndarray:
+    """2D little endian ISO WKB, the bytes of PostGIS ST_AsBinary(geom, 'NDR') for the same geometry"""
+    return shapely.to_wkb(geometries, output_dimension=2, byte_order=1, flavor="iso")
+
+
+def fingerprint(wkb: Optional[bytes], resolution: int) -> Optional[str]:
+    """Hash of the WKB of a geometry and the H3 resolution of its cells, None for missing geometries"""
+    if wkb is None:
+        return None
+    return hashlib.sha256(f"{resolution}:".encode() + bytes(wkb)).hexdigest()
+
+
+def cell_resolution(cell: str) -> int:
+    """Resolution of a hex h3 cell index, stored in bits 52 to 55"""
+    return (int(cell, 16) >> 52) & 0xF
+
+
+def stored_fingerprints(cursor) -> Dict[str, tuple]:
+    """(id, fingerprint) of the GADM rows of geo_region by name
+
+    The rows without a stored fingerprint get it from their geometry and the resolution of their first cell and it is
+    stored, the rows without cells have None and are always polyfilled again.
+    """
+    cursor.execute(STORED_FINGERPRINTS)
+    stored = {name: (region_id, region_fingerprint) for name, region_id, region_fingerprint in cursor.fetchall()}
+    missing = [region_id for region_id, region_fingerprint in stored.values() if region_fingerprint is None]
+    if missing:
+        print(f"Fingerprinting {len(missing)} stored geo regions...")
+        cursor.execute(STORED_GEOMETRIES, (missing,))
+        computed = {
+            region_id: fingerprint(wkb, cell_resolution(cell)) if cell is not None else None
+            for region_id, wkb, cell in cursor.fetchall()
+        }
+        stored = {name: (region_id, computed.get(region_id, fp)) for name, (region_id, fp) in stored.items()}
+        ids = [region_id for region_id, fp in computed.items() if fp is not None]
+        cursor.execute(UPSERT_FINGERPRINTS, (ids, [computed[region_id] for region_id in ids]))
+    return stored
+
+
+def region_changes(names: List[str], fingerprints: List[str], stored: Dict[str, tuple]) -> RegionChanges:
+    """Compares the fingerprints of the regions in the file with the stored ones"""
+    added = [i for i, name in enumerate(names) if name not in stored]
+    changed = [i for i, name in enumerate(names) if name in stored and stored[name][1] != fingerprints[i]]
+    removed = sorted(set(stored) - set(names))
+    return RegionChanges(np.array(added, dtype=np.int64), np.array(changed, dtype=np.int64), removed)
+
+
+def upsert_geo_regions(cursor, gdf: gpd.GeoDataFrame):
+    """Upserts the rows of gdf in geo_region by id, through a temporary table loaded with a binary COPY stream"""
+    cursor.execute("CREATE TEMPORARY TABLE geo_region_update (LIKE geo_region INCLUDING DEFAULTS) ON COMMIT DROP")
+    # spooled to disk, the stream of a large update doesn't have to fit in memory
+    with tempfile.TemporaryFile() as buffer:
+        write_copy(gdf, buffer)
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY geo_region_update ({GEO_REGION_COLUMNS}) FROM STDIN WITH (FORMAT binary)", buffer)
+    cursor.execute(UPSERT_GEO_REGIONS)
+
+
+def insert_admin_regions(cursor, gdf: gpd.GeoDataFrame):
+    """Creates the admin_region of the added regions and links them to their parents level by level"""
+    mpaths = gdf["mpath"].tolist()
+    cursor.execute(
+        INSERT_ADMIN_REGIONS,
+        (gdf["name"].tolist(), gdf["level"].astype(int).tolist(), mpaths, gdf["id"].tolist(), gdf["gid_0"].tolist()),
+    )
+    cursor.execute(LINK_ADMIN_REGION_PARENTS, (mpaths,))
+    for level in sorted(gdf["level"].astype(int).unique()):
+        cursor.execute(SET_ADMIN_REGION_MPATHS, (mpaths, int(level)))
+
+
+def refresh_geo_regions(conn, gdf: gpd.GeoDataFrame, thread_count: int = 1, dry_run: bool = False) -> int:
+    """Polyfills and upserts the added and changed regions of gdf in a single transaction, returns how many
+
+    A dry run only reports the changes, its transaction is rolled back.
+    """
+    fingerprints = [fingerprint(wkb, H3_RESOLUTION) for wkb in normalized_wkb(gdf.geometry.to_numpy())]
+    with conn:
+        with conn.cursor() as cursor:
+            stored = stored_fingerprints(cursor)
+            changes = region_changes(gdf["mpath"].tolist(), fingerprints, stored)
+            print(
+                f"{len(changes.added)} added, {len(changes.changed)} changed and"
+                f" {len(gdf) - len(changes.added) - len(changes.changed)} unchanged regions"
+            )
+            if changes.removed:
+                print(f"{len(changes.removed)} regions missing from the file are kept: {', '.join(changes.removed)}")
+            positions = np.r_[changes.added, changes.changed]
+            if dry_run:
+                # not even the fingerprints computed for the stored rows are kept
+                conn.rollback()
+                return 0
+            if not len(positions):
+                return 0
+
+            updated = gdf.iloc[positions].copy()
+            # the changed regions keep their id, the tables referencing them are untouched
+            updated["id"] = [str(uuid.uuid4()) for _ in changes.added] + [
+                stored[name][0] for name in gdf["mpath"].iloc[changes.changed]
+            ]
+            print(f"Making h3 cells of {len(updated)} regions...")
+            updated["h3Flat"], updated["h3Compact"] = polyfill_all(updated.geometry, H3_RESOLUTION, thread_count)
+            updated["h3FlatLength"] = [len(cells) for cells in updated["h3Flat"]]
+
+            print("Updating geo_region...")
+            upsert_geo_regions(cursor, updated.drop(["name"], axis=1).rename(columns={"mpath": "name"}))
+            if len(changes.added):
+                insert_admin_regions(cursor, updated.iloc[: len(changes.added)])
+            located = [i for i, position in enumerate(positions) if fingerprints[position] is not None]
+            cursor.execute(
+                UPSERT_FINGERPRINTS,
+                ([updated["id"].iloc[i] for i in located], [fingerprints[positions[i]] for i in located]),
+            )
+    return len(positions)
+
+
+@click.command()
+@click.argument("filename", type=click.Path(exists=True, path_type=Path))
+@click.option("--thread-count", type=int, default=1, help="Number of processes polyfilling the geometries")
+@click.option("--dry-run", is_flag=True, help="Report the added, changed and removed regions without updating")
+def main(filename: Path, thread_count: int, dry_run: bool) -> None:
+    """Polyfill and upsert the regions of the gadm shapefile that are new or changed since the last refresh"""
+    gdf = gpd.read_file(filename, engine="pyogrio")
+    conn = get_connection()
+    try:
+        updated = refresh_geo_regions(conn, gdf, thread_count, dry_run)
+    finally:
+        conn.close()
+    print(f"Updated {updated} geo regions")
+
+
+if __name__ == "__main__":
+    main()
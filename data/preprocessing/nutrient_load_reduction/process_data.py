@@ -2,17 +2,24 @@
 and estimates the percentage of reduction needed to meet a good water quality conditions.
 
 Usage:
-process_data.py <input_folder> <output_folder>
+process_data.py <input_folder> <output_folder> [--format=parquet]
 
 Arguments:
     <input_folder>     Input folder containing the limiting nutrients shapefile
     <output_folder>    Output folder to export the required percentage reduction
+Options:
+    --format=<format>  Output format, GeoParquet, FlatGeobuf or shapefile [parquet, fgb, shp] [default: parquet]
 """
 import logging
+import sys
 from pathlib import Path
 import argparse
 
 import geopandas as gpd
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # shared preprocessing modules
+from vector_output import OUTPUT_FORMATS, write_vector  # noqa: E402
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("preprocessing_limiting_nutrients_file")
@@ -43,7 +50,7 @@ def check_and_reproject_to_4326(gdf):
     return gdf
 
 
-def calculate_perc_reduction(row):
+def calculate_perc_reduction(cases, tp_con, tn_con):
     """
     Calculation of the required Load Reduction.
 
@@ -51,18 +58,23 @@ def calculate_perc_reduction(row):
     McDowell et al. (2020)
     The global concentration thresholds values for Total N (0.70 mg-N/L) and Total P (0.046 mg-P/L)
     represent acceptable levels of algal growth.
+    Computed for all the basins at once from the Cases_v2_1, TP_con_V2_ and TN_con_V2_ columns. Basins without
+    concentration (zero) of their limiting nutrient need no reduction.
 
     More information can be found on the LandGriffon v2.0 methodology
     """
-    if row["Cases_v2_1"] == 4 and row["TP_con_V2_"]:
-        return ((row["TP_con_V2_"] - 0.046) / row["TP_con_V2_"]) * 100
-    elif row["Cases_v2_1"] == 2 and row["TN_con_V2_"]:
-        return ((row["TN_con_V2_"] - 0.7) / row["TN_con_V2_"]) * 100
-    else:
-        return 0
-
-
-def process_folder(input_folder, output_folder):
+    cases = np.asarray(cases, dtype="float64")
+    tp_con = np.asarray(tp_con, dtype="float64")
+    tn_con = np.asarray(tn_con, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tp_reduction = ((tp_con - 0.046) / tp_con) * 100
+        tn_reduction = ((tn_con - 0.7) / tn_con) * 100
+    return np.select(
+        [(cases == 4) & (tp_con != 0), (cases == 2) & (tn_con != 0)], [tp_reduction, tn_reduction], default=0.0
+    )
+
+
+def process_folder(input_folder, output_folder, output_format="parquet"):
     vec_extensions = "gdb gpkg shp json geojson".split()
     input_path = Path(input_folder)
     output_path = Path(output_folder)
@@ -78,12 +90,12 @@ def process_folder(input_folder, output_folder):
         # Check and reproject to EPSG:4326
         gdf = check_and_reproject_to_4326(gdf)
         # Calculate perc_reduction and add it as a new column
-        gdf["perc_reduc"] = gdf.apply(calculate_perc_reduction, axis=1)
-        # Save the processed data to a new shapefile
+        gdf["perc_reduc"] = calculate_perc_reduction(gdf["Cases_v2_1"], gdf["TP_con_V2_"], gdf["TN_con_V2_"])
+        # Save the processed data to a new file
         gdf = gdf[["Cases_v2_1", "perc_reduc", "geometry"]]
-        output_file = output_path / "nutrient_load_reduction.shp"
+        output_file = output_path / f"nutrient_load_reduction{OUTPUT_FORMATS[output_format]}"
         log.info(f"Saving preprocessed file to {output_file}")
-        gdf.to_file(output_file)
+        write_vector(gdf, output_file)
     else:
         mssg = (
             f"Found more than one vector file in {input_folder}."
@@ -98,10 +110,11 @@ def main():
     parser = argparse.ArgumentParser(description="Process limiting nutrients vector files.")
     parser.add_argument("input_folder", type=str, help="Path to the input folder containing vector files")
     parser.add_argument("output_folder", type=str, help="Path to the output folder to save processed data")
+    parser.add_argument("--format", help="Output format", choices=OUTPUT_FORMATS, default="parquet")
     args = parser.parse_args()
 
     # Process the specified folder
-    process_folder(args.input_folder, args.output_folder)
+    process_folder(args.input_folder, args.output_folder, args.format)
 
 
 if __name__ == "__main__":
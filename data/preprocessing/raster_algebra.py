@@ -0,0 +1,128 @@
+"""Block streaming evaluation of weighted sums of rasters, shared by the raster aggregation pipelines
+
+Every expression is a weighted sum of rasters on the same grid written to its own output. All the expressions are
+evaluated together band of rows by band of rows: each band of an input is read once and shared by every expression
+that uses it, so the memory is bounded by the band size whatever the number and size of the rasters. The bands are
+computed in parallel by a pool of processes and written as they are done to tiled, deflate compressed GeoTIFFs.
+"""
+
+import logging
+import math
+import multiprocessing
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+
+log = logging.getLogger(__name__)  # here we can use __name__ because it is an imported module
+
+NODATA_MODES = ["mask", "nansum"]
+TILE_SIZE = 256
+
+
+class WeightedSum(NamedTuple):
+    """output = sum(weight * raster for raster, weight in terms.items())
+
+    nodata is how the cells without data are added:
+     - mask: like numpy masked arrays, the cells where any of the terms is nodata are nodata in the output
+     - nansum: the values are added as read and NaN counts as 0, like np.nansum
+
+    The output has the profile of the first term and the result is rounded to decimals if given.
+    """
+
+    output: Path
+    terms: Dict[Path, float]
+    nodata: str = "mask"
+    decimals: Optional[int] = None
+
+
+def check_grid(reference: rio.DatasetReader, raster: rio.DatasetReader):
+    """Rasters must share the grid to be added cell by cell"""
+    if (reference.shape, reference.transform, reference.crs) != (raster.shape, raster.transform, raster.crs):
+        raise ValueError(f"Raster {raster.name} is not on the same grid as {reference.name}")
+
+
+def band_windows(height: int, width: int, window_rows: int) -> List[Window]:
+    """Windows of whole rows covering the raster, the band height is rounded up to the output tile size"""
+    rows = TILE_SIZE * math.ceil(window_rows / TILE_SIZE)
+    return [Window(0, row, width, min(rows, height - row)) for row in range(0, height, rows)]
+
+
+def output_profile(reference: rio.DatasetReader) -> dict:
+    """Profile of the reference raster as a single band tiled GeoTIFF with deflate compression"""
+    profile = reference.profile.copy()
+    floating = np.dtype(profile["dtype"]).kind == "f"
+    profile.update(
+        driver="GTiff",
+        count=1,
+        tiled=True,
+        blockxsize=TILE_SIZE,
+        blockysize=TILE_SIZE,
+        compress="deflate",
+        predictor=3 if floating else 2,
+        BIGTIFF="IF_SAFER",
+    )
+    return profile
+
+
+def evaluate_window(expressions: List[WeightedSum], dtypes: List[str], window: Window) -> List[np.ndarray]:
+    """Evaluates all the expressions on a window, reading each input only once"""
+    inputs = sorted({raster for expression in expressions for raster in expression.terms})
+    with ExitStack() as stack:
+        bands = {raster: stack.enter_context(rio.open(raster)).read(1, window=window, masked=True) for raster in inputs}
+    results = []
+    for expression, dtype in zip(expressions, dtypes, strict=True):
+        terms = [(bands[raster], weight) for raster, weight in expression.terms.items()]
+        if expression.nodata == "mask":
+            (first, first_weight), *rest = terms
+            result = first * first_weight
+            for band, weight in rest:
+                result += band * weight
+        else:
+            result = np.nansum([np.ma.getdata(band) * weight for band, weight in terms], 0)
+        if expression.decimals is not None:
+            result = np.round(result, expression.decimals)
+        results.append(result.astype(dtype))
+    return results
+
+
+def evaluate(expressions: List[WeightedSum], thread_count: int = 1, window_rows: int = 4 * TILE_SIZE) -> List[Path]:
+    """Evaluates the weighted sums band by band and writes each to its output, returns the output paths"""
+    if not expressions:
+        return []
+    for expression in expressions:
+        if expression.nodata not in NODATA_MODES:
+            raise ValueError(f"Unknown nodata mode {expression.nodata}, use one of {NODATA_MODES}")
+        if not expression.terms:
+            raise ValueError(f"Weighted sum for {expression.output} has no terms")
+    inputs = sorted({raster for expression in expressions for raster in expression.terms})
+    with ExitStack() as stack:
+        datasets = {raster: stack.enter_context(rio.open(raster)) for raster in inputs}
+        reference = datasets[inputs[0]]
+        for dataset in datasets.values():
+            check_grid(reference, dataset)
+        profiles = [output_profile(datasets[next(iter(expression.terms))]) for expression in expressions]
+        windows = band_windows(reference.height, reference.width, window_rows)
+    log.info(f"Evaluating {len(expressions)} weighted sums of {len(inputs)} rasters in {len(windows)} bands")
+
+    compute = partial(evaluate_window, expressions, [profile["dtype"] for profile in profiles])
+    with ExitStack() as stack:
+        # forked before opening the outputs, the workers only read
+        pool = stack.enter_context(multiprocessing.Pool(thread_count)) if thread_count > 1 else None
+        outputs = [
+            stack.enter_context(rio.open(expression.output, "w", **profile))
+            for expression, profile in zip(expressions, profiles, strict=True)
+        ]
+        # a pool sized batch of bands at a time, so memory doesn't grow if writing is slower than computing
+        batch_size = max(thread_count, 1)
+        for start in range(0, len(windows), batch_size):
+            batch = windows[start : start + batch_size]
+            results = pool.map(compute, batch) if pool is not None else [compute(window) for window in batch]
+            for window, window_results in zip(batch, results, strict=True):
+                for output, result in zip(outputs, window_results, strict=True):
+                    output.write(result, 1, window=window)
+    return [expression.output for expression in expressions]
@@ -0,0 +1,123 @@
+import sys
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from shapely.geometry import LineString, MultiPolygon, Polygon, box
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "unsustainable_water_use"))
+sys.path.append(str(Path(__file__).resolve().parents[1] / "nutrient_load_reduction"))
+import preprocess_data as water_use  # noqa: E402
+import process_data as nutrient_load  # noqa: E402
+
+
+# Row by row implementations the vectorized ones replaced, the outputs must not change
+def row_water_perc_reduction(row):
+    if row["bws_cat"] > 2 and row["bws_raw"] != 9999:
+        return ((row["bws_raw"] - 0.4) / row["bws_raw"]) * 100
+    elif row["bws_cat"] == 4 and row["bws_raw"] == 9999:
+        return ((0.8 - 0.4) / 0.8) * 100
+    else:
+        return 0
+
+
+def row_nutrient_perc_reduction(row):
+    if row["Cases_v2_1"] == 4 and row["TP_con_V2_"]:
+        return ((row["TP_con_V2_"] - 0.046) / row["TP_con_V2_"]) * 100
+    elif row["Cases_v2_1"] == 2 and row["TN_con_V2_"]:
+        return ((row["TN_con_V2_"] - 0.7) / row["TN_con_V2_"]) * 100
+    else:
+        return 0
+
+
+def row_fix_invalid_geometries(gdf):
+    # guarded against missing geometries, which made the row by row version fail
+    invalid_geometries = gdf[~gdf.geometry.is_valid]
+    if not invalid_geometries.empty:
+        fixed_geometries = []
+        for geom in invalid_geometries.geometry:
+            if geom is not None and geom.geom_type == "Polygon":
+                fixed_geom = geom.buffer(0)
+            elif geom is not None and geom.geom_type == "MultiPolygon":
+                fixed_geom = MultiPolygon([polygon.buffer(0) for polygon in geom.geoms])
+            else:
+                fixed_geom = geom
+            fixed_geometries.append(fixed_geom)
+        gdf.loc[invalid_geometries.index, "geometry"] = fixed_geometries
+    return gdf[~gdf.geometry.is_empty]
+
+
+@pytest.fixture
+def basins():
+    rng = np.random.default_rng(0)
+    size = 5_000
+    bws_raw = rng.uniform(0, 1.5, size)
+    bws_raw[rng.random(size) < 0.1] = 9999
+    cases = rng.choice([1, 2, 3, 4], size).astype("float64")
+    tp_con = rng.uniform(0, 0.2, size)
+    tn_con = rng.uniform(0, 3, size)
+    tp_con[rng.random(size) < 0.1] = 0
+    tn_con[rng.random(size) < 0.1] = 0
+    tn_con[rng.random(size) < 0.05] = np.nan
+    return pd.DataFrame(
+        {
+            "bws_cat": rng.choice([-1, 0, 1, 2, 3, 4], size).astype("float64"),
+            "bws_raw": bws_raw,
+            "Cases_v2_1": cases,
+            "TP_con_V2_": tp_con,
+            "TN_con_V2_": tn_con,
+        }
+    )
+
+
+def test_water_perc_reduction_special_cases():
+    """Extremely high stress basins without raw value (9999) are taken as a raw value of 0.8"""
+    bws_cat = [4, 3, 4, 3, 2, 1, np.nan]
+    bws_raw = [9999, 9999, 0.8, 0.5, 0.5, 9999, 0.9]
+    expected = [((0.8 - 0.4) / 0.8) * 100, 0, ((0.8 - 0.4) / 0.8) * 100, ((0.5 - 0.4) / 0.5) * 100, 0, 0, 0]
+    np.testing.assert_array_equal(water_use.calculate_perc_reduction(bws_cat, bws_raw), expected)
+
+
+def test_water_perc_reduction_matches_row_by_row(basins):
+    expected = basins.apply(row_water_perc_reduction, axis=1).to_numpy()
+    result = water_use.calculate_perc_reduction(basins["bws_cat"], basins["bws_raw"])
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_nutrient_perc_reduction_special_cases():
+    """Only the limiting nutrient of each basin counts and basins without its concentration need no reduction"""
+    cases = [4, 4, 2, 2, 1, 2]
+    tp_con = [0.092, 0, 0.092, 0.092, 0.092, 0.092]
+    tn_con = [1.4, 1.4, 1.4, 0, 1.4, np.nan]
+    result = nutrient_load.calculate_perc_reduction(cases, tp_con, tn_con)
+    expected = [((0.092 - 0.046) / 0.092) * 100, 0, ((1.4 - 0.7) / 1.4) * 100, 0, 0, np.nan]
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_nutrient_perc_reduction_matches_row_by_row(basins):
+    expected = basins.apply(row_nutrient_perc_reduction, axis=1).to_numpy()
+    result = nutrient_load.calculate_perc_reduction(basins["Cases_v2_1"], basins["TP_con_V2_"], basins["TN_con_V2_"])
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_fix_invalid_geometries_matches_row_by_row():
+    bowtie = Polygon([(0, 0), (2, 2), (2, 0), (0, 2)])
+    collapsed = Polygon([(0, 0), (1, 1), (2, 2), (0, 0)])
+    geometries = [
+        box(0, 0, 1, 1),
+        bowtie,
+        collapsed,
+        MultiPolygon([shapely.affinity.translate(bowtie, 5), box(10, 10, 11, 11)]),
+        MultiPolygon([collapsed, box(20, 20, 21, 21)]),
+        MultiPolygon([collapsed]),
+        LineString([(0, 0), (1, 1), (0, 0)]),
+        None,
+    ]
+    gdf = gpd.GeoDataFrame({"id": range(len(geometries))}, geometry=geometries, crs="EPSG:4326")
+    expected = row_fix_invalid_geometries(gdf.copy())
+    result = water_use.fix_invalid_geometries(gdf.copy())
+    assert result["id"].tolist() == expected["id"].tolist()
+    assert result.geometry.to_wkb().tolist() == expected.geometry.to_wkb().tolist()
@@ -0,0 +1,103 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from raster_algebra import TILE_SIZE, WeightedSum, band_windows, evaluate  # noqa: E402
+
+# taller than two bands of rows, so the last band ends at the raster height and not on a band boundary
+HEIGHT, WIDTH = 2 * TILE_SIZE + 89, 53
+TRANSFORM = from_origin(-10, 60, 0.1, 0.1)
+
+
+def write_raster(path, data, nodata, transform=TRANSFORM):
+    profile = {
+        "driver": "GTiff",
+        "height": data.shape[0],
+        "width": data.shape[1],
+        "count": 1,
+        "dtype": data.dtype,
+        "crs": "EPSG:4326",
+        "transform": transform,
+        "nodata": nodata,
+    }
+    with rio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+    return path
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = {}
+    for name in ["a", "b", "c"]:
+        data = rng.uniform(0, 100, (HEIGHT, WIDTH)).astype("float32")
+        data[rng.random((HEIGHT, WIDTH)) < 0.1] = -1
+        paths[name] = write_raster(tmp_path / f"{name}.tif", data, nodata=-1)
+    for name in ["nan_a", "nan_b"]:
+        data = rng.uniform(0, 100, (HEIGHT, WIDTH)).astype("float32")
+        data[rng.random((HEIGHT, WIDTH)) < 0.2] = np.nan
+        paths[name] = write_raster(tmp_path / f"{name}.tif", data, nodata=np.nan)
+    return paths
+
+
+def read(path, masked=False):
+    with rio.open(path) as src:
+        return src.read(1, masked=masked)
+
+
+def expressions(rasters, output_folder):
+    return [
+        WeightedSum(output_folder / "mask.tif", {rasters["a"]: 0.5, rasters["b"]: 2.0, rasters["c"]: -1.0}),
+        WeightedSum(output_folder / "nansum.tif", {rasters["nan_a"]: 1.5, rasters["nan_b"]: 3.0}, nodata="nansum"),
+        WeightedSum(output_folder / "rounded.tif", {rasters["a"]: 1 / 3}, decimals=2),
+    ]
+
+
+def test_band_windows_cover_the_raster():
+    windows = band_windows(HEIGHT, WIDTH, window_rows=TILE_SIZE + 1)
+
+    assert [(window.row_off, window.height) for window in windows] == [(0, 2 * TILE_SIZE), (2 * TILE_SIZE, 89)]
+    assert all(window.width == WIDTH for window in windows)
+
+
+@pytest.mark.parametrize("window_rows", [TILE_SIZE, 3 * TILE_SIZE])
+def test_evaluate_matches_full_reads(rasters, tmp_path, window_rows):
+    mask, nansum, rounded = evaluate(expressions(rasters, tmp_path), window_rows=window_rows)
+
+    expected = read(rasters["a"], True) * 0.5 + read(rasters["b"], True) * 2.0 + read(rasters["c"], True) * -1.0
+    result = read(mask, True)
+    # a cell is nodata in the output as soon as one of the terms is
+    np.testing.assert_array_equal(result.mask, expected.mask)
+    np.testing.assert_allclose(result.compressed(), expected.compressed(), rtol=1e-6)
+    assert result.mask.any() and not result.mask.all()
+
+    expected = np.nansum([read(rasters["nan_a"]) * 1.5, read(rasters["nan_b"]) * 3.0], 0)
+    np.testing.assert_allclose(read(nansum), expected, rtol=1e-6)
+    assert not np.isnan(read(nansum)).any()
+
+    expected = np.round(read(rasters["a"], True) * (1 / 3), 2)
+    np.testing.assert_allclose(read(rounded, True).compressed(), expected.compressed(), rtol=1e-6)
+
+
+def test_parallel_evaluation_matches_serial(rasters, tmp_path):
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+
+    serial = evaluate(expressions(rasters, tmp_path / "serial"), window_rows=TILE_SIZE)
+    parallel = evaluate(expressions(rasters, tmp_path / "parallel"), thread_count=3, window_rows=TILE_SIZE)
+
+    for serial_output, parallel_output in zip(serial, parallel, strict=True):
+        np.testing.assert_array_equal(read(parallel_output), read(serial_output))
+
+
+def test_rasters_must_share_the_grid(rasters, tmp_path):
+    shifted = write_raster(tmp_path / "shifted.tif", read(rasters["a"]), -1, from_origin(-9.9, 60, 0.1, 0.1))
+
+    with pytest.raises(ValueError, match="not on the same grid"):
+        evaluate([WeightedSum(tmp_path / "out.tif", {rasters["a"]: 1.0, shifted: 1.0})])
+    assert not (tmp_path / "out.tif").exists()
@@ -0,0 +1,158 @@
+import sys
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import MultiPolygon, Polygon, box
+
+# the gadm scripts need the pandas API of h3ronpy, newer than the one pinned for the h3 importers
+pytest.importorskip("h3ronpy.pandas")
+sys.path.append(str(Path(__file__).resolve().parents[1] / "gadm"))
+from update_geo_region import (  # noqa: E402
+    H3_RESOLUTION,
+    STORED_FINGERPRINTS,
+    STORED_GEOMETRIES,
+    UPSERT_FINGERPRINTS,
+    cell_resolution,
+    fingerprint,
+    normalized_wkb,
+    refresh_geo_regions,
+    region_changes,
+    stored_fingerprints,
+)
+
+REGIONS = gpd.GeoDataFrame(
+    {
+        "mpath": ["AAA", "AAA.1_1", "BBB"],
+        "name": ["Aaa", "Aaa one", "Bbb"],
+        "level": [0, 1, 0],
+        "gid_0": ["AAA", "AAA", "BBB"],
+    },
+    geometry=[box(0, 0, 2, 2), box(0, 0, 1, 1), box(10, 10, 11, 11)],
+    crs="EPSG:4326",
+)
+
+
+def fingerprints(geometries, resolution=H3_RESOLUTION):
+    return [fingerprint(wkb, resolution) for wkb in normalized_wkb(np.asarray(geometries, dtype=object))]
+
+
+class FakeConnection:
+    """psycopg2 like connection answering the queries of update_geo_region from lists of stored rows"""
+
+    def __init__(self, stored_rows, stored_geometries):
+        self.stored_rows = stored_rows
+        self.stored_geometries = stored_geometries
+        self.log = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.log.append("commit" if exc_type is None else "rollback")
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.log.append("rollback")
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, params=None):
+        self.connection.log.append(query)
+        if query == STORED_FINGERPRINTS:
+            self.result = self.connection.stored_rows
+        elif query == STORED_GEOMETRIES:
+            self.result = [row for row in self.connection.stored_geometries if row[0] in params[0]]
+        else:
+            self.result = []
+
+    def fetchall(self):
+        return self.result
+
+
+def test_fingerprint_is_stable_across_wkb_flavors():
+    polygon = Polygon([(0, 0), (1, 0), (1, 1), (0, 0)])
+    with_z = Polygon([(0, 0, 5), (1, 0, 5), (1, 1, 5), (0, 0, 5)])
+    # a round trip through big endian extended WKB, as a geometry can come back from another source
+    round_trip = shapely.from_wkb(shapely.to_wkb(polygon, byte_order=0, flavor="extended", include_srid=True))
+
+    assert fingerprints([polygon, with_z, round_trip]) == fingerprints([polygon] * 3)
+    assert fingerprints([polygon]) == fingerprints([Polygon([(0, 0), (1, 0), (1, 1), (0, 0)])])
+    # the stored geometries are compared with the WKB PostGIS ST_AsBinary(geom, 'NDR') returns
+    assert bytes(normalized_wkb(np.array([polygon]))[0])[:5] == b"\x01\x03\x00\x00\x00"
+
+
+def test_fingerprint_changes_with_geometry_and_resolution():
+    polygon = box(0, 0, 1, 1)
+
+    assert fingerprints([polygon]) != fingerprints([box(0, 0, 1, 1.0001)])
+    assert fingerprints([polygon]) != fingerprints([MultiPolygon([polygon])])
+    assert fingerprints([polygon], 6) != fingerprints([polygon], 5)
+    assert fingerprint(None, H3_RESOLUTION) is None
+    assert cell_resolution("861e8050fffffff") == 6
+
+
+def test_region_changes():
+    names = ["AAA", "AAA.1_1", "BBB", "CCC"]
+    current = fingerprints([box(0, 0, 2, 2), box(0, 0, 1, 1), box(10, 10, 11, 11), box(20, 20, 21, 21)])
+    stored = {
+        "AAA": ("id-aaa", current[0]),
+        "AAA.1_1": ("id-aaa-1", fingerprints([box(0, 0, 1, 2)])[0]),
+        # polyfilled without cells, never matches
+        "BBB": ("id-bbb", None),
+        "DDD": ("id-ddd", "fingerprint"),
+        "AAA.2_1": ("id-aaa-2", "fingerprint"),
+    }
+
+    changes = region_changes(names, current, stored)
+
+    assert changes.added.tolist() == [3]
+    assert changes.changed.tolist() == [1, 2]
+    assert changes.removed == ["AAA.2_1", "DDD"]
+    assert changes.added.dtype == changes.changed.dtype == np.int64
+
+    unchanged = region_changes(names[:1], current[:1], {"AAA": ("id-aaa", current[0])})
+    assert len(unchanged.added) == len(unchanged.changed) == 0 and unchanged.removed == []
+
+
+def test_stored_rows_are_fingerprinted_from_their_geometry():
+    stored_rows = [("AAA", "id-aaa", None), ("AAA.1_1", "id-aaa-1", None), ("BBB", "id-bbb", None)]
+    stored_geometries = [
+        ("id-aaa", normalized_wkb(np.array([box(0, 0, 2, 2)]))[0], "861e8050fffffff"),
+        # polyfilled at another resolution, it has to be done again
+        ("id-aaa-1", normalized_wkb(np.array([box(0, 0, 1, 1)]))[0], "851e8053fffffff"),
+        # no cells
+        ("id-bbb", normalized_wkb(np.array([box(10, 10, 11, 11)]))[0], None),
+    ]
+
+    stored = stored_fingerprints(FakeCursor(FakeConnection(stored_rows, stored_geometries)))
+
+    assert stored["AAA"] == ("id-aaa", fingerprints([box(0, 0, 2, 2)])[0])
+    assert stored["AAA.1_1"] == ("id-aaa-1", fingerprints([box(0, 0, 1, 1)], 5)[0])
+    assert stored["BBB"] == ("id-bbb", None)
+    changes = region_changes(REGIONS["mpath"].tolist(), fingerprints(REGIONS.geometry), stored)
+    assert changes.changed.tolist() == [1, 2] and len(changes.added) == 0
+
+
+def test_dry_run_writes_nothing():
+    conn = FakeConnection([("AAA", "id-aaa", None)], [("id-aaa", b"wkb", "861e8050fffffff")])
+
+    assert refresh_geo_regions(conn, REGIONS, dry_run=True) == 0
+
+    # the fingerprints of the stored rows are computed and rolled back with everything else
+    assert conn.log == [STORED_FINGERPRINTS, STORED_GEOMETRIES, UPSERT_FINGERPRINTS, "rollback", "commit"]
+    assert not any("CREATE" in query or "geo_region_update" in query for query in conn.log)
@@ -1,23 +1,31 @@
-""" Reads the baseline water stress from aqueduct vector file, reporjects the file to EPSG4326 and estimates the percentage of reduction needed to meet a good water quality conditions.
+"""Reads the baseline water stress from aqueduct vector file, reporjects the file to EPSG4326 and estimates the percentage of reduction needed to meet a good water quality conditions.
 
 Usage:
-process_data.py <input_folder> <output_folder>
+process_data.py <input_folder> <output_folder> [--format=parquet]
 
 Arguments:
     <folder>     Folder containing the baseline aqueduct data
     <folder>     Folder containing the preprocessed percentage of required reduction data
+Options:
+    --format=<format>  Output format, GeoParquet, FlatGeobuf or shapefile [parquet, fgb, shp] [default: parquet]
 """
-from http.client import TEMPORARY_REDIRECT
+
+import argparse
 import logging
+import sys
 from pathlib import Path
-import argparse
 
 import geopandas as gpd
-from shapely.geometry import MultiPolygon
+import numpy as np
+import shapely
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # shared preprocessing modules
+from vector_output import OUTPUT_FORMATS, write_vector  # noqa: E402
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("preprocessing_limiting_nutrients_file")
 
+
 def check_and_reproject_to_4326(gdf):
     """
     Checks if a GeoDataFrame is in CRS 4326 (WGS84) and reprojects it if not.
@@ -41,10 +49,14 @@ def check_and_reproject_to_4326(gdf):
 
     return gdf
 
+
 def fix_invalid_geometries(gdf):
     """
     Identify and fix invalid geometries in a GeoDataFrame.
 
+    All the invalid geometries are repaired at once with shapely's array functions: polygons with buffer(0) and
+    multipolygons buffering each constituent polygon. Other geometry types are left as they are.
+
     Parameters:
     gdf (GeoDataFrame): Input GeoDataFrame.
 
@@ -52,47 +64,62 @@ def fix_invalid_geometries(gdf):
     GeoDataFrame: A GeoDataFrame with invalid geometries fixed.
     """
     # Step 1: Identify invalid geometries
-    invalid_geometries = gdf[~gdf.geometry.is_valid]
+    geometries = gdf.geometry.to_numpy()
+    invalid = ~shapely.is_valid(geometries)
+    type_ids = shapely.get_type_id(geometries)
+    polygons = invalid & (type_ids == shapely.GeometryType.POLYGON)
+    multipolygons = invalid & (type_ids == shapely.GeometryType.MULTIPOLYGON)
 
     # Step 2: Fix invalid geometries
-    if not invalid_geometries.empty:
-        fixed_geometries = []
-        for geom in invalid_geometries.geometry:
-            if geom.geom_type == 'Polygon':
-                # Try to fix invalid Polygon geometries using buffer(0)
-                fixed_geom = geom.buffer(0)
-            elif geom.geom_type == 'MultiPolygon':
-                # If it's a MultiPolygon, fix each constituent Polygon
-                fixed_polygons = [polygon.buffer(0) for polygon in geom.geoms]
-                fixed_geom = MultiPolygon(fixed_polygons)
-            else:
-                # Skip unsupported geometry types
-                fixed_geom = geom
-
-            fixed_geometries.append(fixed_geom)
+    if polygons.any() or multipolygons.any():
+        fixed = geometries.copy()
+        # Try to fix invalid Polygon geometries using buffer(0)
+        fixed[polygons] = shapely.buffer(geometries[polygons], 0)
+        # If it's a MultiPolygon, fix each constituent Polygon. The fixed parts can be empty or split in several
+        # polygons, they are flattened again and the empty ones dropped before rebuilding the multipolygons
+        parts, owners = shapely.get_parts(geometries[multipolygons], return_index=True)
+        fixed_parts, split_from = shapely.get_parts(shapely.buffer(parts, 0), return_index=True)
+        owners = owners[split_from]
+        kept = ~shapely.is_empty(fixed_parts)
+        rebuilt = np.full(multipolygons.sum(), shapely.MultiPolygon(), dtype=object)
+        if kept.any():
+            shapely.multipolygons(fixed_parts[kept], indices=owners[kept], out=rebuilt)
+        fixed[multipolygons] = rebuilt
 
         # Replace invalid geometries with fixed ones
-        gdf.loc[invalid_geometries.index, 'geometry'] = fixed_geometries
+        repaired = polygons | multipolygons
+        gdf.loc[repaired, "geometry"] = fixed[repaired]
     # Step 3: Remove rows with None geometries
     gdf = gdf[~gdf.geometry.is_empty]
 
     return gdf
 
 
-# Calculation of the required percentage of reduction.
-# This reduction is calculated in all catchment which baseline water stress is above the threshold 0.4.
-# More information can be found on the LandGriffon v2.0 methodology under the unsustainable water use indicator.
-# NOTE: There are some cases where the basin is categorised as extremely high BWS (>80%) but the raw value is 9999.0
-# We are considering in those cases that the bws raw value is equal to 0.8
-def calculate_perc_reduction(row):
-    if row['bws_cat'] > 2 and row['bws_raw'] != 9999:
-        return ((row['bws_raw'] - 0.4) / row['bws_raw']) * 100
-    elif row['bws_cat']==4 and row['bws_raw'] == 9999:
-        return ((0.8- 0.4) / 0.8) * 100
-    else:
-        return 0
+def calculate_perc_reduction(bws_cat, bws_raw):
+    """
+    Calculation of the required percentage of reduction.
+
+    This reduction is calculated in all catchment which baseline water stress is above the threshold 0.4.
+    NOTE: There are some cases where the basin is categorised as extremely high BWS (>80%) but the raw value is 9999.0
+    We are considering in those cases that the bws raw value is equal to 0.8
+    Computed for all the basins at once from the bws_cat and bws_raw columns.
 
-def process_folder(input_folder, output_folder):
+    More information can be found on the LandGriffon v2.0 methodology under the unsustainable water use indicator.
+    """
+    bws_cat = np.asarray(bws_cat, dtype="float64")
+    bws_raw = np.asarray(bws_raw, dtype="float64")
+    no_raw = bws_raw == 9999
+    with np.errstate(divide="ignore", invalid="ignore"):
+        reduction = ((bws_raw - 0.4) / bws_raw) * 100
+    return np.select(
+        [(bws_cat > 2) & ~no_raw, (bws_cat == 4) & no_raw],
+        [reduction, ((0.8 - 0.4) / 0.8) * 100],
+        default=0.0,
+    )
+
+
+def process_folder(input_folder, output_folder, output_format="parquet"):
+    """Preprocesses the single aqueduct vector file of input_folder into the excess withdrawals file"""
     vec_extensions = "gdb gpkg shp json geojson".split()
     input_path = Path(input_folder)
     output_path = Path(output_folder)
@@ -102,22 +129,22 @@ def process_folder(input_folder, output_folder):
     if not vectors:
         log.error(f"No vectors with extension {vec_extensions} found in {input_folder}")
         return
-    if len(vectors) == 1: #folder just contains one vector file
+    if len(vectors) == 1:  # folder just contains one vector file
         # Read the shapefile
         gdf = gpd.read_file(vectors[0])
         # Use dropna() to remove rows with None-type geometries and fix invalid geometries
-        log.info('Fixing invalid geometries')
+        log.info("Fixing invalid geometries")
         gdf = fix_invalid_geometries(gdf)
         # Check and reproject to EPSG:4326
         gdf = check_and_reproject_to_4326(gdf)
         # Clean gdf to keep just necessary columns
-        gdf = gdf[['bws_cat', 'bws_raw', 'geometry']]
+        gdf = gdf[["bws_cat", "bws_raw", "geometry"]]
         # Calculate perc_reduction and add it as a new column
-        gdf['perc_reduc'] = gdf.apply(calculate_perc_reduction, axis=1)
-        # Save the processed data to a new shapefile
-        output_file = output_path / 'excess_withdrawals.shp'
+        gdf["perc_reduc"] = calculate_perc_reduction(gdf["bws_cat"], gdf["bws_raw"])
+        # Save the processed data to a new file
+        output_file = output_path / f"excess_withdrawals{OUTPUT_FORMATS[output_format]}"
         log.info(f"Saving preprocessed file to {output_file}")
-        gdf.to_file(output_file)
+        write_vector(gdf, output_file)
     else:
         mssg = (
             f"Found more than one vector file in {input_folder}."
@@ -126,15 +153,19 @@ def process_folder(input_folder, output_folder):
         logging.error(mssg)
         return
 
+
 def main():
+    """Parses the command line and preprocesses the aqueduct folder"""
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Process aqueduct vector files.")
     parser.add_argument("input_folder", type=str, help="Path to the input folder containing vector files")
     parser.add_argument("output_folder", type=str, help="Path to the output folder to save processed data")
+    parser.add_argument("--format", help="Output format", choices=OUTPUT_FORMATS, default="parquet")
     args = parser.parse_args()
 
     # Process the specified folder
-    process_folder(args.input_folder, args.output_folder)
+    process_folder(args.input_folder, args.output_folder, args.format)
+
 
 if __name__ == "__main__":
     main()
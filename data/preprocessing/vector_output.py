@@ -0,0 +1,66 @@
+"""Writers of the vector files handed over from the preprocessing pipelines to h3_data_importer and gdal_rasterize
+
+GeoParquet is the default hand-off format: it is written and read columnar, keeps the full column names and has no
+file size cap. The features are sorted along a Hilbert curve and written with a GeoParquet 1.1 bbox covering column,
+so a reader with a bounding box skips the row groups outside of it using their statistics.
+FlatGeobuf (.fgb) is the option for the files that GDAL tools read, it has a spatial index and no column name limit.
+Any other extension (i.e. the legacy .shp) is written by GDAL as well.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Union
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+log = logging.getLogger(__name__)  # here we can use __name__ because it is an imported module
+
+OUTPUT_FORMATS = {"parquet": ".parquet", "fgb": ".fgb", "shp": ".shp"}
+
+# small enough row groups for the bbox statistics to skip most of a global layer when reading a region
+ROW_GROUP_SIZE = 10_000
+
+
+def write_geoparquet(gdf: gpd.GeoDataFrame, path: Union[str, Path], row_group_size: int = ROW_GROUP_SIZE):
+    """Writes a GeoParquet 1.1 file with WKB geometries and a bbox covering column, sorted along a Hilbert curve"""
+    geometry_column = gdf.geometry.name
+    # missing and empty geometries have no place on the curve nor bounds, they go last with a null bbox
+    located = ~(gdf.geometry.isna() | gdf.geometry.is_empty).to_numpy()
+    located_rows = np.flatnonzero(located)
+    hilbert = gdf.geometry.iloc[located_rows].hilbert_distance().to_numpy() if len(located_rows) else []
+    gdf = gdf.iloc[np.r_[located_rows[np.argsort(hilbert, kind="stable")], np.flatnonzero(~located)]]
+    geometries = gdf.geometry.to_numpy()
+    missing = np.arange(len(gdf)) >= len(located_rows)
+    bounds = [pa.array(bound, mask=missing) for bound in shapely.bounds(geometries).T]
+    table = pa.Table.from_pandas(gdf.drop(columns=geometry_column), preserve_index=False)
+    table = table.append_column(geometry_column, pa.array(shapely.to_wkb(geometries), type=pa.binary()))
+    table = table.append_column("bbox", pa.StructArray.from_arrays(bounds, names=["xmin", "ymin", "xmax", "ymax"]))
+    geo = {
+        "version": "1.1.0",
+        "primary_column": geometry_column,
+        "columns": {
+            geometry_column: {
+                "encoding": "WKB",
+                "geometry_types": sorted(gdf.geom_type.dropna().unique()),
+                "crs": gdf.crs.to_json_dict() if gdf.crs is not None else None,
+                "bbox": [float(bound) for bound in gdf.total_bounds] if len(located_rows) else [],
+                "covering": {"bbox": {key: ["bbox", key] for key in ("xmin", "ymin", "xmax", "ymax")}},
+            }
+        },
+    }
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"geo": json.dumps(geo).encode()})
+    pq.write_table(table, Path(path).as_posix(), row_group_size=row_group_size)
+
+
+def write_vector(gdf: gpd.GeoDataFrame, path: Union[str, Path]):
+    """Writes gdf as GeoParquet for a .parquet path and with GDAL (through pyogrio) for any other format"""
+    if Path(path).suffix == ".parquet":
+        write_geoparquet(gdf, path)
+    else:
+        gdf.to_file(path, engine="pyogrio")
+    log.info(f"Written {len(gdf)} features to {path}")
@@ -12,6 +12,8 @@ class Settings(BaseSettings):
     titiler_prefix: str = getenv("TITILER_PREFIX")
     titiler_router_prefix: str = getenv("TITILER_ROUTER_PREFIX")
     default_cog: str = getenv("DEFAULT_COG")
+    auth_cache_ttl: str = getenv("AUTH_CACHE_TTL", "60")
+    auth_cache_size: str = getenv("AUTH_CACHE_SIZE", "1024")
 
 @lru_cache()
 def get_settings():
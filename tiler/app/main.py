@@ -7,7 +7,7 @@ from titiler.core.errors import DEFAULT_STATUS_CODES, add_exception_handlers
 from titiler.core.middleware import LoggerMiddleware, TotalTimeMiddleware
 
 from .config.config import get_settings
-from .middlewares.auth_middleware import AuthMiddleware
+from .middlewares.auth_middleware import AuthMiddleware, token_validator
 from .middlewares.s3_access import s3_presigned_access
 
 root_path = get_settings().root_path
@@ -33,6 +33,18 @@ app.include_router(cog.router, tags=["Cloud Optimized GeoTIFF"], prefix=titiler_
 add_exception_handlers(app, DEFAULT_STATUS_CODES)
 
 
+@app.on_event("startup")
+async def open_token_validator():
+    """Open the pooled client used to validate the tokens, in the event loop serving the requests."""
+    await token_validator.open()
+
+
+@app.on_event("shutdown")
+async def close_token_validator():
+    """Close the connections to the API used to validate the tokens."""
+    await token_validator.aclose()
+
+
 @app.get("/health", description="Health Check", tags=["Health Check"])
 def ping():
     """Health check."""
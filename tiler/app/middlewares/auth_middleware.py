@@ -1,17 +1,117 @@
-import requests
-from fastapi import Request, Response, HTTPException
+import asyncio
+import base64
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+import httpx
+from fastapi import HTTPException, Request, Response
 from starlette.middleware.base import BaseHTTPMiddleware
-import os
+
 from app.config.config import get_settings
 
 api_url = get_settings().api_url
 api_port = get_settings().api_port
 require_auth = get_settings().require_auth
+auth_cache_ttl = float(get_settings().auth_cache_ttl)
+auth_cache_size = int(get_settings().auth_cache_size)
+
+
+def token_lifetime(token: str) -> float | None:
+    """Seconds until the `exp` claim of a "Bearer <jwt>" token, None if the token has no readable expiry.
+
+    The signature is not checked here, the expiry only bounds how long a validation by the API is cached.
+    """
+    try:
+        payload = token.split()[-1].split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"]) - time.time()
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenValidator:
+    """Validates tokens against the API /auth/validate-token endpoint.
+
+    The requests go through a pooled async client that keeps its connections alive. Its connections belong to the
+    event loop they were opened in, so the validator is opened and closed with the app lifespan, or used as an async
+    context manager. Valid tokens are kept in a bounded LRU cache keyed on the hash of the token, for ttl seconds or
+    until the token expires if sooner, and concurrent validations of the same token share a single request to the API.
+    """
+
+    def __init__(self, url: str, ttl: float = 60, max_size: int = 1024, max_connections: int = 20, timeout: float = 10):
+        self.url = url
+        self.ttl = ttl
+        self.max_size = max_size
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = timeout
+        # token hash -> time.monotonic() the validation expires at
+        self._cache: OrderedDict[bytes, float] = OrderedDict()
+        self._pending: dict[bytes, asyncio.Future] = {}
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled client, only available between open() and aclose()"""
+        if self._client is None:
+            raise RuntimeError("The token validator is not open")
+        return self._client
+
+    async def open(self):
+        """Opens the pooled client, in the event loop that serves the requests"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+
+    async def aclose(self):
+        """Closes the pooled client and its connections to the API"""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    async def __aenter__(self) -> "TokenValidator":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def is_valid(self, token: str) -> bool:
+        """Whether the API accepts the token, answered from the cache while a validation holds"""
+        key = hashlib.sha256(token.encode()).digest()
+        expires = self._cache.get(key)
+        if expires is not None:
+            if expires > time.monotonic():
+                self._cache.move_to_end(key)
+                return True
+            del self._cache[key]
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._validate(token, key))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        # a cancelled request must not cancel the validation the others are waiting for
+        return await asyncio.shield(pending)
+
+    async def _validate(self, token: str, key: bytes) -> bool:
+        response = await self.client.get(self.url, headers={"Authorization": token})
+        if response.status_code != 200:
+            return False
+        lifetime = token_lifetime(token)
+        ttl = self.ttl if lifetime is None else min(self.ttl, lifetime)
+        if ttl > 0:
+            self._cache[key] = time.monotonic() + ttl
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return True
+
+
+token_validator = TokenValidator(f"{api_url}:{api_port}/auth/validate-token", auth_cache_ttl, auth_cache_size)
 
 
 class AuthMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        print('accessing path', request.url.path)
+        print("accessing path", request.url.path)
         if request.url.path in ("/health", "/tiler/docs", "/tiler"):
             return await call_next(request)
         if require_auth == "false":
@@ -21,15 +121,10 @@ class AuthMiddleware(BaseHTTPMiddleware):
                 token = request.headers.get("Authorization")
                 if not token:
                     return Response(status_code=400, content="No token found")
-                headers = {
-                    "Authorization": token
-                }
-                response = requests.get(f"{api_url}:{api_port}/auth/validate-token", headers=headers)
-                if response.status_code != 200:
+                if not await token_validator.is_valid(token):
                     return Response(status_code=401, content="Unauthorized")
                 return await call_next(request)
 
-
             except Exception as e:
                 print(e)
-                raise HTTPException(status_code=500, detail=str(e))
+                raise HTTPException(status_code=500, detail=str(e)) from e
@@ -1,34 +1,162 @@
-import os
+import asyncio
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
-from unittest.mock import patch, Mock
 from starlette.testclient import TestClient
 
 from ..main import app
+from ..middlewares import auth_middleware
+from ..middlewares.auth_middleware import TokenValidator, token_lifetime
 from ..middlewares.s3_access import s3_presigned_access
 
-test_client = TestClient(app)
 
 def override_s3_pressigned_access(url: str | None):
     return url
 
+
 # Inject a mock dependency
 app.dependency_overrides[s3_presigned_access] = override_s3_pressigned_access
 
 
-@patch('app.middlewares.auth_middleware.requests.get')
-def test_auth_failing_api_validation(mock_get):
-    mock = Mock()
-    mock.status_code = 401
-    mock_get.return_value = mock
-    response = test_client.get("/cog/info", headers={"Authorization": "Bearer my_token"})
+def jwt(**claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).rstrip(b"=").decode()
+    return f"Bearer header.{payload}.signature"
+
+
+class StubApi(BaseHTTPRequestHandler):
+    """API /auth/validate-token stub, accepting the tokens in server.valid_tokens"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        token = self.headers.get("Authorization")
+        self.server.requests.append((self.path, token, self.client_address[1]))
+        time.sleep(self.server.delay)
+        valid = self.path == "/auth/validate-token" and token in self.server.valid_tokens
+        payload = b'{"message": "valid token"}' if valid else b'{"message": "Unauthorized"}'
+        self.send_response(200 if valid else 401)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubApi)
+    server.requests = []
+    server.valid_tokens = {"Bearer my_token"}
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def validator(api, monkeypatch):
+    validator = TokenValidator(f"http://127.0.0.1:{api.server_address[1]}/auth/validate-token", ttl=60)
+    monkeypatch.setattr(auth_middleware, "token_validator", validator)
+    return validator
+
+
+@pytest.fixture
+def client(validator):
+    # the app lifespan opens the module validator, the stub one is opened in the same event loop
+    with TestClient(app) as client:
+        client.portal.call(validator.open)
+        yield client
+        client.portal.call(validator.aclose)
+
+
+def test_auth_failing_api_validation(api, client):
+    response = client.get("/cog/info", headers={"Authorization": "Bearer not_my_token"})
     assert response.status_code == 401
+    assert [token for _, token, _ in api.requests] == ["Bearer not_my_token"]
+
 
-@patch('app.middlewares.auth_middleware.requests.get')
-def test_auth_correct_api_validation(mock_get):
-    mock = Mock()
-    mock.status_code = 200
-    mock_get.return_value = mock
-    response = test_client.get("/cog/info", headers={"Authorization": "Bearer my_token"})
+def test_auth_correct_api_validation(api, client):
+    response = client.get("/cog/info", headers={"Authorization": "Bearer my_token"})
     assert response.status_code != 401
+    assert [token for _, token, _ in api.requests] == ["Bearer my_token"]
+
+
+def test_valid_tokens_are_cached(api, client):
+    for _ in range(3):
+        assert client.get("/cog/info", headers={"Authorization": "Bearer my_token"}).status_code != 401
+    assert len(api.requests) == 1
+
+    # invalid tokens are asked again every time
+    for _ in range(2):
+        assert client.get("/cog/info", headers={"Authorization": "Bearer other"}).status_code == 401
+    assert len(api.requests) == 3
+
+
+def test_cache_is_bounded(api, validator):
+    validator.max_size = 2
+    api.valid_tokens = {"Bearer a", "Bearer b", "Bearer c"}
+
+    async def validate(tokens):
+        async with validator:
+            return [await validator.is_valid(token) for token in tokens]
+
+    assert asyncio.run(validate(["Bearer a", "Bearer b", "Bearer a", "Bearer c", "Bearer a", "Bearer b"])) == [True] * 6
+    # "Bearer b" was the least recently used when "Bearer c" came in
+    assert [token for _, token, _ in api.requests] == ["Bearer a", "Bearer b", "Bearer c", "Bearer b"]
+
+
+def test_cache_is_capped_by_token_expiry(api, validator):
+    expiring, expired = jwt(sub="user", exp=time.time() + 0.3), jwt(sub="user", exp=time.time() - 1)
+    api.valid_tokens = {expiring, expired}
+
+    async def validate(tokens):
+        async with validator:
+            return [await validator.is_valid(token) for token in tokens]
+
+    assert asyncio.run(validate([expiring, expiring, expired, expired])) == [True] * 4
+    assert [token for _, token, _ in api.requests] == [expiring, expired, expired]
+    time.sleep(0.4)
+    asyncio.run(validate([expiring]))
+    assert [token for _, token, _ in api.requests].count(expiring) == 2
+    assert 0 < token_lifetime(jwt(exp=time.time() + 10)) <= 10
+    assert token_lifetime("Bearer my_token") is None
+
+
+def test_concurrent_validations_are_coalesced(api, validator):
+    api.delay = 0.2
+
+    async def validate_concurrently():
+        async with validator:
+            return await asyncio.gather(
+                *(validator.is_valid(token) for token in ["Bearer my_token"] * 20 + ["Bearer other"] * 5)
+            )
+
+    assert asyncio.run(validate_concurrently()) == [True] * 20 + [False] * 5
+    assert sorted(token for _, token, _ in api.requests) == ["Bearer my_token", "Bearer other"]
+
+
+def test_connections_are_kept_alive(api, validator):
+    api.valid_tokens = {f"Bearer {i}" for i in range(5)}
+
+    async def validate_all():
+        async with validator:
+            for token in sorted(api.valid_tokens):
+                assert await validator.is_valid(token)
+            pool = validator.client._transport._pool
+        return pool
 
+    pool = asyncio.run(validate_all())
+    assert len(api.requests) == 5
+    assert len({port for _, _, port in api.requests}) == 1
+    # closing the validator closes its connections, in the event loop they were opened in
+    assert pool.connections == []
+    with pytest.raises(RuntimeError, match="not open"):
+        assert validator.client